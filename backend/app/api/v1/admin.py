@@ -0,0 +1,60 @@
+from typing import Optional
+from fastapi import APIRouter, Depends, Header, HTTPException, Query
+from fastapi.responses import JSONResponse, PlainTextResponse
+
+from app.config import get_settings
+from app.profiling import SamplingProfiler, get_loop_watchdog, request_profiles
+
+settings = get_settings()
+
+
+def require_internal_key(x_internal_key: Optional[str] = Header(None, alias="X-Internal-Key")):
+    if x_internal_key != settings.internal_test_key:
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+
+router = APIRouter(prefix="/admin", tags=["Admin"], dependencies=[Depends(require_internal_key)])
+
+
+@router.get("/profile")
+async def profile_worker(
+    seconds: float = Query(10, gt=0),
+    interval: float = Query(0.005, ge=0.001, le=1),
+    format: str = Query("speedscope", pattern="^(speedscope|collapsed)$")
+):
+    """Sample the stacks of every thread in this worker for ``seconds``.
+
+    ``speedscope`` output opens in https://www.speedscope.app; ``collapsed``
+    is the input format of flamegraph.pl.
+    """
+    if seconds > settings.profile_max_seconds:
+        raise HTTPException(status_code=400, detail=f"At most {settings.profile_max_seconds} seconds")
+    profiler = await SamplingProfiler(interval).profile(seconds)
+    if format == "collapsed":
+        return PlainTextResponse(profiler.collapsed())
+    return JSONResponse(
+        profiler.speedscope(),
+        headers={"Content-Disposition": 'attachment; filename="profile.speedscope.json"'}
+    )
+
+
+@router.get("/profile/requests/{profile_id}")
+async def get_request_profile(
+    profile_id: str,
+    sort: str = Query("cumulative", pattern="^(cumulative|tottime|ncalls)$"),
+    limit: int = Query(50, ge=1, le=1000)
+):
+    """``cProfile`` report of a request sent with ``X-Profile: 1``."""
+    report = request_profiles.report(profile_id, sort, limit)
+    if report is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return PlainTextResponse(report)
+
+
+@router.get("/loop-blocks")
+async def get_loop_blocks():
+    """Recent event loop blocking episodes with the loop thread's stack."""
+    watchdog = get_loop_watchdog()
+    if watchdog is None:
+        return {"threshold_seconds": 0, "events": []}
+    return {"threshold_seconds": watchdog.threshold, "events": list(watchdog.events)}
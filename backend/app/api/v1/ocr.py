@@ -1,15 +1,36 @@
-import subprocess
-import tempfile
-import os
-from fastapi import APIRouter, UploadFile, File, Header, Depends, HTTPException
-from fastapi.responses import FileResponse
+import asyncio
+import hashlib
+from contextlib import asynccontextmanager
+import orjson
+from fastapi import APIRouter, UploadFile, File, Form, Header, Depends, HTTPException, Request
+from fastapi.responses import Response, StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 from pydantic import BaseModel
-from typing import Optional
+from typing import List, Optional
 from app.database import get_db
-from app.services.ocr import process_file
-from app.services.tokens import check_and_use_token, get_token_status
-from app.metrics import ocr_requests, tokens_consumed, free_trial_used
+from app.services.ocr import (
+    process_pages, process_batch, assemble_markdown, inspect_file, parse_page_range,
+    BatchFile, FileInfo, PageResult, PAGE_SEPARATOR
+)
+from app.services.archive import extract_archive, ArchiveEntry, UploadError, ZIP_TYPES
+from app.services.tokens import check_and_use_token, get_token_status, reocr_token_cost
+from app.services.documents import (
+    create_document, get_document, get_document_pages, save_page,
+    complete_document, find_unfinished_document, assemble_document, can_access_document
+)
+from app.services.executor import run_in_thread
+from app.services.deadline import (
+    ClientDisconnected, DeadlineExceeded, cancel_on_disconnect, deadline, request_budget
+)
+from app.services.admission import (
+    AdmissionError, Overloaded, RateLimited, check_rate_limits, estimate_cost, get_admission_controller,
+    refund_rate_limits
+)
+from app.services.export import (
+    convert_markdown, convert_batch, get_export_format, iter_chunks, ExportError, DOCX_MEDIA_TYPE
+)
+from app.metrics import ocr_requests, tokens_consumed, free_trial_used, ocr_cancelled, track_stage, TOOL_NAME
+from app.middleware import strip_etag_encoding
 from app.config import get_settings
 from app.auth import get_current_user, UserInfo
 
@@ -29,6 +50,23 @@ class OCRResponse(BaseModel):
     markdown: Optional[str] = None
     error: Optional[str] = None
     tokens_remaining: int = 0
+    document_id: Optional[str] = None
+
+
+class BatchFileResult(BaseModel):
+    filename: str
+    success: bool
+    document_id: Optional[str] = None
+    page_count: int = 0
+    markdown: Optional[str] = None
+    error: Optional[str] = None
+
+
+class BatchOCRResponse(BaseModel):
+    success: bool
+    files: List[BatchFileResult]
+    markdown: str  # All successful files, each under a "# <filename>" heading
+    tokens_remaining: int = 0
 
 
 class TokenStatusResponse(BaseModel):
@@ -41,9 +79,193 @@ class TokenStatusResponse(BaseModel):
     total_available: int
 
 
+class PageInfoResponse(BaseModel):
+    page_index: int
+    width: float  # Points for PDFs, pixels for images
+    height: float
+    has_text: bool
+
+
+class InspectResponse(BaseModel):
+    filename: str
+    mime_type: str
+    page_count: int
+    encrypted: bool
+    needs_password: bool
+    text_pages: int  # Pages with a text layer
+    pages: List[PageInfoResponse]
+    max_pages: int  # Per-request limit; larger documents need a `pages` range
+    within_limits: bool
+
+
+def entity_tag(body: bytes) -> str:
+    """Strong ETag of a response body."""
+    return f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Whether ``If-None-Match`` lists ``etag``, by weak comparison as RFC 9110 asks."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return any(
+        strip_etag_encoding(tag.strip().removeprefix("W/")) == etag
+        for tag in if_none_match.split(",")
+    )
+
+
+def _serialize(model: BaseModel) -> bytes:
+    return orjson.dumps(model.model_dump())
+
+
+def _serialize_with_tag(model: BaseModel) -> tuple[bytes, str]:
+    body = _serialize(model)
+    return body, entity_tag(body)
+
+
+async def json_response(model: BaseModel, if_none_match: Optional[str] = None, cacheable: bool = False) -> Response:
+    """Serialize a response model off the event loop; documents can be several MB of Markdown.
+    
+    ``cacheable`` responses carry an ETag and are answered with 304 when
+    ``if_none_match`` already has it.
+    """
+    if not cacheable:
+        return Response(await run_in_thread(_serialize, model), media_type="application/json")
+    
+    body, etag = await run_in_thread(_serialize_with_tag, model)
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
+
+
+async def export_response(data: bytes, media_type: str, filename: str, if_none_match: Optional[str]) -> Response:
+    """A converted file as a download, or 304 if the client already has it."""
+    etag = await run_in_thread(entity_tag, data)
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    return StreamingResponse(
+        iter_chunks(data),
+        media_type=media_type,
+        headers={
+            **headers,
+            "Content-Disposition": f'attachment; filename="{filename}"',
+            "Content-Length": str(len(data))
+        }
+    )
+
+
+async def inspect_upload(file_bytes: bytes, mime_type: str) -> FileInfo:
+    """Open an upload without rendering it; 400 if it is unreadable or locked."""
+    try:
+        with track_stage("inspect"):
+            info = await run_in_thread(inspect_file, file_bytes, mime_type)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if info.needs_password:
+        raise HTTPException(status_code=400, detail="PDF is password protected")
+    return info
+
+
+def select_pages(info: FileInfo, pages: Optional[str], max_pages: int) -> List[int]:
+    """The 0-based pages to OCR, enforcing the per-request page limit."""
+    selected = list(range(info.page_count))
+    if pages:
+        try:
+            selected = parse_page_range(pages, info.page_count)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    if len(selected) > max_pages:
+        raise HTTPException(
+            status_code=400,
+            detail=f"{len(selected)} pages selected, at most {max_pages} per request. Select a range with `pages`"
+        )
+    return selected
+
+
+def rate_limit_subject(device_id: str, user: Optional[UserInfo]) -> str:
+    return f"user:{user.id}" if user else f"device:{device_id}"
+
+
+@asynccontextmanager
+async def admitted(subject: str, cost: int, is_internal: bool = False):
+    """Rate limits (429) and admission control (503), both with ``Retry-After``, around OCR work."""
+    counted_at = None
+    try:
+        if not is_internal:
+            counted_at = await check_rate_limits(subject, cost)
+        async with get_admission_controller().admit(cost):
+            yield
+    except AdmissionError as e:
+        if isinstance(e, Overloaded) and counted_at is not None:
+            # Shed requests are retried; they should not use up the device's limits
+            await refund_rate_limits(subject, cost, counted_at)
+        raise HTTPException(
+            status_code=429 if isinstance(e, RateLimited) else 503,
+            detail=str(e),
+            headers={"Retry-After": str(e.retry_after)}
+        )
+
+
+@asynccontextmanager
+async def ocr_deadline(http_request: Request, pages: int, concurrency: int = 1):
+    """Cancel OCR work when the client disconnects (499) or its deadline passes (504).
+    
+    Pages finished by then stay checkpointed, so submitting again resumes.
+    """
+    settings = get_settings()
+    try:
+        async with cancel_on_disconnect(http_request.is_disconnected, settings.disconnect_poll_seconds):
+            async with deadline(request_budget(pages, concurrency)):
+                yield
+    except ClientDisconnected:
+        ocr_cancelled.labels(tool=TOOL_NAME, reason="disconnect").inc()
+        raise HTTPException(status_code=499, detail="Client closed request")
+    except DeadlineExceeded as e:
+        ocr_cancelled.labels(tool=TOOL_NAME, reason="deadline").inc()
+        raise HTTPException(
+            status_code=504,
+            detail=f"OCR processing timed out: {e}. Finished pages are kept; submit again to continue"
+        )
+
+
+@router.post("/inspect", response_model=InspectResponse)
+async def inspect_ocr_file(file: UploadFile = File(...)):
+    """Pre-flight check: page count, page sizes, text layer and encryption, without rendering or charging."""
+    settings = get_settings()
+    content_type = file.content_type or ""
+    if content_type not in ALLOWED_TYPES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unsupported file type: {content_type}. Supported: PDF, JPEG, PNG, WebP"
+        )
+    mime_type = ALLOWED_TYPES[content_type]
+    try:
+        with track_stage("inspect"):
+            info = await run_in_thread(inspect_file, await file.read(), mime_type)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    return InspectResponse(
+        filename=file.filename or "document",
+        mime_type=mime_type,
+        page_count=info.page_count,
+        encrypted=info.encrypted,
+        needs_password=info.needs_password,
+        text_pages=sum(1 for page in info.pages if page.has_text),
+        pages=[PageInfoResponse(**page._asdict()) for page in info.pages],
+        max_pages=settings.max_pages_per_request,
+        within_limits=not info.needs_password and info.page_count <= settings.max_pages_per_request
+    )
+
+
 @router.post("/process", response_model=OCRResponse)
 async def process_ocr(
+    http_request: Request,
     file: UploadFile = File(...),
+    pages: Optional[str] = Form(None),
     x_device_id: str = Header(..., alias="X-Device-Id"),
     x_internal_key: Optional[str] = Header(None, alias="X-Internal-Key"),
     authorization: Optional[str] = Header(None),
@@ -52,7 +274,9 @@ async def process_ocr(
     """Process a PDF or image file and return OCR results in Markdown format.
     
     Supports both device mode (guest) and user mode (logged in with JWT).
-    User mode takes priority if JWT token is provided.
+    User mode takes priority if JWT token is provided. ``pages`` selects
+    1-based pages of a PDF, e.g. ``12-15`` or ``1,3,5-7``; only those are
+    rendered and OCR'd.
     """
     settings = get_settings()
     is_internal = x_internal_key == settings.internal_test_key
@@ -68,45 +292,244 @@ async def process_ocr(
             detail=f"Unsupported file type: {content_type}. Supported: PDF, JPEG, PNG, WebP"
         )
     
-    # Check and use token (skip for internal testing)
-    if not is_internal:
-        success, message = await check_and_use_token(db, x_device_id, user)
-        if not success:
-            raise HTTPException(
-                status_code=402,
-                detail=message
-            )
+    file_bytes = await file.read()
+    mime_type = ALLOWED_TYPES[content_type]
+    is_pdf = mime_type == "application/pdf"
+    dpi = settings.pdf_dpi if is_pdf else None
     
-    # Track metrics
-    ocr_requests.labels(tool="textbook-ocr", file_type=content_type).inc()
-    if not is_internal:
-        tokens_consumed.labels(tool="textbook-ocr").inc()
+    # Pre-flight: reject unreadable, locked or oversized files before charging
+    info = await inspect_upload(file_bytes, mime_type)
+    selected = select_pages(info, pages, settings.max_pages_per_request)
     
-    # Get token status
-    status = await get_token_status(db, x_device_id, user)
-    if not is_internal and status["free_uses_remaining"] < 3:
-        free_trial_used.labels(tool="textbook-ocr").inc()
+    # An interrupted run of the same file resumes from its checkpoints
+    content_hash = await run_in_thread(lambda: hashlib.sha256(file_bytes).hexdigest())
+    document = await find_unfinished_document(db, content_hash, x_device_id, user)
+    resuming = document is not None
     
-    try:
-        file_bytes = await file.read()
+    # Shed or queue before charging when the pipeline is saturated
+    cost = estimate_cost(mime_type, len(selected), len(file_bytes))
+    async with admitted(rate_limit_subject(x_device_id, user), cost, is_internal):
+        # Check and use token (skip for internal testing and resumed runs)
+        if not is_internal and not resuming:
+            success, message = await check_and_use_token(db, x_device_id, user)
+            if not success:
+                raise HTTPException(
+                    status_code=402,
+                    detail=message
+                )
         
-        markdown_result = await process_file(
-            file_bytes,
-            file.filename or "document",
-            ALLOWED_TYPES[content_type]
-        )
+        # Track metrics
+        ocr_requests.labels(tool="textbook-ocr", file_type=content_type).inc()
+        if not is_internal and not resuming:
+            tokens_consumed.labels(tool="textbook-ocr").inc()
         
-        return OCRResponse(
-            success=True,
-            markdown=markdown_result,
-            tokens_remaining=status["total_available"]
-        )
+        # Get token status
+        status = await get_token_status(db, x_device_id, user)
+        if not is_internal and status["free_uses_remaining"] < 3:
+            free_trial_used.labels(tool="textbook-ocr").inc()
         
-    except Exception as e:
+        try:
+            if document is None:
+                document = await create_document(
+                    db,
+                    filename=file.filename or "document",
+                    mime_type=mime_type,
+                    source=file_bytes,
+                    page_count=info.page_count,
+                    content_hash=content_hash,
+                    status="processing",
+                    device_id=x_device_id,
+                    user=user
+                )
+            document_id = document.document_id
+            
+            done = {page.page_index for page in await get_document_pages(db, document_id)}
+            todo = [i for i in selected if i not in done]
+            
+            async def checkpoint(page: PageResult):
+                with track_stage("db"):
+                    await save_page(db, document_id, page, settings.ocr_model, dpi)
+            
+            if todo:
+                async with ocr_deadline(http_request, len(todo)):
+                    await process_pages(
+                        file_bytes,
+                        mime_type,
+                        dpi=settings.pdf_dpi,
+                        page_indices=todo,
+                        on_page=checkpoint
+                    )
+            await complete_document(db, document)
+            
+            return await json_response(OCRResponse(
+                success=True,
+                markdown=await assemble_document(db, document_id),
+                tokens_remaining=status["total_available"],
+                document_id=document_id
+            ))
+        
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(
+                status_code=500,
+                detail=f"OCR processing failed: {str(e)}"
+            )
+
+
+async def read_batch_uploads(files: List[UploadFile], max_files: int, max_bytes: int) -> List[ArchiveEntry]:
+    """Flatten uploaded files and ZIP archives into one list of supported files."""
+    entries: List[ArchiveEntry] = []
+    total = 0
+    for file in files:
+        content_type = file.content_type or ""
+        if content_type in ZIP_TYPES or (file.filename or "").lower().endswith(".zip"):
+            extracted = await run_in_thread(
+                extract_archive, file.file, max_files - len(entries), max_bytes - total
+            )
+        elif content_type in ALLOWED_TYPES:
+            if len(entries) == max_files:
+                raise UploadError(f"Too many files, at most {max_files} per batch")
+            data = await file.read()
+            if total + len(data) > max_bytes:
+                raise UploadError(f"Batch too large, at most {max_bytes // 2**20} MB uncompressed")
+            extracted = [ArchiveEntry(file.filename or "document", data, ALLOWED_TYPES[content_type])]
+        else:
+            raise UploadError(
+                f"Unsupported file type: {content_type}. Supported: PDF, JPEG, PNG, WebP, ZIP"
+            )
+        entries += extracted
+        total += sum(len(entry.data) for entry in extracted)
+    if not entries:
+        raise UploadError("No supported files in the upload")
+    return entries
+
+
+@router.post("/process/batch", response_model=BatchOCRResponse)
+async def process_ocr_batch(
+    http_request: Request,
+    files: List[UploadFile] = File(...),
+    x_device_id: str = Header(..., alias="X-Device-Id"),
+    x_internal_key: Optional[str] = Header(None, alias="X-Internal-Key"),
+    authorization: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_db)
+):
+    """OCR several files, or the PDFs and images inside ZIP archives, in one request.
+    
+    Pages of all files share one work queue, so a batch of photos is OCR'd
+    concurrently rather than one request after another. Tokens are charged
+    once for the whole batch: one per file, except interrupted files being
+    resumed. A file that fails does not fail the others.
+    """
+    settings = get_settings()
+    is_internal = x_internal_key == settings.internal_test_key
+    user = await get_current_user(authorization)
+    
+    try:
+        entries = await read_batch_uploads(files, settings.batch_max_files, settings.batch_max_bytes)
+    except UploadError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    # Resolve every file before charging, so limits are checked up front
+    documents = []
+    for entry in entries:
+        content_hash = await run_in_thread(lambda: hashlib.sha256(entry.data).hexdigest())
+        document = await find_unfinished_document(db, content_hash, x_device_id, user)
+        try:
+            info = await inspect_upload(entry.data, entry.mime_type)
+        except HTTPException as e:
+            raise HTTPException(status_code=400, detail=f"{entry.filename}: {e.detail}")
+        documents.append((content_hash, document, info.page_count))
+    total_pages = sum(page_count for _, _, page_count in documents)
+    if total_pages > settings.batch_max_pages:
         raise HTTPException(
-            status_code=500,
-            detail=f"OCR processing failed: {str(e)}"
+            status_code=400,
+            detail=f"Batch has {total_pages} pages, at most {settings.batch_max_pages} allowed"
         )
+    
+    cost = sum(
+        estimate_cost(entry.mime_type, page_count, len(entry.data))
+        for entry, (_, _, page_count) in zip(entries, documents)
+    )
+    async with admitted(rate_limit_subject(x_device_id, user), cost, is_internal):
+        new_files = sum(1 for _, document, _ in documents if document is None)
+        if not is_internal and new_files:
+            success, message = await check_and_use_token(db, x_device_id, user, amount=new_files)
+            if not success:
+                raise HTTPException(status_code=402, detail=message)
+            tokens_consumed.labels(tool="textbook-ocr").inc(new_files)
+        for entry in entries:
+            ocr_requests.labels(tool="textbook-ocr", file_type=entry.mime_type).inc()
+        
+        status = await get_token_status(db, x_device_id, user)
+        
+        batch, stored = [], []
+        for entry, (content_hash, document, page_count) in zip(entries, documents):
+            if document is None:
+                document = await create_document(
+                    db,
+                    filename=entry.filename,
+                    mime_type=entry.mime_type,
+                    source=entry.data,
+                    page_count=page_count,
+                    content_hash=content_hash,
+                    status="processing",
+                    device_id=x_device_id,
+                    user=user
+                )
+            done = {page.page_index for page in await get_document_pages(db, document.document_id)}
+            todo = [i for i in range(document.page_count) if i not in done]
+            batch.append(BatchFile(entry.data, entry.mime_type, todo))
+            stored.append(document)
+        
+        # Pages finish concurrently; the session must only be used by one at a time
+        db_lock = asyncio.Lock()
+        
+        async def checkpoint(file_index: int, page: PageResult):
+            document = stored[file_index]
+            dpi = settings.pdf_dpi if document.mime_type == "application/pdf" else None
+            async with db_lock:
+                with track_stage("db"):
+                    await save_page(db, document.document_id, page, settings.ocr_model, dpi)
+        
+        async with ocr_deadline(
+            http_request, sum(len(file.page_indices) for file in batch), settings.batch_page_concurrency
+        ):
+            outcomes = await process_batch(
+                batch,
+                dpi=settings.pdf_dpi,
+                concurrency=settings.batch_page_concurrency,
+                on_page=checkpoint
+            )
+        
+        results = []
+        for entry, document, outcome in zip(entries, stored, outcomes):
+            if isinstance(outcome, Exception):
+                results.append(BatchFileResult(
+                    filename=entry.filename,
+                    success=False,
+                    document_id=document.document_id,
+                    page_count=document.page_count,
+                    error=f"OCR processing failed: {outcome}"
+                ))
+                continue
+            await complete_document(db, document)
+            results.append(BatchFileResult(
+                filename=entry.filename,
+                success=True,
+                document_id=document.document_id,
+                page_count=document.page_count,
+                markdown=await assemble_document(db, document.document_id)
+            ))
+        
+        return await json_response(BatchOCRResponse(
+            success=all(result.success for result in results),
+            files=results,
+            markdown=PAGE_SEPARATOR.join(
+                f"# {result.filename}\n\n{result.markdown}" for result in results if result.success
+            ),
+            tokens_remaining=status["total_available"]
+        ))
 
 
 @router.get("/tokens", response_model=TokenStatusResponse)
@@ -125,55 +548,250 @@ async def get_tokens(
     return TokenStatusResponse(**status)
 
 
-class ConvertDocxRequest(BaseModel):
+class DocumentPage(BaseModel):
+    page_index: int
+    model: str
+    dpi: Optional[int] = None
     markdown: str
+    diagnostics: List[dict] = []
 
 
-@router.post("/convert-docx")
-async def convert_to_docx(request: ConvertDocxRequest):
-    """Convert markdown content to Word (.docx) format using pandoc.
+class DocumentResponse(BaseModel):
+    document_id: str
+    filename: str
+    mime_type: str
+    page_count: int
+    status: str
+    pages: List[DocumentPage]
+    markdown: str
+
+
+class ReOCRRequest(BaseModel):
+    pages: List[int]
+    model: Optional[str] = None
+    dpi: Optional[int] = None
+
+
+async def get_accessible_document(db, document_id, device_id, user):
+    document = await get_document(db, document_id)
+    if not document or not can_access_document(document, device_id, user):
+        raise HTTPException(status_code=404, detail="Document not found")
+    return document
+
+
+@router.get("/documents/{document_id}", response_model=DocumentResponse)
+async def get_ocr_document(
+    document_id: str,
+    x_device_id: str = Header(..., alias="X-Device-Id"),
+    authorization: Optional[str] = Header(None),
+    if_none_match: Optional[str] = Header(None, alias="If-None-Match"),
+    db: AsyncSession = Depends(get_db)
+):
+    """Get a stored OCR result with its per-page manifest; 304 if unchanged since ``If-None-Match``."""
+    user = await get_current_user(authorization)
+    document = await get_accessible_document(db, document_id, x_device_id, user)
+    pages = await get_document_pages(db, document_id)
     
-    This properly handles LaTeX math formulas by converting them to OMML format.
+    return await json_response(DocumentResponse(
+        document_id=document.document_id,
+        filename=document.filename,
+        mime_type=document.mime_type,
+        page_count=document.page_count,
+        status=document.status,
+        pages=[
+            DocumentPage(
+                page_index=p.page_index,
+                model=p.model,
+                dpi=p.dpi,
+                markdown=p.markdown,
+                diagnostics=p.diagnostics or []
+            )
+            for p in pages
+        ],
+        markdown=assemble_markdown([p.markdown for p in pages], [p.page_index + 1 for p in pages])
+    ), if_none_match, cacheable=True)
+
+
+@router.post("/documents/{document_id}/reocr", response_model=OCRResponse)
+async def reocr_document_pages(
+    document_id: str,
+    request: ReOCRRequest,
+    http_request: Request,
+    x_device_id: str = Header(..., alias="X-Device-Id"),
+    x_internal_key: Optional[str] = Header(None, alias="X-Internal-Key"),
+    authorization: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_db)
+):
+    """Re-run OCR for selected pages of a stored document.
+    
+    Only the requested pages are rendered and OCR'd again, optionally with a
+    different model or DPI; the other pages are reused from the manifest.
+    Billing is per started block of ``reocr_pages_per_token`` pages.
     """
-    try:
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.md', delete=False, encoding='utf-8') as md_file:
-            md_file.write(request.markdown)
-            md_path = md_file.name
+    settings = get_settings()
+    is_internal = x_internal_key == settings.internal_test_key
+    user = await get_current_user(authorization)
+    
+    document = await get_accessible_document(db, document_id, x_device_id, user)
+    is_pdf = document.mime_type == "application/pdf"
+    if document.status != "completed":
+        raise HTTPException(status_code=409, detail="Document is still processing")
+    
+    page_indices = sorted(set(request.pages))
+    if not page_indices:
+        raise HTTPException(status_code=400, detail="No pages selected")
+    if page_indices[0] < 0 or page_indices[-1] >= document.page_count:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Page index out of range. Document has {document.page_count} page(s)"
+        )
+    
+    model = request.model or settings.ocr_model
+    if model not in settings.ocr_model_choices and model != settings.ocr_model:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unsupported model: {model}. Supported: {', '.join(settings.ocr_model_choices)}"
+        )
+    
+    dpi = request.dpi or settings.pdf_dpi
+    if not settings.pdf_dpi_min <= dpi <= settings.pdf_dpi_max:
+        raise HTTPException(
+            status_code=400,
+            detail=f"DPI must be between {settings.pdf_dpi_min} and {settings.pdf_dpi_max}"
+        )
+    
+    cost = estimate_cost(document.mime_type, len(page_indices), len(document.source))
+    async with admitted(rate_limit_subject(x_device_id, user), cost, is_internal):
+        if not is_internal:
+            amount = reocr_token_cost(len(page_indices))
+            success, message = await check_and_use_token(db, x_device_id, user, amount=amount)
+            if not success:
+                raise HTTPException(status_code=402, detail=message)
+            tokens_consumed.labels(tool="textbook-ocr").inc(amount)
         
-        docx_path = md_path.replace('.md', '.docx')
+        status = await get_token_status(db, x_device_id, user)
+        
+        # Each page is saved when done, so pages finished before a disconnect are kept
+        async def checkpoint(page: PageResult):
+            with track_stage("db"):
+                await save_page(db, document_id, page, model, dpi if is_pdf else None)
         
         try:
-            result = subprocess.run(
-                ['pandoc', md_path, '-o', docx_path, '--from=markdown', '--to=docx'],
-                capture_output=True,
-                text=True,
-                timeout=30
-            )
-            
-            if result.returncode != 0:
-                raise HTTPException(
-                    status_code=500,
-                    detail=f"Pandoc conversion failed: {result.stderr}"
+            async with ocr_deadline(http_request, len(page_indices)):
+                await process_pages(
+                    document.source,
+                    document.mime_type,
+                    dpi=dpi,
+                    model=model,
+                    page_indices=page_indices,
+                    on_page=checkpoint
                 )
             
-            return FileResponse(
-                docx_path,
-                media_type='application/vnd.openxmlformats-officedocument.wordprocessingml.document',
-                filename='ocr-result.docx',
-                background=None
+            return await json_response(OCRResponse(
+                success=True,
+                markdown=await assemble_document(db, document_id),
+                tokens_remaining=status["total_available"],
+                document_id=document_id
+            ))
+        
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(
+                status_code=500,
+                detail=f"OCR processing failed: {str(e)}"
             )
-            
-        finally:
-            if os.path.exists(md_path):
-                os.unlink(md_path)
-                
-    except subprocess.TimeoutExpired:
+
+
+class ConvertDocxRequest(BaseModel):
+    markdown: str
+
+
+@router.post("/convert-docx")
+async def convert_to_docx(
+    request: ConvertDocxRequest,
+    if_none_match: Optional[str] = Header(None, alias="If-None-Match")
+):
+    """Convert markdown content to Word (.docx) format using pandoc.
+    
+    This properly handles LaTeX math formulas by converting them to OMML format.
+    Pandoc runs asynchronously over pipes; repeated exports of the same
+    Markdown are served from cache.
+    """
+    try:
+        docx = await convert_markdown(request.markdown, "docx")
+    except ExportError as e:
         raise HTTPException(
             status_code=500,
-            detail="Conversion timed out"
+            detail=str(e)
         )
-    except Exception as e:
+    
+    return await export_response(docx, DOCX_MEDIA_TYPE, "ocr-result.docx", if_none_match)
+
+
+class ExportRequest(BaseModel):
+    markdown: str
+    format: str = "docx"
+
+
+class BatchExportDocument(BaseModel):
+    name: str = "document"
+    markdown: str
+
+
+class BatchExportRequest(BaseModel):
+    documents: List[BatchExportDocument]
+    format: str = "docx"
+
+
+@router.post("/export")
+async def export_markdown(
+    request: ExportRequest,
+    if_none_match: Optional[str] = Header(None, alias="If-None-Match")
+):
+    """Convert markdown content to DOCX, HTML (MathML formulas) or LaTeX.
+    
+    The response has an ETag; sending it back in ``If-None-Match`` with the
+    same Markdown gets a 304 instead of the file.
+    """
+    try:
+        fmt = get_export_format(request.format)
+    except ExportError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    try:
+        data = await convert_markdown(request.markdown, request.format)
+    except ExportError as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    
+    return await export_response(data, fmt.media_type, f"ocr-result.{fmt.extension}", if_none_match)
+
+
+@router.post("/export/batch")
+async def export_markdown_batch(
+    request: BatchExportRequest,
+    if_none_match: Optional[str] = Header(None, alias="If-None-Match")
+):
+    """Convert several markdown documents in one request and return a ZIP archive."""
+    settings = get_settings()
+    try:
+        get_export_format(request.format)
+    except ExportError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not request.documents:
+        raise HTTPException(status_code=400, detail="No documents to export")
+    if len(request.documents) > settings.export_batch_max_documents:
         raise HTTPException(
-            status_code=500,
-            detail=f"Conversion failed: {str(e)}"
+            status_code=400,
+            detail=f"Too many documents. Maximum is {settings.export_batch_max_documents}"
+        )
+    
+    try:
+        archive = await convert_batch(
+            [(doc.name, doc.markdown) for doc in request.documents],
+            request.format
         )
+    except ExportError as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    
+    return await export_response(archive, "application/zip", "ocr-results.zip", if_none_match)
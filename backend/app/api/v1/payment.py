@@ -8,7 +8,6 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 from pydantic import BaseModel
 from typing import Optional
-import httpx
 from datetime import datetime
 
 from app.database import get_db
@@ -86,6 +85,8 @@ async def create_checkout(
     }
     params["hash"] = generate_xunhu_hash(params, settings.xunhu_secret)
 
+    import httpx
+    
     async with httpx.AsyncClient(timeout=15.0) as client:
         resp = await client.post(XUNHU_API_URL, data=params)
         data = resp.json()
@@ -201,7 +202,8 @@ async def get_payment_status(
     if not transaction:
         raise HTTPException(status_code=404, detail="Transaction not found")
 
-    token_status = await get_token_status(db, transaction.device_id)
+    # The payment callback may have credited the tokens in another worker
+    token_status = await get_token_status(db, transaction.device_id, use_cache=transaction.status != "completed")
 
     return {
         "status": transaction.status,
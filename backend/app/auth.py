@@ -1,7 +1,6 @@
 """
 JWT verification for DenseMatrix Auth integration.
 """
-import httpx
 from fastapi import Header, HTTPException, Depends
 from typing import Optional
 from pydantic import BaseModel
@@ -33,6 +32,7 @@ async def get_current_user(
         return None
     
     token = authorization[7:]  # Remove "Bearer " prefix
+    import httpx
     
     try:
         async with httpx.AsyncClient() as client:
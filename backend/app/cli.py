@@ -0,0 +1,275 @@
+"""
+Offline bulk OCR of a directory tree, without the API or the token system.
+
+    python -m app.cli ocr textbooks/ --processes 4 --concurrency 16
+
+Every PDF and image under the directory is OCR'd through the same
+pipeline as the API (``app.services.ocr.process_batch``) and written next
+to its source as Markdown (``book.pdf`` -> ``book.md``). PDFs are split into
+windows of ``--window`` pages, rendered by ``--processes`` worker
+processes while ``--concurrency`` pages are OCR'd at once.
+
+Each finished page is appended to a JSON-lines manifest
+(``.ocr-manifest.jsonl`` in the directory), so an interrupted run resumes
+where it stopped; files whose content is unchanged since they were
+finished are skipped.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import sys
+import time
+from pathlib import Path
+from typing import Dict, Iterator, List, NamedTuple, Optional, TextIO
+
+from app.config import get_settings
+from app.services.archive import EXTENSION_TYPES
+from app.services.executor import shutdown_executors
+from app.services.ocr import (
+    BatchFile, PageResult, assemble_markdown, close_llm_clients, count_pages, process_batch
+)
+
+MANIFEST_NAME = ".ocr-manifest.jsonl"
+
+
+class SourceState:
+    """What the manifest records about one source file."""
+
+    def __init__(self, sha256: str, page_count: int = 0):
+        self.sha256 = sha256
+        self.page_count = page_count
+        self.pages: Dict[int, str] = {}
+        self.done = False
+
+
+class Unit(NamedTuple):
+    """A window of pages of one source, as handed to ``process_batch``."""
+    path: Path
+    page_indices: List[int]
+
+
+def find_sources(root: Path) -> List[Path]:
+    """Supported files under ``root``, skipping hidden files and directories."""
+    return sorted(
+        path for path in root.rglob("*")
+        if path.is_file()
+        and path.suffix.lower() in EXTENSION_TYPES
+        and not any(part.startswith(".") for part in path.relative_to(root).parts)
+    )
+
+
+def output_paths(sources: List[Path]) -> Dict[Path, Path]:
+    """``book.pdf`` -> ``book.md``, or ``book.pdf.md`` when another source would take the same name."""
+    stems: Dict[Path, int] = {}
+    for path in sources:
+        stems[path.with_suffix("")] = stems.get(path.with_suffix(""), 0) + 1
+    return {
+        path: path.with_suffix(".md") if stems[path.with_suffix("")] == 1 else path.with_name(path.name + ".md")
+        for path in sources
+    }
+
+
+def load_manifest(path: Path) -> Dict[str, SourceState]:
+    """Replay a manifest; a torn last line from an interrupted run is ignored."""
+    states: Dict[str, SourceState] = {}
+    if not path.exists():
+        return states
+    with path.open(encoding="utf-8") as manifest:
+        for line in manifest:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            state = states.get(record["file"])
+            if "page_count" in record:
+                # A new run of the file; pages of older content no longer count
+                if state is None or state.sha256 != record["sha256"]:
+                    state = states[record["file"]] = SourceState(record["sha256"], record["page_count"])
+                state.page_count = record["page_count"]
+            elif state is None or state.sha256 != record["sha256"]:
+                continue
+            elif "page" in record:
+                state.pages[record["page"]] = record["markdown"]
+            elif record.get("done"):
+                state.done = True
+    return states
+
+
+class BulkRun:
+    """One ``ocr`` run over a directory tree."""
+
+    def __init__(
+        self,
+        root: Path,
+        manifest: TextIO,
+        states: Dict[str, SourceState],
+        window: int = 8,
+        force: bool = False,
+        log: TextIO = sys.stderr
+    ):
+        self.root = root
+        self.manifest = manifest
+        self.states = states
+        self.window = window
+        self.force = force
+        self.log = log
+        self.outputs: Dict[Path, Path] = {}
+        self.units: List[Unit] = []
+        self.failed = set()
+        self.stats = {"files": 0, "skipped": 0, "written": 0, "failed": 0, "pages": 0, "resumed_pages": 0}
+
+    def record(self, **record) -> None:
+        self.manifest.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.manifest.flush()
+
+    def key(self, path: Path) -> str:
+        return path.relative_to(self.root).as_posix()
+
+    def batch_files(self, sources: List[Path]) -> Iterator[BatchFile]:
+        """Pages still to OCR, read lazily so only the files being rendered are in memory."""
+        self.outputs = output_paths(sources)
+        for path in sources:
+            self.stats["files"] += 1
+            key = self.key(path)
+            data = path.read_bytes()
+            sha256 = hashlib.sha256(data).hexdigest()
+            state = self.states.get(key)
+            if state is not None and state.sha256 == sha256 and state.done and self.outputs[path].exists() and not self.force:
+                self.stats["skipped"] += 1
+                continue
+
+            mime_type = EXTENSION_TYPES[path.suffix.lower()]
+            try:
+                page_count = count_pages(data, mime_type)
+            except Exception as e:
+                self.fail(path, e)
+                continue
+            if state is None or state.sha256 != sha256 or self.force:
+                state = self.states[key] = SourceState(sha256, page_count)
+            self.record(file=key, sha256=sha256, page_count=page_count)
+
+            todo = [i for i in range(page_count) if i not in state.pages]
+            self.stats["resumed_pages"] += page_count - len(todo)
+            if not todo:
+                self.finish(path)
+            for start in range(0, len(todo), self.window):
+                self.units.append(Unit(path, todo[start:start + self.window]))
+                yield BatchFile(data, mime_type, todo[start:start + self.window])
+
+    async def on_page(self, unit_index: int, page: PageResult) -> None:
+        path = self.units[unit_index].path
+        key = self.key(path)
+        state = self.states[key]
+        state.pages[page.page_index] = page.markdown
+        self.stats["pages"] += 1
+        self.record(
+            file=key, sha256=state.sha256, page=page.page_index, markdown=page.markdown, diagnostics=page.diagnostics
+        )
+        if len(state.pages) == state.page_count:
+            self.finish(path)
+
+    def finish(self, path: Path) -> None:
+        state = self.states[self.key(path)]
+        indices = sorted(state.pages)
+        markdown = assemble_markdown([state.pages[i] for i in indices], [i + 1 for i in indices])
+        self.outputs[path].write_text(markdown, encoding="utf-8")
+        state.done = True
+        self.record(file=self.key(path), sha256=state.sha256, done=True, output=self.key(self.outputs[path]))
+        self.stats["written"] += 1
+        print(f"{self.key(path)} -> {self.key(self.outputs[path])} ({state.page_count} pages)", file=self.log)
+
+    def fail(self, path: Path, error: Exception, pages: Optional[List[int]] = None) -> None:
+        self.failed.add(path)
+        where = f" pages {pages[0] + 1}-{pages[-1] + 1}" if pages else ""
+        print(f"{self.key(path)}{where} failed: {error}", file=self.log)
+
+
+async def run_ocr(
+    root: Path,
+    manifest_path: Optional[Path] = None,
+    dpi: Optional[int] = None,
+    model: Optional[str] = None,
+    concurrency: Optional[int] = None,
+    renderers: int = 1,
+    window: int = 8,
+    force: bool = False,
+    log: TextIO = sys.stderr
+) -> dict:
+    """OCR every supported file under ``root``; returns the run's statistics."""
+    settings = get_settings()
+    manifest_path = manifest_path or root / MANIFEST_NAME
+    states = load_manifest(manifest_path)
+    start = time.perf_counter()
+
+    with manifest_path.open("a", encoding="utf-8") as manifest:
+        run = BulkRun(root, manifest, states, window, force, log)
+        outcomes = await process_batch(
+            run.batch_files(find_sources(root)),
+            dpi=dpi or settings.pdf_dpi,
+            model=model,
+            concurrency=concurrency or settings.batch_page_concurrency,
+            on_page=run.on_page,
+            renderers=renderers
+        )
+
+    for unit, outcome in zip(run.units, outcomes):
+        if isinstance(outcome, Exception):
+            run.fail(unit.path, outcome, unit.page_indices)
+    run.stats["failed"] = len(run.failed)
+    run.stats["seconds"] = round(time.perf_counter() - start, 2)
+    run.stats["pages_per_minute"] = round(run.stats["pages"] / max(run.stats["seconds"], 1e-9) * 60, 1)
+    return run.stats
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    settings = get_settings()
+    parser = argparse.ArgumentParser(prog="python -m app.cli", description="Textbook OCR command-line tools")
+    commands = parser.add_subparsers(dest="command", required=True)
+    ocr = commands.add_parser("ocr", help="OCR every PDF and image under a directory into Markdown")
+    ocr.add_argument("directory", type=Path)
+    ocr.add_argument("--processes", type=int, default=settings.executor_processes,
+                     help="Worker processes rendering PDF pages (0: threads)")
+    ocr.add_argument("--concurrency", type=int, default=settings.batch_page_concurrency,
+                     help="Pages OCR'd at once")
+    ocr.add_argument("--window", type=int, default=8, help="Pages of a PDF rendered together")
+    ocr.add_argument("--dpi", type=int, default=settings.pdf_dpi)
+    ocr.add_argument("--model", default=settings.ocr_model)
+    ocr.add_argument("--manifest", type=Path, help=f"Default: DIRECTORY/{MANIFEST_NAME}")
+    ocr.add_argument("--force", action="store_true", help="Redo files that are already done")
+    args = parser.parse_args(argv)
+
+    if not args.directory.is_dir():
+        parser.error(f"Not a directory: {args.directory}")
+    settings.executor_processes = args.processes
+
+    async def run():
+        try:
+            return await run_ocr(
+                args.directory,
+                manifest_path=args.manifest,
+                dpi=args.dpi,
+                model=args.model,
+                concurrency=args.concurrency,
+                renderers=max(1, args.processes),
+                window=args.window,
+                force=args.force
+            )
+        finally:
+            await close_llm_clients()
+
+    try:
+        stats = asyncio.run(run())
+    finally:
+        shutdown_executors()
+
+    print(
+        f"{stats['files']} files: {stats['written']} written, {stats['skipped']} unchanged, {stats['failed']} failed\n"
+        f"{stats['pages']} pages OCR'd ({stats['resumed_pages']} resumed from the manifest) "
+        f"in {stats['seconds']}s, {stats['pages_per_minute']} pages/min"
+    )
+    return 1 if stats["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
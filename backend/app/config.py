@@ -7,13 +7,76 @@ class Settings(BaseSettings):
     llm_proxy_url: str = "https://llm-proxy.densematrix.ai"
     llm_proxy_key: str = "sk-wskhgeyawc"
     
+    llm_transport: str = "openai"  # openai (SDK) or streaming (request body streamed over pooled httpx)
+    llm_timeout_seconds: float = 600
+    llm_max_connections: int = 20  # Pool size of the streaming transport
+    
     # OCR Models (matching Dify workflow)
     ocr_model: str = "gemini-2.5-pro"  # Main OCR model
     format_model: str = "gemini-3-flash-preview"  # LaTeX format cleanup
+    ocr_model_choices: list[str] = ["gemini-2.5-pro", "gemini-2.5-flash"]  # Allowed for re-OCR
+    format_mode: str = "auto"  # auto: local LaTeX repair, format model only if needed; local; llm
+    
+    # PDF rasterization
+    pdf_dpi: int = 600
+    pdf_dpi_min: int = 72
+    pdf_dpi_max: int = 600
+    max_pages_per_request: int = 300  # Larger PDFs must select a `pages` range
+    render_window_pages: int = 4  # Pages rendered together, so only a window of page images is held
+    
+    # Image uploads: EXIF rotation, crop, deskew, contrast and downscaling before OCR
+    preprocess_images: bool = True
+    image_max_pixels: int = 2_500_000
+    image_pixel_budgets: dict[str, int] = {}  # Per OCR model, overrides image_max_pixels
+    image_jpeg_quality: int = 85
+    
+    # Response compression; br and zstd need the brotli and zstandard packages
+    compression_min_bytes: int = 1024
+    compression_encodings: list[str] = ["zstd", "br", "gzip"]  # Server preference on equal q
+    
+    # Export (pandoc)
+    pandoc_path: str = "pandoc"
+    export_concurrency: int = 2
+    export_timeout_seconds: float = 30
+    export_cache_ttl_seconds: int = 24 * 3600  # Converted files, kept in the state backend
+    export_cache_max_entry_bytes: int = 16 * 1024 * 1024  # Larger outputs are not cached
+    pandoc_server_enabled: bool = False  # Keep a warm `pandoc server` instead of one process per export
+    pandoc_server_port: int = 0  # 0 picks a free local port
+    export_batch_max_documents: int = 50
+    
+    # Batch uploads (several files or ZIP archives per request)
+    batch_max_files: int = 50
+    batch_max_pages: int = 300
+    batch_max_bytes: int = 200 * 1024 * 1024  # Uncompressed
+    batch_page_concurrency: int = 4  # Pages OCR'd at once, across all files of a batch
+    
+    # Deadline of a request's OCR work, also capping each LLM call's timeout (see app.services.deadline)
+    request_deadline_base_seconds: float = 60
+    request_deadline_seconds_per_page: float = 120  # Per round of pages OCR'd concurrently
+    request_deadline_max_seconds: float = 3600
+    disconnect_poll_seconds: float = 1  # How often running OCR requests check for a gone client
+    
+    # Admission control of OCR requests, priced in pages (see app.services.admission); 0 disables
+    admission_capacity: int = 64  # Pages in flight per worker
+    admission_max_wait_seconds: float = 10  # Queue for capacity this long at most, else 503
+    admission_default_seconds: float = 60  # Time an admitted request is in flight, until measured
+    admission_max_retry_after_seconds: int = 300
+    admission_image_bytes_per_page: int = 4 * 1024 * 1024  # Images cost a page per started N bytes
+    rate_limit_requests_per_minute: int = 20  # Per device (or user); 0 disables
+    rate_limit_pages_per_hour: int = 1000
     
     # Database
     database_url: str = "sqlite+aiosqlite:///./app.db"
     
+    # Shared state (caches, counters, job queues) across replicas, see app.state
+    state_backend: str = "memory"  # memory (per process), sql (the database above) or redis
+    state_memory_max_entries: int = 100_000
+    state_memory_max_bytes: int = 256 * 1024 * 1024
+    state_key_prefix: str = "textbook-ocr:"  # Redis only
+    redis_url: str = "redis://localhost:6379/0"
+    redis_max_connections: int = 10
+    redis_timeout_seconds: float = 5
+    
     # 虎皮椒 Payment (xunhupay.com)
     xunhu_appid: str = ""
     xunhu_secret: str = ""
@@ -22,6 +85,29 @@ class Settings(BaseSettings):
     tool_name: str = "textbook-ocr"
     free_uses_per_device: int = 3
     base_url: str = "https://textbook-ocr.demo.densematrix.ai"
+    reocr_pages_per_token: int = 5  # Re-running selected pages is billed per N pages
+    token_status_cache_seconds: float = 5  # How stale a balance written by another replica may be (memory state)
+    
+    # Page checkpoints of unfinished documents
+    checkpoint_ttl_seconds: int = 24 * 3600
+    checkpoint_janitor_interval_seconds: int = 3600
+    document_retention_seconds: int = 30 * 24 * 3600  # Completed documents and their sources; 0 keeps them
+    
+    # Tracing (optional, needs opentelemetry-sdk)
+    tracing_enabled: bool = False
+    tracing_exporter: str = "file"  # file (JSON lines) or otlp
+    tracing_file: str = "traces.jsonl"
+    tracing_otlp_endpoint: str = ""  # Defaults to the OTEL_EXPORTER_OTLP_* environment
+    
+    # Executors for blocking and CPU-bound work, see app.services.executor
+    executor_threads: int = 0  # 0: Python's default pool size
+    executor_processes: int = 1  # 0: run process work on the thread pool instead
+    loop_lag_interval_seconds: float = 0.5
+    
+    # Profiling (admin endpoints require internal_test_key)
+    profile_max_seconds: int = 60
+    profile_request_history: int = 20  # Per-request cProfile results kept in memory
+    loop_block_threshold_seconds: float = 0.5  # Watchdog stack capture; 0 disables
     
     # Internal testing (bypass token limits)
     internal_test_key: str = "dm-internal-2026"
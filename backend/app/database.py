@@ -1,22 +1,49 @@
-from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+import asyncio
+from typing import Optional
+
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import DeclarativeBase
 from app.config import get_settings
 
-settings = get_settings()
-
-engine = create_async_engine(settings.database_url, echo=False)
-async_session = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+# Built on first use rather than at import, so importing the app loads no DB driver
+_engine: Optional[AsyncEngine] = None
+_sessionmaker: Optional[async_sessionmaker] = None
 
 
 class Base(DeclarativeBase):
     pass
 
 
+def get_engine() -> AsyncEngine:
+    global _engine
+    if _engine is None:
+        _engine = create_async_engine(get_settings().database_url, echo=False)
+    return _engine
+
+
+def async_session() -> AsyncSession:
+    """A new session on the application engine (use as ``async with async_session() as db``)."""
+    global _sessionmaker
+    if _sessionmaker is None:
+        _sessionmaker = async_sessionmaker(get_engine(), class_=AsyncSession, expire_on_commit=False)
+    return _sessionmaker()
+
+
 async def get_db():
     async with async_session() as session:
         yield session
 
 
-async def init_db():
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+async def init_db(attempts: int = 5):
+    for attempt in range(attempts):
+        try:
+            async with get_engine().begin() as conn:
+                await conn.run_sync(Base.metadata.create_all)
+            return
+        except OperationalError:
+            # Workers starting together race on create_all ("already exists", "database is locked");
+            # on the next attempt the tables another worker created are skipped
+            if attempt == attempts - 1:
+                raise
+            await asyncio.sleep(0.2 * (attempt + 1))
@@ -1,30 +1,59 @@
-import time
+import asyncio
 from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, ORJSONResponse
 
+from app.config import get_settings
 from app.database import init_db
+from app.tracing import setup_tracing, shutdown_tracing
 from app.api.v1.ocr import router as ocr_router
 from app.api.v1.payment import router as payment_router
-from app.metrics import metrics_router, http_requests, http_request_duration, crawler_visits
-
-BOT_PATTERNS = ["Googlebot", "bingbot", "Baiduspider", "YandexBot", "DuckDuckBot", "Slurp", "facebookexternalhit"]
+from app.api.v1.admin import router as admin_router
+from app.metrics import metrics_router, mark_process_dead, cleanup_dead_processes, monitor_loop_lag
+from app.middleware import CompressionMiddleware, MetricsMiddleware, ProfilingMiddleware
+from app.profiling import start_loop_watchdog, stop_loop_watchdog
+from app.services.documents import run_checkpoint_janitor
+from app.services.export import start_export_server, stop_export_server
+from app.services.executor import shutdown_executors
+from app.services.ocr import close_llm_clients
+from app.state import close_state
+from app.warmup import readiness, warm_up
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
+    settings = get_settings()
+    cleanup_dead_processes()
+    setup_tracing(settings)
+    start_loop_watchdog(settings.loop_block_threshold_seconds)
     await init_db()
+    # Clients, executors and a test render, in the background; see /ready
+    warmup = asyncio.create_task(warm_up())
+    janitor = asyncio.create_task(run_checkpoint_janitor())
+    lag_monitor = asyncio.create_task(monitor_loop_lag(settings.loop_lag_interval_seconds))
+    await start_export_server()
     yield
     # Shutdown
+    warmup.cancel()
+    janitor.cancel()
+    lag_monitor.cancel()
+    stop_loop_watchdog()
+    await stop_export_server()
+    shutdown_executors()
+    await close_llm_clients()
+    await close_state()
+    shutdown_tracing()
+    mark_process_dead()
 
 
 app = FastAPI(
     title="Textbook OCR API",
     description="AI-powered OCR for textbooks with LaTeX formula support",
     version="1.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
 # CORS
@@ -36,45 +65,18 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# gzip (brotli, zstd if installed) for JSON, Markdown, HTML and LaTeX
+app.add_middleware(CompressionMiddleware)
 
-@app.middleware("http")
-async def metrics_middleware(request: Request, call_next):
-    start_time = time.time()
-    
-    # Track crawler visits
-    ua = request.headers.get("user-agent", "")
-    for bot in BOT_PATTERNS:
-        if bot.lower() in ua.lower():
-            crawler_visits.labels(tool="textbook-ocr", bot=bot).inc()
-            break
-    
-    response = await call_next(request)
-    
-    # Track request metrics
-    duration = time.time() - start_time
-    endpoint = request.url.path
-    method = request.method
-    status = response.status_code
-    
-    http_requests.labels(
-        tool="textbook-ocr",
-        endpoint=endpoint,
-        method=method,
-        status=status
-    ).inc()
-    
-    http_request_duration.labels(
-        tool="textbook-ocr",
-        endpoint=endpoint,
-        method=method
-    ).observe(duration)
-    
-    return response
+# Request metrics and opt-in per-request profiling
+app.add_middleware(ProfilingMiddleware)
+app.add_middleware(MetricsMiddleware)
 
 
 # Include routers
 app.include_router(ocr_router, prefix="/api/v1")
 app.include_router(payment_router, prefix="/api/v1")
+app.include_router(admin_router, prefix="/api/v1")
 app.include_router(metrics_router)
 
 
@@ -92,6 +94,12 @@ async def health():
     return {"status": "healthy", "service": "textbook-ocr"}
 
 
+@app.get("/ready")
+async def ready():
+    """200 once startup warm-up is done, 503 while it runs or after it failed."""
+    return JSONResponse(status_code=200 if readiness.ready else 503, content=readiness.to_dict())
+
+
 @app.exception_handler(Exception)
 async def global_exception_handler(request: Request, exc: Exception):
     return JSONResponse(
@@ -1,9 +1,20 @@
-from prometheus_client import Counter, Histogram, Gauge, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client import (
+    CollectorRegistry, Counter, Histogram, Gauge, REGISTRY, generate_latest, multiprocess, CONTENT_TYPE_LATEST
+)
 from fastapi import APIRouter, Response
+from contextlib import contextmanager
+from typing import Optional
+import asyncio
 import os
+import time
+from app.tracing import span
 
 TOOL_NAME = os.getenv("TOOL_NAME", "textbook-ocr")
 
+# Set when running several worker processes; each worker writes its samples
+# to files in this directory and /metrics aggregates them
+MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
 # HTTP metrics
 http_requests = Counter(
     "http_requests_total",
@@ -48,6 +59,80 @@ payment_revenue = Counter(
     ["tool"]
 )
 
+# OCR pipeline metrics
+pipeline_stage_duration = Histogram(
+    "ocr_stage_duration_seconds",
+    "Time spent in each OCR pipeline stage",
+    ["tool", "stage", "model"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 60, 120, 300)
+)
+
+pipeline_in_flight = Gauge(
+    "ocr_stage_in_flight",
+    "OCR pipeline stages currently running",
+    ["tool", "stage"],
+    multiprocess_mode="livesum"
+)
+
+ocr_pages = Histogram(
+    "ocr_pages_per_request",
+    "Pages OCR'd per request",
+    ["tool"],
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500)
+)
+
+ocr_image_bytes = Histogram(
+    "ocr_image_bytes",
+    "Size of images sent to the OCR model",
+    ["tool", "mime_type"],
+    buckets=(64e3, 256e3, 512e3, 1e6, 2e6, 4e6, 8e6, 16e6, 32e6)
+)
+
+llm_tokens = Counter(
+    "llm_tokens_total",
+    "LLM tokens reported in response usage",
+    ["tool", "model", "kind"]
+)
+
+admission_outcomes = Counter(
+    "ocr_admission_total",
+    "OCR requests by admission outcome (admitted, queued, shed, rate_limited)",
+    ["tool", "outcome"]
+)
+
+admission_in_flight = Gauge(
+    "ocr_admission_in_flight_pages",
+    "Pages of admitted OCR requests still running",
+    ["tool"],
+    multiprocess_mode="livesum"
+)
+
+admission_wait = Histogram(
+    "ocr_admission_wait_seconds",
+    "Time OCR requests spent queued for capacity",
+    ["tool"],
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+)
+
+ocr_cancelled = Counter(
+    "ocr_requests_cancelled_total",
+    "OCR requests whose remaining pages were cancelled (disconnect, deadline)",
+    ["tool", "reason"]
+)
+
+event_loop_lag = Gauge(
+    "event_loop_lag_seconds",
+    "How late the last event loop timer fired",
+    ["tool"],
+    multiprocess_mode="livemax"
+)
+
+event_loop_blocked = Counter(
+    "event_loop_blocked_total",
+    "Times the event loop was blocked longer than the watchdog threshold",
+    ["tool"]
+)
+
 # SEO metrics
 page_views = Counter(
     "page_views_total",
@@ -64,9 +149,89 @@ crawler_visits = Counter(
 programmatic_pages = Gauge(
     "programmatic_pages_count",
     "Number of programmatic SEO pages",
-    ["tool"]
+    ["tool"],
+    multiprocess_mode="max"
 )
 
+@contextmanager
+def track_stage(stage: str, model: str = "", attributes: Optional[dict] = None):
+    """Time a pipeline stage and count it as in flight while it runs.
+    
+    Also traced as an ``ocr.<stage>`` span when tracing is enabled.
+    """
+    in_flight = pipeline_in_flight.labels(tool=TOOL_NAME, stage=stage)
+    in_flight.inc()
+    start = time.perf_counter()
+    if model:
+        attributes = {"ocr.model": model, **(attributes or {})}
+    try:
+        with span(f"ocr.{stage}", attributes):
+            yield
+    finally:
+        pipeline_stage_duration.labels(tool=TOOL_NAME, stage=stage, model=model).observe(
+            time.perf_counter() - start
+        )
+        in_flight.dec()
+
+
+def observe_stage(stage: str, seconds: float, model: str = "") -> None:
+    """Record a stage timed elsewhere, e.g. in a worker process."""
+    pipeline_stage_duration.labels(tool=TOOL_NAME, stage=stage, model=model).observe(seconds)
+
+
+async def monitor_loop_lag(interval: float = 0.5) -> None:
+    """Keep ``event_loop_lag_seconds`` at how late a periodic timer fires."""
+    loop = asyncio.get_running_loop()
+    gauge = event_loop_lag.labels(tool=TOOL_NAME)
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        gauge.set(max(0.0, loop.time() - start - interval))
+
+
+def record_llm_usage(model: str, usage) -> None:
+    """Count prompt and completion tokens from an OpenAI-style ``usage`` object."""
+    if usage is None:
+        return
+    llm_tokens.labels(tool=TOOL_NAME, model=model, kind="prompt").inc(usage.prompt_tokens or 0)
+    llm_tokens.labels(tool=TOOL_NAME, model=model, kind="completion").inc(usage.completion_tokens or 0)
+
+
+def generate_metrics() -> bytes:
+    """Current metrics in text format, summed over all workers in multiprocess mode."""
+    if not MULTIPROC_DIR:
+        return generate_latest(REGISTRY)
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry, path=MULTIPROC_DIR)
+    return generate_latest(registry)
+
+
+def mark_process_dead(pid: Optional[int] = None) -> None:
+    """Drop the live gauge samples of a worker that has exited (this one by default)."""
+    if MULTIPROC_DIR:
+        multiprocess.mark_process_dead(pid or os.getpid(), MULTIPROC_DIR)
+
+
+def cleanup_dead_processes() -> None:
+    """Drop live gauge samples left behind by workers that died without shutting down."""
+    if not MULTIPROC_DIR:
+        return
+    pids = set()
+    for name in os.listdir(MULTIPROC_DIR):
+        # gauge_livesum_<pid>.db
+        if name.startswith("gauge_live") and name.endswith(".db"):
+            pid = name[:-3].rsplit("_", 1)[-1]
+            if pid.isdigit():
+                pids.add(int(pid))
+    for pid in pids:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            mark_process_dead(pid)
+        except PermissionError:
+            pass
+
+
 # Metrics router
 metrics_router = APIRouter()
 
@@ -75,6 +240,6 @@ metrics_router = APIRouter()
 async def get_metrics():
     """Prometheus metrics endpoint."""
     return Response(
-        content=generate_latest(),
+        content=generate_metrics(),
         media_type=CONTENT_TYPE_LATEST
     )
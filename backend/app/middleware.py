@@ -0,0 +1,342 @@
+"""
+Request metrics, profiling and response compression as pure ASGI middlewares.
+
+Requests are labelled by the matched route template (``/status/{checkout_id}``
+rather than the concrete path), so the number of time series stays bounded;
+paths that match no route share the ``<unmatched>`` label.
+"""
+import re
+import time
+import zlib
+from typing import Any, Callable, Dict, NamedTuple, Optional
+
+from app.config import get_settings
+from app.metrics import TOOL_NAME, http_requests, http_request_duration, crawler_visits
+from app.profiling import request_profiles
+from app.services.executor import run_in_thread
+from app.tracing import span, set_attributes
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+BOT_PATTERNS = ["Googlebot", "bingbot", "Baiduspider", "YandexBot", "DuckDuckBot", "Slurp", "facebookexternalhit"]
+BOT_RE = re.compile("|".join(map(re.escape, BOT_PATTERNS)), re.IGNORECASE)
+BOT_NAMES = {bot.lower(): bot for bot in BOT_PATTERNS}
+
+UNMATCHED_ENDPOINT = "<unmatched>"
+
+
+def route_template(scope) -> str:
+    """The path template of the route that handled ``scope``."""
+    route = scope.get("route")
+    path = getattr(route, "path", None)
+    if path is None:
+        return UNMATCHED_ENDPOINT
+    return scope.get("root_path", "") + path
+
+
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start_time = time.perf_counter()
+        method = scope["method"]
+        status = 500
+
+        # Track crawler visits
+        for name, value in scope["headers"]:
+            if name == b"user-agent":
+                match = BOT_RE.search(value.decode("latin-1"))
+                if match:
+                    crawler_visits.labels(tool=TOOL_NAME, bot=BOT_NAMES[match.group().lower()]).inc()
+                break
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        with span(f"HTTP {method}", {"http.method": method, "http.target": scope["path"]}) as root:
+            try:
+                await self.app(scope, receive, send_wrapper)
+            finally:
+                endpoint = route_template(scope)
+                if root is not None:
+                    root.update_name(f"{method} {endpoint}")
+                set_attributes(root, {"http.status_code": status})
+
+                http_requests.labels(
+                    tool=TOOL_NAME,
+                    endpoint=endpoint,
+                    method=method,
+                    status=status
+                ).inc()
+                http_request_duration.labels(
+                    tool=TOOL_NAME,
+                    endpoint=endpoint,
+                    method=method
+                ).observe(time.perf_counter() - start_time)
+
+
+class ProfilingMiddleware:
+    """Runs requests sent with ``X-Profile: 1`` and the internal key under ``cProfile``.
+    
+    The response carries an ``X-Profile-Id`` header; the report is served by
+    ``GET /api/v1/admin/profile/requests/{profile_id}``.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope["headers"])
+        wanted = headers.get(b"x-profile") == b"1"
+        if not wanted or headers.get(b"x-internal-key", b"").decode("latin-1") != get_settings().internal_test_key:
+            await self.app(scope, receive, send)
+            return
+
+        started = request_profiles.start()
+        if started is None:
+            # Another request is being profiled
+            await self.app(scope, receive, send)
+            return
+        profile_id, profiler = started
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                message = {**message, "headers": [*message.get("headers", []), (b"x-profile-id", profile_id.encode())]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            request_profiles.finish(profile_id, profiler)
+
+
+# ============== Compression ==============
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5  # The default of 11 is meant for static files
+ZSTD_LEVEL = 3
+
+# Bodies at least this large are compressed in a worker thread
+THREAD_MIN_BYTES = 256 * 1024
+
+COMPRESSIBLE_TYPES = re.compile(r"^(text/|application/(json|javascript|xml|x-latex|x-tex)\b|[^;]*\+(json|xml)\b)")
+
+
+class Codec(NamedTuple):
+    compress: Callable[[bytes], bytes]
+    stream: Callable[[], Any]  # A compressor with ``compress(data)`` and ``flush()``
+
+
+class _BrotliStream:
+    def __init__(self):
+        self.compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+
+    def compress(self, data: bytes) -> bytes:
+        return self.compressor.process(data)
+
+    def flush(self) -> bytes:
+        return self.compressor.finish()
+
+
+def _gzip_stream():
+    return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+
+def _gzip(data: bytes) -> bytes:
+    compressor = _gzip_stream()
+    return compressor.compress(data) + compressor.flush()
+
+
+CODECS: Dict[str, Codec] = {"gzip": Codec(_gzip, _gzip_stream)}
+if brotli is not None:
+    CODECS["br"] = Codec(lambda data: brotli.compress(data, quality=BROTLI_QUALITY), _BrotliStream)
+if zstandard is not None:
+    CODECS["zstd"] = Codec(
+        lambda data: zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data),
+        lambda: zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    )
+
+
+def choose_encoding(accept_encoding: str, preferences) -> Optional[str]:
+    """The available coding with the highest ``q`` in ``Accept-Encoding``; ties go to ``preferences`` order."""
+    weights = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.partition(";")
+        weight = 1.0
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        weights[name.strip().lower()] = weight
+
+    best, best_weight = None, 0.0
+    for encoding in preferences:
+        weight = weights.get(encoding, weights.get("*", 0.0))
+        if encoding in CODECS and weight > best_weight:
+            best, best_weight = encoding, weight
+    return best
+
+
+def strip_etag_encoding(etag: str) -> str:
+    """The entity tag of the uncompressed representation, see ``CompressionMiddleware``."""
+    for encoding in CODECS:
+        suffix = f'-{encoding}"'
+        if etag.endswith(suffix):
+            return etag[:-len(suffix)] + '"'
+    return etag
+
+
+class CompressionMiddleware:
+    """Compresses text and JSON responses with zstd, brotli or gzip, as the client accepts.
+    
+    Bodies under ``compression_min_bytes`` are sent as is; streamed bodies
+    are compressed chunk by chunk. Strong ETags get the coding
+    appended (``"abc-gzip"``), since each coding is a different
+    representation; ``strip_etag_encoding`` undoes that for ``If-None-Match``.
+    A ``304`` carries the tag the client validated with, suffix included,
+    so its cache entry keeps matching.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        settings = get_settings()
+        encoding = None
+        if_none_match = b""
+        for name, value in scope["headers"]:
+            if name == b"accept-encoding":
+                encoding = choose_encoding(value.decode("latin-1"), settings.compression_encodings)
+            elif name == b"if-none-match":
+                if_none_match = value
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        codec = CODECS[encoding]
+        start_message = None
+        stream = None  # Compressor of a streamed body, once started
+
+        async def send_wrapper(message):
+            nonlocal start_message, stream
+            if message["type"] == "http.response.start":
+                if message["status"] == 304:
+                    await send({**message, "headers": _not_modified_headers(message.get("headers", []), if_none_match)})
+                    return
+                start_message = message
+                return
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if start_message is not None:
+                start, start_message = start_message, None
+                headers = start.get("headers", [])
+                length = len(body) if not more_body else _content_length(headers)
+                if not _compressible(start["status"], headers) or (length is not None and length < settings.compression_min_bytes):
+                    await send(start)
+                    await send(message)
+                    return
+                if more_body:
+                    stream = codec.stream()
+                else:
+                    if len(body) >= THREAD_MIN_BYTES:
+                        body = await run_in_thread(codec.compress, body)
+                    else:
+                        body = codec.compress(body)
+                await send({**start, "headers": _encoded_headers(headers, encoding, None if more_body else len(body))})
+                if stream is None:
+                    await send({"type": "http.response.body", "body": body})
+                    return
+
+            if stream is None:
+                await send(message)
+                return
+            chunk = stream.compress(body)
+            if not more_body:
+                chunk += stream.flush()
+            if chunk or not more_body:
+                await send({"type": "http.response.body", "body": chunk, "more_body": more_body})
+
+        await self.app(scope, receive, send_wrapper)
+
+
+def _compressible(status: int, headers) -> bool:
+    if status < 200 or status in (204, 304):
+        return False
+    content_type = b""
+    for name, value in headers:
+        name = name.lower()
+        if name == b"content-encoding":
+            return False
+        if name == b"content-type":
+            content_type = value
+    return bool(COMPRESSIBLE_TYPES.match(content_type.decode("latin-1").lower()))
+
+
+def _content_length(headers) -> Optional[int]:
+    for name, value in headers:
+        if name.lower() == b"content-length":
+            return int(value)
+    return None
+
+
+def _not_modified_headers(headers, if_none_match: bytes):
+    """``headers`` of a 304 with the ETag as the client sent it, coding suffix included."""
+    sent = [tag.strip().removeprefix("W/") for tag in if_none_match.decode("latin-1").split(",")]
+    result = []
+    for name, value in headers:
+        if name.lower() == b"etag":
+            etag = value.decode("latin-1")
+            value = next((tag for tag in sent if strip_etag_encoding(tag) == etag), etag).encode("latin-1")
+        result.append((name, value))
+    return result
+
+
+def _encoded_headers(headers, encoding: str, length: Optional[int]):
+    encoded = [(b"content-encoding", encoding.encode())]
+    vary = []
+    for name, value in headers:
+        name = name.lower()
+        if name == b"content-length":
+            continue
+        if name == b"vary":
+            vary.append(value)
+            continue
+        if name == b"etag" and not value.startswith(b"W/") and value.endswith(b'"'):
+            value = value[:-1] + f"-{encoding}\"".encode()
+        encoded.append((name, value))
+    vary.append(b"Accept-Encoding")
+    encoded.append((b"vary", b", ".join(vary)))
+    if length is not None:
+        encoded.append((b"content-length", str(length).encode()))
+    return encoded
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, Boolean
+from sqlalchemy import Column, Integer, BigInteger, Float, String, DateTime, Boolean, Text, LargeBinary, UniqueConstraint, JSON
 from sqlalchemy.sql import func
 from app.database import Base
 
@@ -41,3 +41,47 @@ class UserToken(Base):
     paid_tokens = Column(Integer, default=0)
     created_at = Column(DateTime, server_default=func.now())
     updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
+
+
+class OCRDocument(Base):
+    """An OCR result kept with its source file so single pages can be re-run."""
+    __tablename__ = "ocr_documents"
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    document_id = Column(String(64), unique=True, nullable=False, index=True)
+    device_id = Column(String(255), nullable=True, index=True)
+    user_id = Column(String(255), nullable=True, index=True)
+    filename = Column(String(255), nullable=False)
+    mime_type = Column(String(100), nullable=False)
+    page_count = Column(Integer, nullable=False, default=0)
+    content_hash = Column(String(64), nullable=True, index=True)  # sha256 of source
+    status = Column(String(50), default="completed")  # processing / completed
+    source = Column(LargeBinary, nullable=False)
+    created_at = Column(DateTime, server_default=func.now())
+    updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
+
+
+class OCRPage(Base):
+    """Per-page entry of a document's result manifest."""
+    __tablename__ = "ocr_pages"
+    __table_args__ = (UniqueConstraint("document_id", "page_index"),)
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    document_id = Column(String(64), nullable=False, index=True)
+    page_index = Column(Integer, nullable=False)  # 0-based
+    markdown = Column(Text, nullable=False, default="")
+    model = Column(String(100), nullable=False)
+    dpi = Column(Integer, nullable=True)  # None for image uploads
+    diagnostics = Column(JSON, nullable=True)  # LaTeX check findings for this page
+    created_at = Column(DateTime, server_default=func.now())
+    updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
+
+
+class StateEntry(Base):
+    """A cache entry or counter of the SQL state backend (``app/state.py``)."""
+    __tablename__ = "state_entries"
+    
+    key = Column(String(255), primary_key=True)
+    value = Column(LargeBinary, nullable=True)
+    counter = Column(BigInteger, nullable=True)  # Set instead of value for counters
+    expires_at = Column(Float, nullable=True, index=True)  # Unix time
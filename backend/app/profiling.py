@@ -0,0 +1,235 @@
+"""
+Profiling tools for a running worker.
+
+- ``SamplingProfiler`` samples the stacks of all threads for a while and
+  renders them as speedscope JSON or collapsed stacks (flamegraph.pl).
+- ``RequestProfiles`` keeps the ``cProfile`` results of requests that asked
+  for one (see ``ProfilingMiddleware``).
+- ``LoopWatchdog`` notices when the event loop stops ticking and captures
+  the loop thread's stack while it is still blocked.
+"""
+import asyncio
+import cProfile
+import io
+import logging
+import pstats
+import sys
+import threading
+import time
+import traceback
+import uuid
+from collections import Counter, OrderedDict, deque
+from typing import Dict, List, Optional, Tuple
+
+from app.config import get_settings
+from app.metrics import TOOL_NAME, event_loop_blocked
+
+logger = logging.getLogger(__name__)
+
+Frame = Tuple[str, str, int]  # function, file, first line
+
+
+def _stack(frame) -> List[Frame]:
+    """Frames from the outermost call down to ``frame``."""
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append((code.co_name, code.co_filename, code.co_firstlineno))
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+
+class SamplingProfiler:
+    """Samples every thread's stack each ``interval`` seconds on a background thread."""
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.samples: Dict[str, Counter] = {}  # Thread name -> stack -> count
+        self.duration = 0.0
+
+    def _sample(self, own_id: int) -> None:
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id:
+                continue
+            name = names.get(thread_id, str(thread_id))
+            self.samples.setdefault(name, Counter())[tuple(_stack(frame))] += 1
+
+    def run(self, seconds: float, stop: Optional[threading.Event] = None) -> "SamplingProfiler":
+        """Sample for ``seconds``, blocking the calling thread."""
+        stop = stop or threading.Event()
+        own_id = threading.get_ident()
+        start = time.perf_counter()
+        deadline = start + seconds
+        while not stop.is_set() and time.perf_counter() < deadline:
+            self._sample(own_id)
+            stop.wait(self.interval)
+        self.duration = time.perf_counter() - start
+        return self
+
+    async def profile(self, seconds: float) -> "SamplingProfiler":
+        """Sample from a helper thread so the event loop being profiled keeps running."""
+        stop = threading.Event()
+        try:
+            return await asyncio.to_thread(self.run, seconds, stop)
+        finally:
+            stop.set()
+
+    def collapsed(self) -> str:
+        """One ``thread;outer;...;inner count`` line per distinct stack."""
+        lines = []
+        for thread, stacks in self.samples.items():
+            for stack, count in stacks.most_common():
+                names = [thread] + [f"{name} ({file}:{line})" for name, file, line in stack]
+                lines.append(f"{';'.join(names)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def speedscope(self) -> dict:
+        """A speedscope file with one sampled profile per thread."""
+        frames, index = [], {}
+        profiles = []
+        for thread, stacks in self.samples.items():
+            samples, weights = [], []
+            for stack, count in stacks.most_common():
+                ids = []
+                for frame in stack:
+                    if frame not in index:
+                        index[frame] = len(frames)
+                        frames.append({"name": frame[0], "file": frame[1], "line": frame[2]})
+                    ids.append(index[frame])
+                samples.append(ids)
+                weights.append(count * self.interval)
+            profiles.append({
+                "type": "sampled",
+                "name": thread,
+                "unit": "seconds",
+                "startValue": 0,
+                "endValue": sum(weights),
+                "samples": samples,
+                "weights": weights,
+            })
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": f"textbook-ocr {self.duration:.1f}s",
+            "exporter": "textbook-ocr",
+            "shared": {"frames": frames},
+            "profiles": profiles,
+        }
+
+
+class RequestProfiles:
+    """The most recent per-request ``cProfile`` results, by profile id.
+
+    Only one profile can run at a time; ``start`` returns None while one does.
+    cProfile sees everything on the event loop thread, so concurrent requests
+    show up in each other's profiles.
+    """
+
+    def __init__(self, max_profiles: int = 20):
+        self.max_profiles = max_profiles
+        self._profiles: "OrderedDict[str, pstats.Stats]" = OrderedDict()
+        self._active = None
+
+    def start(self) -> Optional[Tuple[str, cProfile.Profile]]:
+        if self._active is not None:
+            return None
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler (e.g. a debugger) is already installed
+            return None
+        self._active = profiler
+        return uuid.uuid4().hex, profiler
+
+    def finish(self, profile_id: str, profiler: cProfile.Profile) -> None:
+        profiler.disable()
+        self._active = None
+        self._profiles[profile_id] = pstats.Stats(profiler)
+        while len(self._profiles) > self.max_profiles:
+            self._profiles.popitem(last=False)
+
+    def report(self, profile_id: str, sort: str = "cumulative", limit: int = 50) -> Optional[str]:
+        stats = self._profiles.get(profile_id)
+        if stats is None:
+            return None
+        out = io.StringIO()
+        stats.stream = out
+        stats.sort_stats(sort).print_stats(limit)
+        return out.getvalue()
+
+
+class LoopWatchdog:
+    """Logs and records the loop thread's stack whenever the loop is blocked for ``threshold`` seconds."""
+
+    def __init__(self, threshold: float, max_events: int = 20):
+        self.threshold = threshold
+        self.events = deque(maxlen=max_events)
+        self._last_tick = time.monotonic()
+        self._loop_thread_id = None
+        self._task = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    async def _heartbeat(self):
+        interval = self.threshold / 4
+        while True:
+            self._last_tick = time.monotonic()
+            await asyncio.sleep(interval)
+
+    def _watch(self):
+        interval = self.threshold / 4
+        reported = False
+        while not self._stop.wait(interval):
+            blocked = time.monotonic() - self._last_tick
+            if blocked < self.threshold:
+                reported = False
+                continue
+            if reported:
+                continue
+            # Report each blocking episode once, with the stack as it is now
+            reported = True
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame is not None else ""
+            self.events.append({"timestamp": time.time(), "blocked_seconds": round(blocked, 3), "stack": stack})
+            event_loop_blocked.labels(tool=TOOL_NAME).inc()
+            logger.warning("Event loop blocked for %.2fs so far:\n%s", blocked, stack)
+
+    def start(self) -> None:
+        self._loop_thread_id = threading.get_ident()
+        self._last_tick = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.create_task(self._heartbeat())
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+        if self._thread is not None:
+            self._thread.join()
+
+
+request_profiles = RequestProfiles(get_settings().profile_request_history)
+_watchdog: Optional[LoopWatchdog] = None
+
+
+def start_loop_watchdog(threshold: float) -> None:
+    """Watch the running event loop; a threshold of 0 disables the watchdog."""
+    global _watchdog
+    if threshold > 0 and _watchdog is None:
+        _watchdog = LoopWatchdog(threshold)
+        _watchdog.start()
+
+
+def stop_loop_watchdog() -> None:
+    global _watchdog
+    if _watchdog is not None:
+        _watchdog.stop()
+        _watchdog = None
+
+
+def get_loop_watchdog() -> Optional[LoopWatchdog]:
+    return _watchdog
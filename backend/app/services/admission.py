@@ -0,0 +1,201 @@
+"""
+Admission control and per-device rate limits for OCR requests.
+
+Every OCR request is priced in page-equivalents before a token is charged:
+the selected pages of a PDF (counted by ``inspect_file``), or one page per
+started ``admission_image_bytes_per_page`` of an image. A worker admits
+requests while the cost in flight stays within ``admission_capacity``.
+
+Past that, a request waits in a FIFO queue if its estimated wait is at
+most ``admission_max_wait_seconds``. Otherwise it is shed with
+``Overloaded``, and the API answers ``503`` with a ``Retry-After`` header.
+The wait is estimated from the cost ahead of the request and how long
+admitted work has recently stayed in flight.
+
+Rate limits count requests per minute and pages per hour for each device
+(or user), in fixed windows in the shared state, so they hold across
+workers and replicas; ``RateLimited`` becomes ``429``.
+"""
+import asyncio
+import math
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Deque, List, Optional, Tuple
+
+from app.config import get_settings
+from app.metrics import TOOL_NAME, admission_in_flight, admission_outcomes, admission_wait
+from app.state import get_state
+
+
+class AdmissionError(Exception):
+    """A request that is not admitted now; ``retry_after`` is in whole seconds."""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Overloaded(AdmissionError):
+    pass
+
+
+class RateLimited(AdmissionError):
+    pass
+
+
+def estimate_cost(mime_type: str, page_count: int, size: int) -> int:
+    """Page-equivalents of OCR work for a file, known before rendering anything."""
+    if mime_type == "application/pdf":
+        return max(1, page_count)
+    return max(1, math.ceil(size / get_settings().admission_image_bytes_per_page))
+
+
+class AdmissionController:
+    """Bounds the OCR work in flight in this worker, queueing or shedding the rest."""
+
+    def __init__(self, capacity: int, max_wait: float, default_seconds: float, max_retry_after: int = 300):
+        self.capacity = capacity
+        self.max_wait = max_wait
+        self.max_retry_after = max_retry_after
+        self.in_flight = 0
+        self.queued = 0
+        # Moving average of how long an admitted request stays in flight
+        self.seconds_in_flight = default_seconds
+        self._waiters: Deque[Tuple[int, asyncio.Future]] = deque()
+
+    def estimate_wait(self, cost: int) -> float:
+        """Seconds until ``cost`` more would fit, if the work ahead drains at the recent rate."""
+        excess = self.in_flight + self.queued + cost - self.capacity
+        if excess <= 0:
+            return 0.0
+        # Little's law: a full worker finishes about capacity / seconds_in_flight pages per second
+        return excess * self.seconds_in_flight / self.capacity
+
+    def retry_after(self, cost: int) -> int:
+        return min(self.max_retry_after, max(1, math.ceil(self.estimate_wait(cost))))
+
+    def _shed(self, cost: int) -> Overloaded:
+        admission_outcomes.labels(tool=TOOL_NAME, outcome="shed").inc()
+        return Overloaded("Server is busy, please retry later", self.retry_after(cost))
+
+    def _start(self, cost: int) -> None:
+        self.in_flight += cost
+        admission_in_flight.labels(tool=TOOL_NAME).inc(cost)
+
+    def _finish(self, cost: int, seconds: float) -> None:
+        self.in_flight -= cost
+        admission_in_flight.labels(tool=TOOL_NAME).dec(cost)
+        self.seconds_in_flight += 0.2 * (seconds - self.seconds_in_flight)
+        # Wake waiters in order while the oldest fits; later ones must not overtake it
+        while self._waiters:
+            waiter_cost, future = self._waiters[0]
+            if future.done():
+                self._waiters.popleft()
+            elif self.in_flight + waiter_cost <= self.capacity:
+                self._waiters.popleft()
+                self.queued -= waiter_cost
+                self._start(waiter_cost)
+                future.set_result(None)
+            else:
+                break
+
+    async def _wait(self, cost: int) -> None:
+        """Queue for capacity; shed if it does not come within ``max_wait``."""
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append((cost, future))
+        self.queued += cost
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(future, self.max_wait)
+        except asyncio.TimeoutError:
+            self.queued -= cost
+            raise self._shed(cost) from None
+        except asyncio.CancelledError:
+            if future.cancelled():
+                self.queued -= cost
+            else:
+                # Admitted just as the client went away; give the capacity back
+                self._finish(cost, self.seconds_in_flight)
+            raise
+        finally:
+            admission_wait.labels(tool=TOOL_NAME).observe(time.perf_counter() - start)
+        admission_outcomes.labels(tool=TOOL_NAME, outcome="queued").inc()
+
+    @asynccontextmanager
+    async def admit(self, cost: int) -> AsyncIterator[None]:
+        """Hold ``cost`` of capacity for the body; raises ``Overloaded`` if it cannot be had in time."""
+        if self.capacity <= 0:
+            yield
+            return
+        # A request larger than the whole worker still runs, alone
+        cost = min(cost, self.capacity)
+        if not self._waiters and self.in_flight + cost <= self.capacity:
+            self._start(cost)
+            admission_outcomes.labels(tool=TOOL_NAME, outcome="admitted").inc()
+        elif self.estimate_wait(cost) > self.max_wait:
+            raise self._shed(cost)
+        else:
+            await self._wait(cost)
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._finish(cost, time.perf_counter() - start)
+
+
+_controller: Optional[AdmissionController] = None
+
+
+def get_admission_controller() -> AdmissionController:
+    global _controller
+    if _controller is None:
+        settings = get_settings()
+        _controller = AdmissionController(
+            capacity=settings.admission_capacity,
+            max_wait=settings.admission_max_wait_seconds,
+            default_seconds=settings.admission_default_seconds,
+            max_retry_after=settings.admission_max_retry_after_seconds
+        )
+    return _controller
+
+
+def _rate_limits(subject: str, pages: int, now: float) -> List[Tuple[str, int, int, int, str]]:
+    """(name, amount, limit, window seconds, counter key) of each enabled limit."""
+    settings = get_settings()
+    limits = [
+        ("requests", 1, settings.rate_limit_requests_per_minute, 60),
+        ("pages", pages, settings.rate_limit_pages_per_hour, 3600),
+    ]
+    return [
+        (name, amount, limit, window, f"ratelimit:{name}:{subject}:{int(now // window)}")
+        for name, amount, limit, window in limits if limit > 0
+    ]
+
+
+async def check_rate_limits(subject: str, pages: int) -> float:
+    """Count a request of ``pages`` pages against ``subject``'s limits; raises ``RateLimited``.
+
+    Returns the time it was counted at, for ``refund_rate_limits``.
+    """
+    state = get_state()
+    now = time.time()
+    for name, amount, limit, window, key in _rate_limits(subject, pages, now):
+        if await state.incr(key, amount, ttl=window * 2) > limit:
+            if name == "pages":
+                # A rejected request does not use up the page budget
+                await state.incr(key, -amount, ttl=window * 2)
+            admission_outcomes.labels(tool=TOOL_NAME, outcome="rate_limited").inc()
+            raise RateLimited(
+                f"Rate limit exceeded: at most {limit} {name} per {'minute' if window == 60 else 'hour'}",
+                max(1, math.ceil((now // window + 1) * window - now))
+            )
+    return now
+
+
+async def refund_rate_limits(subject: str, pages: int, counted_at: float) -> None:
+    """Take back a request counted by ``check_rate_limits`` that was then shed."""
+    state = get_state()
+    for _, amount, _, window, key in _rate_limits(subject, pages, counted_at):
+        await state.incr(key, -amount, ttl=window * 2)
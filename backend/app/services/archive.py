@@ -0,0 +1,65 @@
+"""
+Reading the files of a batch upload out of ZIP archives.
+"""
+import zipfile
+import zlib
+from pathlib import PurePosixPath
+from typing import BinaryIO, List, NamedTuple
+
+EXTENSION_TYPES = {
+    ".pdf": "application/pdf",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".png": "image/png",
+    ".webp": "image/webp"
+}
+
+ZIP_TYPES = {"application/zip", "application/x-zip-compressed", "application/x-zip"}
+
+
+class UploadError(ValueError):
+    pass
+
+
+class ArchiveEntry(NamedTuple):
+    filename: str
+    data: bytes
+    mime_type: str
+
+
+def extract_archive(fileobj: BinaryIO, max_files: int, max_bytes: int) -> List[ArchiveEntry]:
+    """The supported files in a ZIP archive, ordered by path.
+
+    Entries are decompressed one at a time from the (seekable) upload, and
+    both limits are enforced while reading, so an archive cannot expand
+    past ``max_bytes`` whatever its headers claim. Other files, folders and
+    macOS metadata are skipped.
+    """
+    entries = []
+    total = 0
+    try:
+        with zipfile.ZipFile(fileobj) as archive:
+            for info in sorted(archive.infolist(), key=lambda info: info.filename):
+                path = PurePosixPath(info.filename)
+                mime_type = EXTENSION_TYPES.get(path.suffix.lower())
+                if info.is_dir() or not mime_type or path.name.startswith(".") or "__MACOSX" in path.parts:
+                    continue
+                if len(entries) == max_files:
+                    raise UploadError(f"Too many files, at most {max_files} per batch")
+
+                if info.flag_bits & 0x1:
+                    raise UploadError(f"Encrypted ZIP entries are not supported: {info.filename}")
+                chunks = []
+                with archive.open(info) as entry:
+                    while chunk := entry.read(1024 * 1024):
+                        total += len(chunk)
+                        if total > max_bytes:
+                            raise UploadError(f"Batch too large, at most {max_bytes // 2**20} MB uncompressed")
+                        chunks.append(chunk)
+                entries.append(ArchiveEntry(path.name, b"".join(chunks), mime_type))
+    except (zipfile.BadZipFile, zlib.error, EOFError) as e:
+        raise UploadError(f"Invalid ZIP archive: {e}") from e
+    except NotImplementedError as e:
+        # A compression method zipfile cannot read
+        raise UploadError(f"Unsupported ZIP archive: {e}") from e
+    return entries
@@ -0,0 +1,106 @@
+"""
+Deadlines and cancellation of OCR work.
+
+A request's OCR work runs under ``deadline(seconds)``, a budget from
+``request_budget`` that grows with the page count. The deadline sits in a
+context variable, so every page task started under it inherits it:
+``llm_timeout`` caps each LLM call's timeout at the time left, and the
+body is cancelled when the deadline passes (``DeadlineExceeded``).
+
+``cancel_on_disconnect`` cancels the body as soon as the client has gone
+away (``ClientDisconnected``), so pages nobody will receive are not OCR'd.
+Pages finished before either happens are kept by the callers' checkpoints.
+"""
+import asyncio
+import math
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator, Awaitable, Callable, Optional
+
+from app.config import get_settings
+
+# time.monotonic() by which the current request's OCR work must be done
+_deadline: ContextVar[Optional[float]] = ContextVar("ocr_deadline", default=None)
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+def request_budget(pages: int, concurrency: int = 1) -> float:
+    """Seconds allowed for OCR'ing ``pages`` pages, ``concurrency`` at a time."""
+    settings = get_settings()
+    rounds = math.ceil(max(1, pages) / max(1, concurrency))
+    return min(
+        settings.request_deadline_max_seconds,
+        settings.request_deadline_base_seconds + rounds * settings.request_deadline_seconds_per_page
+    )
+
+
+def remaining() -> Optional[float]:
+    """Seconds left until the current deadline, or None without one."""
+    at = _deadline.get()
+    return None if at is None else at - time.monotonic()
+
+
+def llm_timeout() -> float:
+    """Timeout for the next LLM call: ``llm_timeout_seconds``, or less if the deadline is nearer."""
+    timeout = get_settings().llm_timeout_seconds
+    left = remaining()
+    if left is None:
+        return timeout
+    if left <= 0:
+        raise DeadlineExceeded("Deadline exceeded before the LLM call")
+    return min(timeout, left)
+
+
+@asynccontextmanager
+async def deadline(seconds: float) -> AsyncIterator[None]:
+    """Run the body with a deadline ``seconds`` from now (or an outer, earlier one)."""
+    at = time.monotonic() + seconds
+    outer = _deadline.get()
+    if outer is not None:
+        at = min(at, outer)
+    token = _deadline.set(at)
+    try:
+        async with asyncio.timeout(at - time.monotonic()) as scope:
+            yield
+    except TimeoutError:
+        if scope.expired():
+            raise DeadlineExceeded(f"Deadline of {seconds:.0f}s exceeded") from None
+        raise
+    finally:
+        _deadline.reset(token)
+
+
+@asynccontextmanager
+async def cancel_on_disconnect(
+    is_disconnected: Callable[[], Awaitable[bool]],
+    poll_interval: float = 1
+) -> AsyncIterator[None]:
+    """Cancel the body once ``is_disconnected()`` is true, raising ``ClientDisconnected``."""
+    task = asyncio.current_task()
+    disconnected = False
+
+    async def watch():
+        nonlocal disconnected
+        while not await is_disconnected():
+            await asyncio.sleep(poll_interval)
+        disconnected = True
+        task.cancel()
+
+    watcher = asyncio.create_task(watch())
+    try:
+        yield
+    except asyncio.CancelledError:
+        # Our own cancel, and nobody else's pending: report it as a disconnect
+        if disconnected and task.uncancel() == 0:
+            raise ClientDisconnected("Client disconnected") from None
+        raise
+    finally:
+        watcher.cancel()
@@ -0,0 +1,207 @@
+import asyncio
+import logging
+import uuid
+from datetime import datetime, timedelta
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select, update, delete
+from sqlalchemy.sql import func
+from typing import List, Optional, Sequence
+from app.models import OCRDocument, OCRPage
+from app.auth import UserInfo
+from app.config import get_settings
+from app.database import async_session
+from app.services.ocr import PageResult, assemble_markdown
+from app.state import get_state
+
+logger = logging.getLogger(__name__)
+
+
+async def create_document(
+    db: AsyncSession,
+    *,
+    filename: str,
+    mime_type: str,
+    source: bytes,
+    pages: Sequence[PageResult] = (),
+    model: str = "",
+    dpi: Optional[int] = None,
+    page_count: Optional[int] = None,
+    content_hash: Optional[str] = None,
+    status: str = "completed",
+    device_id: Optional[str] = None,
+    user: Optional[UserInfo] = None
+) -> OCRDocument:
+    """Store a file and its per-page result manifest.
+    
+    Documents created with ``status="processing"`` start without pages and
+    are filled in page by page through ``save_page``.
+    """
+    document = OCRDocument(
+        document_id=uuid.uuid4().hex,
+        device_id=device_id,
+        user_id=user.id if user else None,
+        filename=filename,
+        mime_type=mime_type,
+        page_count=len(pages) if page_count is None else page_count,
+        content_hash=content_hash,
+        status=status,
+        source=source
+    )
+    db.add(document)
+    for page in pages:
+        db.add(OCRPage(
+            document_id=document.document_id,
+            page_index=page.page_index,
+            markdown=page.markdown,
+            diagnostics=page.diagnostics,
+            model=model,
+            dpi=dpi
+        ))
+    await db.commit()
+    await db.refresh(document)
+    return document
+
+
+async def get_document(db: AsyncSession, document_id: str) -> Optional[OCRDocument]:
+    """Look up a stored document by its public id."""
+    result = await db.execute(
+        select(OCRDocument).where(OCRDocument.document_id == document_id)
+    )
+    return result.scalar_one_or_none()
+
+
+async def find_unfinished_document(
+    db: AsyncSession,
+    content_hash: str,
+    device_id: str,
+    user: Optional[UserInfo] = None
+) -> Optional[OCRDocument]:
+    """Find an interrupted run of the same file by the same owner, if any."""
+    query = select(OCRDocument).where(
+        OCRDocument.content_hash == content_hash,
+        OCRDocument.status == "processing"
+    )
+    if user:
+        query = query.where(OCRDocument.user_id == user.id)
+    else:
+        query = query.where(OCRDocument.user_id.is_(None), OCRDocument.device_id == device_id)
+    result = await db.execute(query.order_by(OCRDocument.id.desc()).limit(1))
+    return result.scalar_one_or_none()
+
+
+async def get_document_pages(db: AsyncSession, document_id: str) -> List[OCRPage]:
+    """Return the manifest entries of a document ordered by page index."""
+    result = await db.execute(
+        select(OCRPage)
+        .where(OCRPage.document_id == document_id)
+        .order_by(OCRPage.page_index)
+    )
+    return list(result.scalars().all())
+
+
+async def save_page(
+    db: AsyncSession,
+    document_id: str,
+    result: PageResult,
+    model: str,
+    dpi: Optional[int]
+) -> None:
+    """Checkpoint a single finished page and commit right away.
+    
+    An upsert, so a request saving a page another one saved meanwhile
+    overwrites it instead of failing. Nothing is rolled back, so objects
+    the caller has loaded stay usable.
+    """
+    if db.get_bind().dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    values = {
+        "markdown": result.markdown,
+        "diagnostics": result.diagnostics,
+        "model": model,
+        "dpi": dpi
+    }
+    statement = (
+        insert(OCRPage)
+        .values(document_id=document_id, page_index=result.page_index, **values)
+        .on_conflict_do_update(
+            index_elements=[OCRPage.document_id, OCRPage.page_index],
+            set_={**values, "updated_at": func.now()}
+        )
+        .returning(OCRPage)
+    )
+    # populate_existing refreshes the page if this session has it loaded
+    await db.execute(select(OCRPage).from_statement(statement).execution_options(populate_existing=True))
+    # Keep the janitor away from documents that are still making progress
+    await db.execute(
+        update(OCRDocument)
+        .where(OCRDocument.document_id == document_id)
+        .values(updated_at=func.now())
+    )
+    await db.commit()
+
+
+async def complete_document(db: AsyncSession, document: OCRDocument) -> None:
+    """Mark a document as fully processed."""
+    document.status = "completed"
+    await db.commit()
+
+
+async def delete_stale_documents(db: AsyncSession, max_age_seconds: int, status: str = "processing") -> int:
+    """Delete documents of ``status`` (and their pages) idle for too long.
+    
+    By default these are unfinished documents and their checkpoints; with
+    ``status="completed"`` it enforces the retention of finished results.
+    """
+    cutoff = datetime.utcnow() - timedelta(seconds=max_age_seconds)
+    result = await db.execute(
+        select(OCRDocument.document_id).where(
+            OCRDocument.status == status,
+            OCRDocument.updated_at < cutoff
+        )
+    )
+    document_ids = list(result.scalars().all())
+    if document_ids:
+        await db.execute(delete(OCRPage).where(OCRPage.document_id.in_(document_ids)))
+        await db.execute(delete(OCRDocument).where(OCRDocument.document_id.in_(document_ids)))
+        await db.commit()
+    return len(document_ids)
+
+
+async def run_checkpoint_janitor() -> None:
+    """Periodically clean up stale checkpoints, expired documents and state; runs until cancelled."""
+    settings = get_settings()
+    while True:
+        try:
+            async with async_session() as db:
+                deleted = await delete_stale_documents(db, settings.checkpoint_ttl_seconds)
+                expired = 0
+                if settings.document_retention_seconds:
+                    expired = await delete_stale_documents(db, settings.document_retention_seconds, "completed")
+            if deleted:
+                logger.info("Removed %d stale OCR checkpoint(s)", deleted)
+            if expired:
+                logger.info("Removed %d OCR document(s) past retention", expired)
+            # Expired cache entries and counters of the SQL state backend
+            await get_state().purge_expired()
+        except Exception:
+            logger.exception("Checkpoint janitor run failed")
+        await asyncio.sleep(settings.checkpoint_janitor_interval_seconds)
+
+
+async def assemble_document(db: AsyncSession, document_id: str) -> str:
+    """Rebuild the final Markdown of a document from its manifest."""
+    pages = await get_document_pages(db, document_id)
+    return assemble_markdown([page.markdown for page in pages], [page.page_index + 1 for page in pages])
+
+
+def can_access_document(
+    document: OCRDocument,
+    device_id: str,
+    user: Optional[UserInfo] = None
+) -> bool:
+    """Documents belong to the user that created them, or else to the device."""
+    if document.user_id:
+        return user is not None and user.id == document.user_id
+    return document.device_id == device_id
@@ -0,0 +1,73 @@
+"""
+Run blocking and CPU-bound work off the event loop.
+
+- ``run_in_thread``: work that releases the GIL (PIL/zlib encoding,
+  hashing, base64 of large buffers, JSON of large strings), only blocks
+  on I/O, or is too short to wait for a process (the LaTeX repair pass).
+  Cheap to hand off; shares memory with the caller.
+- ``run_in_process``: long GIL-holding CPU work (PDF rendering).
+  Arguments and results are pickled, so ``fn`` must be a module-level
+  function. With ``executor_processes = 0`` it falls back to the thread
+  pool.
+
+Both pools are created on first use and shut down with the app.
+"""
+import asyncio
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Optional, TypeVar
+
+from app.config import get_settings
+
+T = TypeVar("T")
+
+_thread_pool: Optional[ThreadPoolExecutor] = None
+_process_pool: Optional[ProcessPoolExecutor] = None
+
+
+def get_thread_pool() -> ThreadPoolExecutor:
+    global _thread_pool
+    if _thread_pool is None:
+        _thread_pool = ThreadPoolExecutor(
+            max_workers=get_settings().executor_threads or None,
+            thread_name_prefix="ocr-worker"
+        )
+    return _thread_pool
+
+
+def get_process_pool() -> Optional[ProcessPoolExecutor]:
+    global _process_pool
+    processes = get_settings().executor_processes
+    if _process_pool is None and processes > 0:
+        # Not fork: the parent runs threads (pools, aiosqlite) that a forked child would inherit half-way
+        _process_pool = ProcessPoolExecutor(
+            max_workers=processes,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+    return _process_pool
+
+
+async def run_in_thread(fn: Callable[..., T], *args, **kwargs) -> T:
+    """Run ``fn(*args, **kwargs)`` on the shared thread pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_thread_pool(), functools.partial(fn, *args, **kwargs))
+
+
+async def run_in_process(fn: Callable[..., T], *args, **kwargs) -> T:
+    """Run ``fn(*args, **kwargs)`` in the worker process pool."""
+    pool = get_process_pool()
+    if pool is None:
+        return await run_in_thread(fn, *args, **kwargs)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(pool, functools.partial(fn, *args, **kwargs))
+
+
+def shutdown_executors() -> None:
+    global _thread_pool, _process_pool
+    if _process_pool is not None:
+        _process_pool.shutdown(cancel_futures=True)
+        _process_pool = None
+    if _thread_pool is not None:
+        _thread_pool.shutdown(wait=False, cancel_futures=True)
+        _thread_pool = None
@@ -0,0 +1,289 @@
+import asyncio
+import base64
+import functools
+import hashlib
+import io
+import logging
+import re
+import socket
+import zipfile
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, AsyncIterator, Dict, List, Optional, Sequence, Tuple
+from app.config import get_settings
+from app.services.executor import run_in_thread
+from app.state import get_state
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+if TYPE_CHECKING:
+    import httpx
+
+DOCX_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+
+
+@dataclass(frozen=True)
+class ExportFormat:
+    """How to produce one output format with pandoc."""
+    pandoc_to: str
+    media_type: str
+    extension: str
+    args: Tuple[str, ...] = ()  # Extra command-line arguments
+    server_options: Dict[str, object] = field(default_factory=dict)  # Same, for `pandoc server`
+
+
+EXPORT_FORMATS = {
+    "docx": ExportFormat("docx", DOCX_MEDIA_TYPE, "docx"),
+    "html": ExportFormat(
+        "html", "text/html; charset=utf-8", "html",
+        args=("--standalone", "--mathml"),
+        server_options={"standalone": True, "html-math-method": "mathml"}
+    ),
+    "latex": ExportFormat(
+        "latex", "application/x-latex; charset=utf-8", "tex",
+        args=("--standalone",),
+        server_options={"standalone": True}
+    ),
+}
+
+# Bounds the number of conversions running at once
+_semaphore = asyncio.Semaphore(settings.export_concurrency)
+
+# Conversions running in this process, so concurrent identical requests share one.
+# Finished ones are cached in the state backend, which replicas share.
+_in_flight: Dict[str, "asyncio.Task[bytes]"] = {}
+
+
+class ExportError(Exception):
+    """Raised when pandoc cannot convert the document."""
+
+
+def get_export_format(name: str) -> ExportFormat:
+    """Look up a supported output format by name."""
+    try:
+        return EXPORT_FORMATS[name]
+    except KeyError:
+        raise ExportError(f"Unsupported format: {name}. Supported: {', '.join(EXPORT_FORMATS)}")
+
+
+def cache_key(markdown: str, to: str) -> str:
+    """Cache key for a conversion of ``markdown`` to the format ``to``."""
+    return hashlib.sha256(f"{to}\0{markdown}".encode("utf-8")).hexdigest()
+
+
+async def _cache_get(key: str) -> Optional[bytes]:
+    return await get_state().get(f"export:{key}")
+
+
+async def _cache_put(key: str, data: bytes) -> None:
+    if len(data) <= settings.export_cache_max_entry_bytes:
+        await get_state().set(f"export:{key}", data, ttl=settings.export_cache_ttl_seconds)
+
+
+class PandocServer:
+    """A long-lived local `pandoc server` process that avoids per-export startup cost."""
+
+    def __init__(self, pandoc_path: str, port: int = 0):
+        self.pandoc_path = pandoc_path
+        self.port = port
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.client: Optional["httpx.AsyncClient"] = None
+
+    async def start(self, startup_timeout: float = 10) -> None:
+        import httpx
+        
+        port = self.port or _free_port()
+        try:
+            self.process = await asyncio.create_subprocess_exec(
+                self.pandoc_path, "server", f"--port={port}",
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.DEVNULL
+            )
+        except OSError as e:
+            raise ExportError(f"Pandoc is not available: {e}")
+        self.client = httpx.AsyncClient(
+            base_url=f"http://127.0.0.1:{port}",
+            timeout=settings.export_timeout_seconds
+        )
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + startup_timeout
+        while True:
+            if self.process.returncode is not None:
+                await self.stop()
+                raise ExportError("Pandoc server exited during startup")
+            try:
+                response = await self.client.get("/version")
+                if response.status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            if loop.time() > deadline:
+                await self.stop()
+                raise ExportError("Pandoc server did not start in time")
+            await asyncio.sleep(0.05)
+
+    async def convert(self, markdown: str, fmt: ExportFormat) -> bytes:
+        import httpx
+        
+        payload = {"text": markdown, "from": "markdown", "to": fmt.pandoc_to, **fmt.server_options}
+        try:
+            response = await self.client.post("/", json=payload, headers={"Accept": "application/json"})
+        except httpx.TimeoutException:
+            raise ExportError("Conversion timed out")
+        except httpx.TransportError as e:
+            raise ExportError(f"Pandoc server unavailable: {e}")
+
+        try:
+            data = response.json()
+        except ValueError:
+            data = {"error": response.text}
+        if response.status_code != 200 or "output" not in data:
+            raise ExportError(f"Pandoc conversion failed: {data.get('error', response.text)}")
+        if data.get("base64"):
+            return base64.b64decode(data["output"])
+        return data["output"].encode("utf-8")
+
+    async def stop(self) -> None:
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+        if self.process is not None and self.process.returncode is None:
+            self.process.terminate()
+            try:
+                await asyncio.wait_for(self.process.wait(), timeout=5)
+            except asyncio.TimeoutError:
+                self.process.kill()
+                await self.process.wait()
+        self.process = None
+
+
+_server: Optional[PandocServer] = None
+
+
+def _free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def start_export_server() -> None:
+    """Start the warm pandoc server if enabled; exports fall back to subprocesses otherwise."""
+    global _server
+    if not settings.pandoc_server_enabled or _server is not None:
+        return
+    server = PandocServer(settings.pandoc_path, settings.pandoc_server_port)
+    try:
+        await server.start()
+    except ExportError as e:
+        logger.warning("Pandoc server unavailable, using one process per export: %s", e)
+        return
+    _server = server
+
+
+async def stop_export_server() -> None:
+    """Stop the warm pandoc server, if running."""
+    global _server
+    if _server is not None:
+        server, _server = _server, None
+        await server.stop()
+
+
+async def run_pandoc(markdown: str, fmt: ExportFormat) -> bytes:
+    """Convert Markdown with a pandoc process over stdin/stdout, without temp files."""
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            settings.pandoc_path, "--from=markdown", f"--to={fmt.pandoc_to}", *fmt.args, "--output=-",
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+    except OSError as e:
+        raise ExportError(f"Pandoc is not available: {e}")
+
+    try:
+        stdout, stderr = await asyncio.wait_for(
+            proc.communicate(markdown.encode("utf-8")),
+            timeout=settings.export_timeout_seconds
+        )
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        raise ExportError("Conversion timed out")
+    except asyncio.CancelledError:
+        proc.kill()
+        await proc.wait()
+        raise
+
+    if proc.returncode != 0:
+        raise ExportError(f"Pandoc conversion failed: {stderr.decode('utf-8', errors='replace')}")
+    return stdout
+
+
+async def _convert(markdown: str, fmt: ExportFormat) -> bytes:
+    async with _semaphore:
+        if _server is not None:
+            return await _server.convert(markdown, fmt)
+        return await run_pandoc(markdown, fmt)
+
+
+async def _convert_and_cache(key: str, markdown: str, fmt: ExportFormat) -> bytes:
+    data = await _convert(markdown, fmt)
+    await _cache_put(key, data)
+    return data
+
+
+def _conversion_done(key: str, task: "asyncio.Task[bytes]") -> None:
+    del _in_flight[key]
+    if not task.cancelled():
+        # Retrieved even when every caller has gone away
+        task.exception()
+
+
+async def convert_markdown(markdown: str, to: str = "docx") -> bytes:
+    """Convert Markdown to ``to``, reusing cached or in-flight conversions.
+    
+    A conversion runs as its own task, which every caller awaits shielded:
+    a caller that is cancelled, even the one that started it, neither
+    cancels it nor fails the others waiting for it.
+    """
+    fmt = get_export_format(to)
+    key = cache_key(markdown, to)
+    cached = await _cache_get(key)
+    if cached is not None:
+        return cached
+
+    task = _in_flight.get(key)
+    if task is None:
+        task = asyncio.create_task(_convert_and_cache(key, markdown, fmt))
+        task.add_done_callback(functools.partial(_conversion_done, key))
+        _in_flight[key] = task
+    return await asyncio.shield(task)
+
+
+async def convert_batch(documents: Sequence[Tuple[str, str]], to: str = "docx") -> bytes:
+    """Convert (name, markdown) pairs concurrently and return them as a ZIP archive."""
+    fmt = get_export_format(to)
+    outputs = await asyncio.gather(*(convert_markdown(markdown, to) for _, markdown in documents))
+    return await run_in_thread(_zip_outputs, [name for name, _ in documents], outputs, fmt.extension)
+
+
+def _zip_outputs(names: Sequence[str], outputs: Sequence[bytes], extension: str) -> bytes:
+    buffer = io.BytesIO()
+    used: List[str] = []
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+        for name, data in zip(names, outputs):
+            name = re.sub(r"[^\w.-]+", "_", name).strip("._") or "document"
+            filename = f"{name}.{extension}"
+            if filename in used:
+                filename = f"{name}-{len(used) + 1}.{extension}"
+            used.append(filename)
+            # A fixed timestamp keeps the archive, and so its ETag, the same for the same documents
+            archive.writestr(zipfile.ZipInfo(filename, date_time=(1980, 1, 1, 0, 0, 0)), data, zipfile.ZIP_DEFLATED)
+    return buffer.getvalue()
+
+
+async def iter_chunks(data: bytes, chunk_size: int = 64 * 1024) -> AsyncIterator[bytes]:
+    """Yield ``data`` in chunks for a streaming response."""
+    for start in range(0, len(data), chunk_size):
+        yield data[start:start + chunk_size]
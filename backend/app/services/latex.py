@@ -0,0 +1,353 @@
+"""Local validation and repair of the Markdown + LaTeX produced by OCR.
+
+Fixes the common, mechanical problems (unbalanced braces, unmatched
+``\\left``/``\\right``, unclosed environments, unclosed ``$$`` blocks, ``\\[``
+and ``\\(`` delimiters) deterministically, and reports what it cannot fix so
+that only those pages need the LLM formatting pass.
+"""
+import re
+from dataclasses import dataclass, asdict, field
+from typing import List, Optional, Tuple
+
+# Commands KaTeX can render (https://katex.org/docs/support_table)
+KATEX_COMMANDS = frozenset("""
+above abovewithdelims acute aleph alpha amalg And angle approx approxeq arccos arcctg arcsin arctan arctg arg
+argmax argmin array ast asymp atop backepsilon backprime backsim backsimeq backslash bar barwedge Bbb Bbbk
+bbox bcancel because begin begingroup beta beth between bf bfseries big Big bigcap bigcirc bigcup bigg Bigg
+biggl Biggl biggm Biggm biggr Biggr bigl Bigl bigm Bigm bigodot bigoplus bigotimes bigr Bigr bigsqcup
+bigstar bigtriangledown bigtriangleup biguplus bigvee bigwedge binom blacklozenge blacksquare blacktriangle
+blacktriangledown blacktriangleleft blacktriangleright bm bmod bold boldsymbol bot bowtie Box boxdot boxed
+boxminus boxplus boxtimes bra Bra brace brack braket Braket breve bull bullet bumpeq Bumpeq cal cancel cap Cap
+cdot cdotp cdots
+ce centerdot cfrac check checkmark chi choose circ circeq circlearrowleft circlearrowright circledast
+circledcirc circleddash circledR circledS clubs clubsuit colon color colorbox complement cong coprod copyright
+cos cosec cosh cot cotg coth cr csc ctg cth cup Cup curlyeqprec curlyeqsucc curlyvee curlywedge
+curvearrowleft curvearrowright dag Dagger dagger daleth darr dArr Darr dashleftarrow dashrightarrow dashv dbinom
+dblcolon ddag ddagger ddot ddots def deg degree delta Delta det dfrac diagdown diagup diamond Diamond diamonds
+diamondsuit digamma dim displaystyle div divideontimes dot doteq Doteq doteqdot dotplus dots dotsb dotsc dotsi
+dotsm dotso doublebarwedge doublecap doublecup downarrow Downarrow downdownarrows downharpoonleft
+downharpoonright edef ell emph empty emptyset end endgroup enspace epsilon eqcirc eqcolon Eqcolon eqqcolon
+Eqqcolon
+eqref eqsim eqslantgtr eqslantless equiv eta eth exist exists exp fallingdotseq fbox fcolorbox Finv flat forall
+frac frak frown Game gamma Gamma gcd gdef ge geneuro geq geqq geqslant gets gg ggg gggtr gimel gnapprox gneq
+gneqq gnsim grave gt gtrapprox gtrdot gtreqless gtreqqless gtrless gtrsim gvertneqq H hat hbar hbox
+hdashline hearts heartsuit hline hom hookleftarrow hookrightarrow hphantom href hskip hslash hspace htmlClass
+htmlData htmlId htmlStyle huge Huge iddots iff iiint iint Im image imageof imath impliedby implies in
+includegraphics
+inf infin infty injlim int intercal intop iota isin it itshape jmath Join kappa ker ket Ket kern Khar lambda
+Lambda land
+lang langle Langle large Large LARGE larr lArr Larr lbrace lbrack lceil ldotp ldots le leadsto left leftarrow
+Leftarrow leftarrowtail leftharpoondown leftharpoonup leftleftarrows leftrightarrow Leftrightarrow
+leftrightarrows leftrightharpoons leftrightsquigarrow leftthreetimes leq leqq leqslant lessapprox lessdot
+lesseqgtr lesseqqgtr lessgtr lesssim let lfloor lg lgroup lhd lim liminf limits limsup ll llap llbracket
+llcorner Lleftarrow lll llless lmoustache ln lnapprox lneq lneqq lnot lnsim log long longleftarrow
+Longleftarrow longleftrightarrow Longleftrightarrow longmapsto longrightarrow Longrightarrow looparrowleft
+looparrowright lor lozenge lparen lrarr lrArr Lrarr lrcorner lq Lsh lt ltimes lVert lvert lvertneqq maltese
+mapsto mathbb mathbf mathbin mathcal mathchoice mathclap mathclose mathellipsis mathfrak mathinner mathit
+mathllap mathnormal mathop mathopen mathord mathpunct mathrel mathrlap mathring mathrm mathscr mathsf
+mathsterling mathstrut mathtt matrix max mbox measuredangle medspace mho mid middle min minuso mkern mod models
+mp mskip mu multimap nabla natural ncong ne nearrow neg negmedspace negthickspace negthinspace neq newcommand
+newline nexists ngeq ngeqq ngeqslant ngtr ni nleftarrow nLeftarrow nleftrightarrow nLeftrightarrow nleq nleqq
+nleqslant nless nmid nobreak nobreakspace noexpand nolimits nonumber normalfont normalsize not notag notin notni
+nparallel
+nprec npreceq nRightarrow nrightarrow nshortmid nshortparallel nsim nsubseteq nsubseteqq nsucc nsucceq nsupseteq
+nsupseteqq ntriangleleft ntrianglelefteq ntriangleright ntrianglerighteq nu nVDash nVdash nvDash nvdash nwarrow
+O odot oint oiiint oiint omega Omega omicron ominus operatorname operatornamewithlimits oplus origof oslash
+otimes over overbrace overgroup overleftarrow overleftharpoon overleftrightarrow overline overlinesegment
+overrightarrow overrightharpoon overset owns P parallel partial perp phantom phase phi Phi pi Pi pitchfork plim
+plusmn pm pmb pmod pod Pr prec precapprox preccurlyeq preceq precnapprox precneqq precnsim precsim prime prod
+projlim propto providecommand psi Psi qquad quad R rang rangle Rangle rarr rArr Rarr ratio rbrace rbrack rceil
+Re real Reals reals renewcommand restriction rfloor rgroup rhd rho right rightarrow Rightarrow rightarrowtail
+rightharpoondown rightharpoonup rightleftarrows rightleftharpoons rightrightarrows rightsquigarrow
+rightthreetimes risingdotseq rlap rm rmoustache rparen rq rrbracket Rrightarrow Rsh rtimes rule rVert rvert S
+scriptscriptstyle scriptsize scriptstyle sdot searrow sec sect Set set setminus sf sharp shortmid
+shortparallel sigma Sigma sim simeq sin sinh sixptsize sh small smallint smallfrown smallsetminus smallsmile
+smash smile sout space spades spadesuit sphericalangle sqcap sqcup sqrt sqsubset sqsubseteq sqsupset sqsupseteq
+square ss stackrel star subset Subset subseteq subseteqq subsetneq subsetneqq substack succ succapprox
+succcurlyeq succeq succnapprox succneqq succnsim succsim sum sup supe supset Supset supseteq supseteqq
+supsetneq supsetneqq surd swarrow tag tan tanh tau tbinom TeX text textasciitilde textasciicircum textbackslash
+textbar textbardbl textbf textbraceleft textbraceright textcircled textcolor textdagger textdaggerdbl
+textdegree textdollar textellipsis textemdash textendash textgreater textit textless textmd textnormal
+textquotedblleft textquotedblright textquoteleft textquoteright textregistered textrm textsf textsterling
+textstyle texttt textunderscore textup tfrac tg th therefore Theta theta thetasym thickapprox thicksim thinspace
+tilde times tiny to top triangle triangledown triangleleft trianglelefteq triangleq triangleright
+trianglerighteq tt twoheadleftarrow twoheadrightarrow u uarr uArr Uarr ulcorner underbar underbrace
+undergroup underleftarrow underleftrightarrow underline underlinesegment underrightarrow underset unlhd
+unrhd uparrow Uparrow updownarrow Updownarrow upharpoonleft upharpoonright uplus upsilon Upsilon upuparrows
+urcorner url utilde varDelta varepsilon varGamma varinjlim varkappa varLambda varliminf varlimsup varnothing
+varOmega varphi varPhi varpi varPi varprojlim varpropto varPsi varrho varsigma varSigma varsubsetneq
+varsubsetneqq varsupsetneq varsupsetneqq vartheta varTheta vartriangle vartriangleleft vartriangleright
+varUpsilon varXi vcentcolon vcenter vdash vDash Vdash vdots vec vee veebar verb vert Vert vphantom Vvdash wedge
+weierp widecheck widehat widetilde wp wr xi Xi xleftarrow xLeftarrow xleftharpoondown xleftharpoonup
+xleftrightarrow xLeftrightarrow xleftrightharpoons xlongequal xmapsto xrightarrow xRightarrow
+xrightharpoondown xrightharpoonup xrightleftharpoons xtofrom xtwoheadleftarrow xtwoheadrightarrow yen zeta
+Z
+""".split())
+
+# Environments KaTeX can render
+KATEX_ENVIRONMENTS = frozenset("""
+align align* aligned alignat alignat* alignedat array Bmatrix Bmatrix* bmatrix bmatrix* cases CD darray
+dcases drcases equation equation* gather gather* gathered matrix matrix* multline multline* pmatrix pmatrix*
+rcases smallmatrix split subarray Vmatrix Vmatrix* vmatrix vmatrix*
+""".split())
+
+# Common OCR mistakes with an unambiguous KaTeX equivalent
+COMMAND_ALIASES = {
+    "mathbbm": "mathbb",
+    "bbold": "mathbb",
+    "mathds": "mathbb",
+    "dif": "mathrm{d}",
+    "lbrac": "lbrack",
+    "rbrac": "rbrack",
+}
+
+ENVIRONMENT_ALIASES = {
+    "eqnarray": "aligned",
+    "eqnarray*": "aligned",
+    "displaymath": "aligned",
+}
+
+_TOKEN_RE = re.compile(r"\\([A-Za-z]+)|\\(.)|([{}])", re.S)
+_ENV_NAME_RE = re.compile(r"\s*\{([A-Za-z*]+)\}")
+_FENCE_RE = re.compile(r"^\s*```(?:markdown|md)?[ \t]*\n(.*?)\n```\s*$", re.S)
+# A chatty first line such as "好的，以下是识别结果：" or "Here is the Markdown:"
+_PREAMBLE_RE = re.compile(r"^\s*(?:好的|以下是|这是|下面是|Here is|Here's|Sure)[^\n]{0,60}[:：]\s*\n", re.I)
+
+
+@dataclass
+class Diagnostic:
+    """A problem found in one page's Markdown."""
+    code: str
+    message: str
+    fixed: bool
+    snippet: str = ""
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+@dataclass
+class RepairResult:
+    markdown: str
+    diagnostics: List[Diagnostic] = field(default_factory=list)
+
+    @property
+    def unresolved(self) -> List[Diagnostic]:
+        """Diagnostics the engine could not fix on its own."""
+        return [d for d in self.diagnostics if not d.fixed]
+
+
+def _snippet(text: str, limit: int = 60) -> str:
+    text = " ".join(text.split())
+    return text if len(text) <= limit else text[:limit - 3] + "..."
+
+
+def repair_math(body: str, diagnostics: Optional[List[Diagnostic]] = None) -> str:
+    """Check and repair the LaTeX inside one math span.
+
+    Braces, ``\\left``/``\\right`` and ``\\begin``/``\\end`` share a single
+    stack, so missing closers are inserted in the right nesting order.
+    """
+    if diagnostics is None:
+        diagnostics = []
+    snippet = _snippet(body)
+    out: List[str] = []
+    # (kind, name, index in ``out`` right after the opener)
+    stack: List[Tuple[str, str, int]] = []
+    pos = 0
+
+    def close(kind: str, name: str) -> str:
+        return {"brace": "}", "left": "\\right.", "env": f"\\end{{{name}}}"}[kind]
+
+    def close_until(kind: str, name: str = "") -> bool:
+        """Auto-close openers above the innermost matching one; False if none matches."""
+        for depth in range(len(stack) - 1, -1, -1):
+            if stack[depth][0] == kind and (not name or stack[depth][1] == name):
+                while len(stack) > depth + 1:
+                    inner_kind, inner_name, _ = stack.pop()
+                    out.append(close(inner_kind, inner_name))
+                    diagnostics.append(Diagnostic(
+                        f"unclosed-{inner_kind}", f"Inserted missing {close(inner_kind, inner_name)}", True, snippet
+                    ))
+                stack.pop()
+                return True
+        return False
+
+    for match in _TOKEN_RE.finditer(body):
+        if match.start() < pos:
+            continue  # Inside an environment name already consumed
+        out.append(body[pos:match.start()])
+        pos = match.end()
+        command, symbol, brace = match.groups()
+
+        if brace == "{":
+            out.append("{")
+            stack.append(("brace", "", len(out)))
+        elif brace == "}":
+            if close_until("brace"):
+                out.append("}")
+            else:
+                diagnostics.append(Diagnostic("stray-brace", "Removed unmatched }", True, snippet))
+        elif symbol is not None:
+            out.append(match.group(0))
+        elif command in ("begin", "end"):
+            env = _ENV_NAME_RE.match(body, pos)
+            if not env:
+                out.append(match.group(0))
+                diagnostics.append(Diagnostic("bad-environment", f"\\{command} without environment name", False, snippet))
+                continue
+            pos = env.end()
+            name = env.group(1)
+            if name in ENVIRONMENT_ALIASES:
+                diagnostics.append(Diagnostic(
+                    "unsupported-environment", f"Replaced {name} with {ENVIRONMENT_ALIASES[name]}", True, snippet
+                ))
+                name = ENVIRONMENT_ALIASES[name]
+            elif name not in KATEX_ENVIRONMENTS:
+                diagnostics.append(Diagnostic("unsupported-environment", f"Unknown environment {name}", False, snippet))
+            out.append(f"\\{command}{{{name}}}")
+            if command == "begin":
+                stack.append(("env", name, len(out)))
+            elif not close_until("env", name):
+                diagnostics.append(Diagnostic("unmatched-end", f"\\end{{{name}}} without \\begin", False, snippet))
+        elif command == "left":
+            out.append(match.group(0))
+            stack.append(("left", "", len(out)))
+        elif command == "right":
+            if not close_until("left"):
+                # Open the delimiter at the start of the enclosing group
+                at = stack[-1][2] if stack else 0
+                out.insert(at, "\\left.")
+                diagnostics.append(Diagnostic("unmatched-right", "Inserted missing \\left.", True, snippet))
+            out.append(match.group(0))
+        elif command in KATEX_COMMANDS:
+            out.append(match.group(0))
+        elif command in COMMAND_ALIASES:
+            out.append("\\" + COMMAND_ALIASES[command])
+            diagnostics.append(Diagnostic(
+                "unknown-command", f"Replaced \\{command} with \\{COMMAND_ALIASES[command]}", True, snippet
+            ))
+        else:
+            out.append(match.group(0))
+            diagnostics.append(Diagnostic("unknown-command", f"Unsupported command \\{command}", False, snippet))
+
+    out.append(body[pos:])
+    while stack:
+        kind, name, _ = stack.pop()
+        out.append(close(kind, name))
+        diagnostics.append(Diagnostic(f"unclosed-{kind}", f"Inserted missing {close(kind, name)}", True, snippet))
+    return "".join(out)
+
+
+def _find_closing_inline(text: str, start: int) -> int:
+    """Index of the ``$`` closing inline math opened before ``start``, or -1.
+
+    Follows pandoc's rules: the closer must follow a non-space character and
+    must not be followed by a digit, and inline math does not span paragraphs.
+    """
+    i = start
+    while i < len(text):
+        ch = text[i]
+        if ch == "\\":
+            i += 2
+            continue
+        if ch == "\n" and text.startswith("\n\n", i):
+            return -1
+        if ch == "$":
+            if text[i - 1] not in " \t\n" and not (i + 1 < len(text) and text[i + 1].isdigit()):
+                return i
+            return -1
+        i += 1
+    return -1
+
+
+def repair_markdown(markdown: str) -> RepairResult:
+    """Validate and repair all math in a page of OCR Markdown."""
+    diagnostics: List[Diagnostic] = []
+
+    fenced = _FENCE_RE.match(markdown)
+    if fenced:
+        markdown = fenced.group(1)
+        diagnostics.append(Diagnostic("code-fence", "Removed code fence around the page", True))
+
+    preamble = _PREAMBLE_RE.match(markdown)
+    if preamble:
+        markdown = markdown[preamble.end():]
+        diagnostics.append(Diagnostic("preamble", "Removed model preamble", True, _snippet(preamble.group(0))))
+
+    out: List[str] = []
+    i = 0
+    n = len(markdown)
+    at_line_start = True
+
+    def emit_display(body: str, i: int) -> int:
+        # Display math goes on its own lines
+        while out and out[-1] in (" ", "\t"):
+            out.pop()
+        if out and not out[-1].endswith("\n"):
+            out.append("\n")
+        out.append(f"$$\n{repair_math(body.strip(), diagnostics)}\n$$")
+        while i < n and markdown[i] in " \t":
+            i += 1
+        if i < n and markdown[i] != "\n":
+            out.append("\n")
+        return i
+
+    while i < n:
+        ch = markdown[i]
+
+        # Code is left alone
+        if at_line_start and markdown.startswith("```", i):
+            close = markdown.find("\n```", i + 3)
+            end = n if close == -1 else markdown.find("\n", close + 4)
+            end = n if end == -1 else end
+            out.append(markdown[i:end])
+            i = end
+            continue
+        if ch == "`":
+            end = markdown.find("`", i + 1)
+            if end != -1:
+                out.append(markdown[i:end + 1])
+                i = end + 1
+                continue
+
+        if markdown.startswith("$$", i):
+            end = markdown.find("$$", i + 2)
+            if end == -1:
+                # Close the block at the end of its paragraph
+                end = markdown.find("\n\n", i + 2)
+                end = n if end == -1 else end
+                body, i = markdown[i + 2:end], end
+                diagnostics.append(Diagnostic("unclosed-display", "Inserted missing closing $$", True, _snippet(body)))
+            else:
+                body, i = markdown[i + 2:end], end + 2
+            i = emit_display(body, i)
+        elif markdown.startswith("\\[", i) and markdown.find("\\]", i + 2) != -1:
+            end = markdown.find("\\]", i + 2)
+            body, i = markdown[i + 2:end], end + 2
+            diagnostics.append(Diagnostic("display-delimiter", "Replaced \\[...\\] with $$...$$", True, _snippet(body)))
+            i = emit_display(body, i)
+        elif markdown.startswith("\\(", i) and markdown.find("\\)", i + 2) != -1:
+            end = markdown.find("\\)", i + 2)
+            body = markdown[i + 2:end]
+            diagnostics.append(Diagnostic("inline-delimiter", "Replaced \\(...\\) with $...$", True, _snippet(body)))
+            out.append(f"${repair_math(body.strip(), diagnostics)}$")
+            i = end + 2
+        elif ch == "\\":
+            out.append(markdown[i:i + 2])
+            i += 2
+        elif ch == "$" and i + 1 < n and markdown[i + 1] not in " \t\n":
+            end = _find_closing_inline(markdown, i + 1)
+            if end == -1:
+                # A literal dollar sign
+                out.append(ch)
+                i += 1
+            else:
+                out.append(f"${repair_math(markdown[i + 1:end], diagnostics)}$")
+                i = end + 1
+        else:
+            out.append(ch)
+            i += 1
+        at_line_start = out[-1].endswith("\n") if out else True
+
+    return RepairResult("".join(out), diagnostics)
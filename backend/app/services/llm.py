@@ -0,0 +1,158 @@
+"""
+Streaming transport for OpenAI-compatible chat completions.
+
+The OpenAI SDK needs the whole request as one JSON string, so a page image
+exists three times at once: the base64 string, the ``data:`` URL built
+from it, and the serialized body. ``StreamingChatClient`` instead writes
+the body as it is sent: the JSON around the image is serialized up front,
+and the image is base64-encoded a slice at a time straight from the
+encoded PNG buffer. Requests go through one pooled ``httpx`` client.
+"""
+import asyncio
+import base64
+import json
+import uuid
+from typing import TYPE_CHECKING, Any, AsyncIterator, List, NamedTuple, Optional, Union
+
+if TYPE_CHECKING:
+    import httpx
+
+# Raw bytes per base64 slice; a multiple of 3 so slices concatenate cleanly
+CHUNK_BYTES = 48 * 1024
+
+RETRY_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+
+
+class ImageData(NamedTuple):
+    """An image to send as a ``data:`` URL; stands in for the URL string in messages."""
+    data: Union[bytes, memoryview]
+    mime_type: str
+
+    def encoded_length(self) -> int:
+        return len(f"data:{self.mime_type};base64,") + 4 * ((len(self.data) + 2) // 3)
+
+
+class Usage(NamedTuple):
+    prompt_tokens: int
+    completion_tokens: int
+
+
+class ChatResult(NamedTuple):
+    content: str
+    usage: Optional[Usage]
+
+
+class LLMError(Exception):
+    def __init__(self, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def _split_body(payload: Any) -> List[Union[bytes, ImageData]]:
+    """Serialize ``payload`` to JSON, leaving each ``ImageData`` as a separate part."""
+    images = {}
+
+    def replace(value):
+        if isinstance(value, ImageData):
+            key = f"__image_{uuid.uuid4().hex}__"
+            images[key] = value
+            return key
+        if isinstance(value, dict):
+            return {k: replace(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [replace(v) for v in value]
+        return value
+
+    text = json.dumps(replace(payload), ensure_ascii=False)
+    parts: List[Union[bytes, ImageData]] = []
+    for key, image in images.items():
+        before, text = text.split(f'"{key}"', 1)
+        parts += [(before + '"').encode(), image, b'"']
+    parts.append(text.encode())
+    return parts
+
+
+async def _iter_body(parts: List[Union[bytes, ImageData]]) -> AsyncIterator[bytes]:
+    for part in parts:
+        if not isinstance(part, ImageData):
+            yield part
+            continue
+        yield f"data:{part.mime_type};base64,".encode()
+        data = memoryview(part.data)
+        for start in range(0, len(data), CHUNK_BYTES):
+            yield base64.b64encode(data[start:start + CHUNK_BYTES])
+
+
+def _body_length(parts: List[Union[bytes, ImageData]]) -> int:
+    return sum(part.encoded_length() if isinstance(part, ImageData) else len(part) for part in parts)
+
+
+class StreamingChatClient:
+    """Chat completions with a streamed request body over a pooled connection."""
+
+    def __init__(
+        self,
+        base_url: str,
+        api_key: str,
+        timeout: float = 600,
+        max_connections: int = 20,
+        max_retries: int = 2,
+        http_client: Optional["httpx.AsyncClient"] = None
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key
+        self.max_retries = max_retries
+        import httpx
+        
+        self.http_client = http_client or httpx.AsyncClient(
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        )
+
+    async def create(self, timeout: Optional[float] = None, **payload) -> ChatResult:
+        """POST ``/chat/completions``; ``ImageData`` values in ``messages`` are streamed.
+        
+        ``timeout`` overrides the client's timeout for each attempt.
+        """
+        import httpx
+        
+        parts = _split_body(payload)
+        headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json",
+            # Known up front, so proxies need not buffer a chunked upload
+            "Content-Length": str(_body_length(parts)),
+        }
+        for attempt in range(self.max_retries + 1):
+            last = attempt == self.max_retries
+            try:
+                response = await self.http_client.post(
+                    f"{self.base_url}/chat/completions",
+                    content=_iter_body(parts),
+                    headers=headers,
+                    timeout=httpx.USE_CLIENT_DEFAULT if timeout is None else timeout
+                )
+            except httpx.TransportError as e:
+                if last:
+                    raise LLMError(f"LLM request failed: {e}") from e
+            else:
+                if response.status_code < 400:
+                    return self._parse(response)
+                if last or response.status_code not in RETRY_STATUSES:
+                    raise LLMError(
+                        f"LLM request failed with {response.status_code}: {response.text[:500]}",
+                        response.status_code
+                    )
+            await asyncio.sleep(0.5 * 2 ** attempt)
+
+    @staticmethod
+    def _parse(response: "httpx.Response") -> ChatResult:
+        data = response.json()
+        usage = data.get("usage")
+        return ChatResult(
+            content=data["choices"][0]["message"].get("content") or "",
+            usage=Usage(usage.get("prompt_tokens") or 0, usage.get("completion_tokens") or 0) if usage else None
+        )
+
+    async def aclose(self) -> None:
+        await self.http_client.aclose()
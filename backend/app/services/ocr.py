@@ -1,18 +1,62 @@
+import asyncio
 import base64
 import io
-from typing import List, Tuple
-import fitz  # PyMuPDF
-from PIL import Image
-from openai import AsyncOpenAI
+import logging
+import time
+from collections import defaultdict
+from typing import AsyncIterator, Awaitable, Callable, Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple, Union
 from app.config import get_settings
+from app.services.latex import repair_markdown
+from app.services.executor import run_in_thread, run_in_process
+from app.services.llm import ChatResult, ImageData, StreamingChatClient
+from app.services.deadline import llm_timeout
+from app.metrics import track_stage, observe_stage, record_llm_usage, ocr_pages, ocr_image_bytes, TOOL_NAME
+from app.tracing import span
 
+logger = logging.getLogger(__name__)
 settings = get_settings()
 
-# LLM Client
-llm_client = AsyncOpenAI(
-    base_url=settings.llm_proxy_url,
-    api_key=settings.llm_proxy_key
-)
+# LLM clients, built on first use so that importing this module stays cheap.
+# PyMuPDF, Pillow and NumPy are likewise imported by the functions that need them.
+llm_client = None
+
+# Used instead of the SDK with llm_transport = "streaming"
+streaming_llm_client: Optional[StreamingChatClient] = None
+
+
+def get_llm_client():
+    """The OpenAI SDK client (``openai.AsyncOpenAI``)."""
+    global llm_client
+    if llm_client is None:
+        from openai import AsyncOpenAI
+        llm_client = AsyncOpenAI(
+            base_url=settings.llm_proxy_url,
+            api_key=settings.llm_proxy_key
+        )
+    return llm_client
+
+
+def get_streaming_llm_client() -> StreamingChatClient:
+    global streaming_llm_client
+    if streaming_llm_client is None:
+        streaming_llm_client = StreamingChatClient(
+            base_url=settings.llm_proxy_url,
+            api_key=settings.llm_proxy_key,
+            timeout=settings.llm_timeout_seconds,
+            max_connections=settings.llm_max_connections
+        )
+    return streaming_llm_client
+
+
+async def close_llm_clients() -> None:
+    """Close the connection pools of the clients built so far."""
+    global llm_client, streaming_llm_client
+    if streaming_llm_client is not None:
+        client, streaming_llm_client = streaming_llm_client, None
+        await client.aclose()
+    if llm_client is not None:
+        client, llm_client = llm_client, None
+        await client.close()
 
 OCR_PROMPT = """任务说明
 你将接收到一个教材页面图片。
@@ -43,25 +87,148 @@ FORMAT_PROMPT = """# Role
 直接输出处理后的 Markdown，不要任何前言。"""
 
 
-def pdf_to_images(pdf_bytes: bytes, dpi: int = 600) -> List[Tuple[bytes, str]]:
-    """Convert PDF to list of (image_bytes, mime_type) tuples."""
-    images = []
-    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+PAGE_SEPARATOR = "\n\n---\n\n"
+
+
+class PageResult(NamedTuple):
+    page_index: int  # 0-based
+    markdown: str
+    diagnostics: List[dict]  # Findings of the local LaTeX check, see app.services.latex
+
+
+class RenderedPage(NamedTuple):
+    image_bytes: bytes
+    mime_type: str
+    render_seconds: float
+    encode_seconds: float
+
+
+def render_pdf(
+    pdf_bytes: bytes,
+    dpi: int = 600,
+    page_indices: Optional[Sequence[int]] = None
+) -> List[RenderedPage]:
+    """Render PDF pages to PNG, timing each step.
     
-    for page_num in range(len(doc)):
-        page = doc.load_page(page_num)
-        # High DPI for better OCR
-        mat = fitz.Matrix(dpi / 72, dpi / 72)
-        pix = page.get_pixmap(matrix=mat)
+    Has no side effects on metrics or tracing, so it can run in a worker process.
+    """
+    import fitz  # PyMuPDF
+    
+    pages = []
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+        if page_indices is None:
+            page_indices = range(len(doc))
         
-        # Convert to PNG bytes
-        img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-        img_buffer = io.BytesIO()
-        img.save(img_buffer, format="PNG", optimize=True)
-        images.append((img_buffer.getvalue(), "image/png"))
+        for page_num in page_indices:
+            start = time.perf_counter()
+            page = doc.load_page(page_num)
+            # High DPI for better OCR
+            mat = fitz.Matrix(dpi / 72, dpi / 72)
+            pix = page.get_pixmap(matrix=mat)
+            rendered = time.perf_counter()
+            
+            # Encode straight from the pixmap buffer; going through PIL copied the
+            # raw pixels twice (pix.samples, Image.frombytes) and the PNG once more
+            png = pix.tobytes("png")
+            del pix  # Free the raw pixels before the next page is rendered
+            pages.append(RenderedPage(png, "image/png", rendered - start, time.perf_counter() - rendered))
+    return pages
+
+
+def _observe_rendering(pages: Sequence[RenderedPage]) -> None:
+    for page in pages:
+        observe_stage("render", page.render_seconds)
+        observe_stage("png_encode", page.encode_seconds)
+
+
+def pdf_to_images(
+    pdf_bytes: bytes,
+    dpi: int = 600,
+    page_indices: Optional[Sequence[int]] = None
+) -> List[Tuple[bytes, str]]:
+    """Convert PDF to list of (image_bytes, mime_type) tuples.
     
-    doc.close()
-    return images
+    Only the pages in ``page_indices`` (0-based) are rendered when given.
+    """
+    pages = render_pdf(pdf_bytes, dpi, page_indices)
+    _observe_rendering(pages)
+    return [(page.image_bytes, page.mime_type) for page in pages]
+
+
+def count_pages(file_bytes: bytes, mime_type: str) -> int:
+    """Number of pages in a PDF; images count as a single page."""
+    if mime_type != "application/pdf":
+        return 1
+    import fitz
+    
+    with fitz.open(stream=file_bytes, filetype="pdf") as doc:
+        return len(doc)
+
+
+class PageInfo(NamedTuple):
+    page_index: int  # 0-based
+    width: float  # Points for PDF pages, pixels for images
+    height: float
+    has_text: bool  # The page has a text layer (born-digital or already OCR'd)
+
+
+class FileInfo(NamedTuple):
+    mime_type: str
+    page_count: int
+    encrypted: bool
+    needs_password: bool
+    pages: List[PageInfo]
+
+
+def inspect_file(file_bytes: bytes, mime_type: str) -> FileInfo:
+    """Describe a file without rendering it; raises ValueError for unreadable PDFs."""
+    import fitz
+    from PIL import Image
+    
+    if mime_type != "application/pdf":
+        # Images are passed to the model as is, so an unreadable header is not an error here
+        try:
+            with Image.open(io.BytesIO(file_bytes)) as img:
+                # Only the header is read
+                width, height = img.size
+        except Exception:
+            width, height = 0, 0
+        return FileInfo(mime_type, 1, False, False, [PageInfo(0, width, height, False)])
+    
+    try:
+        doc = fitz.open(stream=file_bytes, filetype="pdf")
+    except Exception as e:
+        raise ValueError(f"Cannot open PDF: {e}") from e
+    with doc:
+        if doc.needs_pass:
+            return FileInfo(mime_type, 0, True, True, [])
+        pages = []
+        for page_index in range(len(doc)):
+            rect = doc.load_page(page_index).rect
+            # Text needs fonts; scanned pages only have images. Cheaper than extracting text.
+            has_text = bool(doc.get_page_fonts(page_index))
+            pages.append(PageInfo(page_index, round(rect.width, 1), round(rect.height, 1), has_text))
+        return FileInfo(mime_type, len(doc), doc.is_encrypted, False, pages)
+
+
+def parse_page_range(spec: str, page_count: int) -> List[int]:
+    """0-based page indices for a 1-based selection like ``"12-15"``, ``"1,3,5-7"`` or ``"10-"``."""
+    indices = set()
+    for part in spec.replace(" ", "").split(","):
+        if not part:
+            continue
+        first, dash, last = part.partition("-")
+        try:
+            start = int(first)
+            end = (int(last) if last else page_count) if dash else start
+        except ValueError:
+            raise ValueError(f"Invalid page range: {part}")
+        if not 1 <= start <= end <= page_count:
+            raise ValueError(f"Page range {part} is outside 1-{page_count}")
+        indices.update(range(start - 1, end))
+    if not indices:
+        raise ValueError("No pages selected")
+    return sorted(indices)
 
 
 def image_to_base64(image_bytes: bytes) -> str:
@@ -69,66 +236,312 @@ def image_to_base64(image_bytes: bytes) -> str:
     return base64.b64encode(image_bytes).decode("utf-8")
 
 
-async def ocr_image(image_bytes: bytes, mime_type: str) -> str:
-    """OCR a single image using Gemini 2.5 Pro."""
-    base64_image = image_to_base64(image_bytes)
-    
-    response = await llm_client.chat.completions.create(
-        model=settings.ocr_model,
-        messages=[
-            {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": OCR_PROMPT},
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:{mime_type};base64,{base64_image}"
-                        }
-                    }
-                ]
-            }
-        ],
-        max_tokens=16000,
-        temperature=0.1
-    )
-    
-    return response.choices[0].message.content or ""
+async def chat_completion(model: str, messages: list, max_tokens: int, temperature: float) -> ChatResult:
+    """Run a chat completion over the configured ``llm_transport``.
+    
+    Only the streaming transport accepts ``ImageData`` in ``messages``.
+    The call times out by the current request's deadline, if it has one.
+    """
+    timeout = llm_timeout()
+    if settings.llm_transport == "streaming":
+        result = await get_streaming_llm_client().create(
+            model=model, messages=messages, max_tokens=max_tokens, temperature=temperature, timeout=timeout
+        )
+    else:
+        response = await get_llm_client().chat.completions.create(
+            model=model,
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            timeout=timeout
+        )
+        result = ChatResult(response.choices[0].message.content or "", response.usage)
+    record_llm_usage(model, result.usage)
+    return result
+
+
+async def ocr_image(image_bytes: bytes, mime_type: str, model: Optional[str] = None) -> str:
+    """OCR a single image using Gemini 2.5 Pro (or the given model)."""
+    model = model or settings.ocr_model
+    ocr_image_bytes.labels(tool=TOOL_NAME, mime_type=mime_type).observe(len(image_bytes))
+    image = ImageData(image_bytes, mime_type)
+    if settings.llm_transport == "streaming":
+        # Encoded slice by slice while the request body is sent
+        image_url = image
+    else:
+        with track_stage("base64_encode"):
+            base64_image = await run_in_thread(image_to_base64, image_bytes)
+        image_url = f"data:{mime_type};base64,{base64_image}"
+    
+    with track_stage("ocr", model, {"ocr.image_bytes": len(image_bytes), "ocr.base64_bytes": 4 * ((len(image_bytes) + 2) // 3)}):
+        result = await chat_completion(
+            model,
+            [
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "text", "text": OCR_PROMPT},
+                        {"type": "image_url", "image_url": {"url": image_url}}
+                    ]
+                }
+            ],
+            max_tokens=16000,
+            temperature=0.1
+        )
+    
+    return result.content
 
 
 async def format_markdown(raw_text: str) -> str:
     """Format and normalize the OCR output using Gemini Flash."""
-    response = await llm_client.chat.completions.create(
-        model=settings.format_model,
-        messages=[
-            {"role": "system", "content": FORMAT_PROMPT},
-            {"role": "user", "content": raw_text}
-        ],
-        max_tokens=16000,
-        temperature=0
-    )
+    with track_stage("format", settings.format_model, {"ocr.input_chars": len(raw_text)}):
+        result = await chat_completion(
+            settings.format_model,
+            [
+                {"role": "system", "content": FORMAT_PROMPT},
+                {"role": "user", "content": raw_text}
+            ],
+            max_tokens=16000,
+            temperature=0
+        )
     
-    return response.choices[0].message.content or raw_text
+    return result.content or raw_text
 
 
-async def process_file(file_bytes: bytes, filename: str, mime_type: str) -> str:
-    """Process a file (PDF or image) and return formatted Markdown."""
+async def clean_markdown(raw_text: str) -> Tuple[str, List[dict]]:
+    """Repair OCR output locally and return it with per-page diagnostics.
+    
+    With ``format_mode="auto"`` the format model only sees pages the local
+    engine could not fully repair; ``"local"`` never calls it and ``"llm"``
+    always does.
+    """
+    if settings.format_mode == "llm":
+        return await format_markdown(raw_text), []
+    
+    with track_stage("latex_repair"):
+        # A short pass; in the process pool it would queue behind page renders
+        result = await run_in_thread(repair_markdown, raw_text)
+    diagnostics = [d.to_dict() for d in result.diagnostics]
+    if result.unresolved and settings.format_mode == "auto":
+        return await format_markdown(result.markdown), diagnostics
+    return result.markdown, diagnostics
+
+
+class PageImage(NamedTuple):
+    page_index: int  # 0-based
+    image_bytes: bytes
+    mime_type: str
+    attributes: dict  # Span attributes of the page
+
+
+async def prepare_image(file_bytes: bytes, mime_type: str, model: Optional[str] = None) -> PageImage:
+    """An uploaded image as a page, straightened and sized for the OCR model."""
+    attributes = {"ocr.page_index": 0, "ocr.original_bytes": len(file_bytes)}
+    if settings.preprocess_images:
+        from app.services.preprocess import preprocess_image
+
+        max_pixels = settings.image_pixel_budgets.get(model or settings.ocr_model, settings.image_max_pixels)
+        try:
+            with track_stage("preprocess"):
+                result = await run_in_thread(
+                    preprocess_image, file_bytes, mime_type, max_pixels, settings.image_jpeg_quality
+                )
+        except Exception:
+            # Formats Pillow cannot read still go to the model as is
+            logger.warning("Image preprocessing failed, sending the original", exc_info=True)
+        else:
+            file_bytes, mime_type = result.image_bytes, result.mime_type
+            attributes.update({
+                "ocr.original_size": f"{result.original_size[0]}x{result.original_size[1]}",
+                "ocr.size": f"{result.size[0]}x{result.size[1]}",
+                "ocr.skew_degrees": result.skew_degrees,
+                "ocr.cropped": result.cropped
+            })
+    attributes["ocr.image_bytes"] = len(file_bytes)
+    return PageImage(0, file_bytes, mime_type, attributes)
+
+
+async def render_file(
+    file_bytes: bytes,
+    mime_type: str,
+    dpi: int = 600,
+    page_indices: Optional[Sequence[int]] = None,
+    model: Optional[str] = None
+) -> List[PageImage]:
+    """The page images of a PDF (rendered) or of an image file (preprocessed)."""
+    if mime_type != "application/pdf":
+        if page_indices is not None and 0 not in page_indices:
+            return []
+        return [await prepare_image(file_bytes, mime_type, model)]
+    
+    if page_indices is None:
+        page_indices = range(count_pages(file_bytes, mime_type))
+    page_indices = list(page_indices)
+    # Rendering holds the GIL, so it runs in a worker process
+    images = await run_in_process(render_pdf, file_bytes, dpi, page_indices)
+    _observe_rendering(images)
+    return [
+        PageImage(page_index, image.image_bytes, image.mime_type, {
+            "ocr.page_index": page_index,
+            "ocr.dpi": dpi,
+            "ocr.image_bytes": len(image.image_bytes),
+            "ocr.render_seconds": image.render_seconds,
+            "ocr.encode_seconds": image.encode_seconds
+        })
+        for page_index, image in zip(page_indices, images)
+    ]
+
+
+async def render_windows(
+    file_bytes: bytes,
+    mime_type: str,
+    dpi: int = 600,
+    page_indices: Optional[Sequence[int]] = None,
+    model: Optional[str] = None,
+    window: Optional[int] = None
+) -> AsyncIterator[List[PageImage]]:
+    """``render_file`` a PDF ``window`` pages at a time (``render_window_pages`` by default).
+    
+    The next window is rendered only once the caller asks for it, so a long
+    PDF never has all its page images in memory at once.
+    """
+    if mime_type != "application/pdf":
+        yield await render_file(file_bytes, mime_type, dpi, page_indices, model)
+        return
+    
+    window = max(1, window or settings.render_window_pages)
+    if page_indices is None:
+        page_indices = range(count_pages(file_bytes, mime_type))
+    page_indices = list(page_indices)
+    for start in range(0, len(page_indices), window):
+        yield await render_file(file_bytes, mime_type, dpi, page_indices[start:start + window], model)
+
+
+async def ocr_page(page: PageImage, model: Optional[str] = None) -> PageResult:
+    """OCR one page image and clean up the result."""
+    with span("ocr.page", page.attributes):
+        raw_ocr = await ocr_image(page.image_bytes, page.mime_type, model)
+        formatted, diagnostics = await clean_markdown(raw_ocr)
+    return PageResult(page.page_index, formatted, diagnostics)
+
+
+async def process_pages(
+    file_bytes: bytes,
+    mime_type: str,
+    dpi: int = 600,
+    model: Optional[str] = None,
+    page_indices: Optional[Sequence[int]] = None,
+    on_page: Optional[Callable[[PageResult], Awaitable[None]]] = None
+) -> List[PageResult]:
+    """OCR a file page by page and return the result of each page.
+    
+    ``page_indices`` restricts a PDF to the given 0-based pages; images
+    always yield a single page with index 0. ``on_page`` is awaited as soon
+    as each page is done, so callers can checkpoint partial progress.
+    """
     results = []
+    async for images in render_windows(file_bytes, mime_type, dpi, page_indices, model):
+        for image in images:
+            results.append(await ocr_page(image, model))
+            if on_page:
+                await on_page(results[-1])
+    ocr_pages.labels(tool=TOOL_NAME).observe(len(results))
     
-    if mime_type == "application/pdf":
-        # PDF: convert to images first
-        images = pdf_to_images(file_bytes)
-        for i, (img_bytes, img_mime) in enumerate(images):
-            raw_ocr = await ocr_image(img_bytes, img_mime)
-            formatted = await format_markdown(raw_ocr)
-            if len(images) > 1:
-                results.append(f"## Page {i + 1}\n\n{formatted}")
-            else:
-                results.append(formatted)
-    else:
-        # Image: direct OCR
-        raw_ocr = await ocr_image(file_bytes, mime_type)
-        formatted = await format_markdown(raw_ocr)
-        results.append(formatted)
+    return results
+
+
+class BatchFile(NamedTuple):
+    file_bytes: bytes
+    mime_type: str
+    page_indices: Optional[Sequence[int]] = None  # All pages when None
+
+
+async def process_batch(
+    files: Iterable[BatchFile],
+    dpi: int = 600,
+    model: Optional[str] = None,
+    concurrency: int = 4,
+    on_page: Optional[Callable[[int, PageResult], Awaitable[None]]] = None,
+    renderers: int = 1
+) -> List[Union[List[PageResult], Exception]]:
+    """OCR the pages of several files through one shared queue.
+    
+    Up to ``renderers`` files are rendered at once (one per worker process
+    is the useful maximum), each a window of pages at a time, while up to
+    ``concurrency`` pages, from any file, are OCR'd at once. The queue is
+    bounded, so rendering waits for the OCR to catch up and only a few
+    windows of page images are held. ``files`` is consumed lazily, so it can
+    be a generator reading files as they are needed. ``on_page`` gets the
+    file's position and the page result. Returns each file's pages in page
+    order, or the exception that failed the file; other files carry on.
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=concurrency * 2)
+    results: Dict[int, List[PageResult]] = defaultdict(list)
+    errors: Dict[int, Exception] = {}
+    pending = enumerate(files)
+    file_count = 0
     
-    return "\n\n---\n\n".join(results)
+    async def produce():
+        nonlocal file_count
+        for file_index, file in pending:
+            file_count = file_index + 1
+            rendered = 0
+            try:
+                async for images in render_windows(file.file_bytes, file.mime_type, dpi, file.page_indices, model):
+                    rendered += len(images)
+                    for image in images:
+                        await queue.put((file_index, image))
+            except Exception as e:
+                # Pages of the file already queued are skipped by the workers
+                errors[file_index] = e
+                continue
+            ocr_pages.labels(tool=TOOL_NAME).observe(rendered)
+    
+    async def work():
+        while (job := await queue.get()) is not None:
+            file_index, image = job
+            if file_index in errors:
+                continue
+            try:
+                result = await ocr_page(image, model)
+                if on_page:
+                    await on_page(file_index, result)
+            except Exception as e:
+                errors.setdefault(file_index, e)
+                continue
+            results[file_index].append(result)
+    
+    producers = [asyncio.create_task(produce()) for _ in range(renderers)]
+    workers = [asyncio.create_task(work()) for _ in range(concurrency)]
+    try:
+        await asyncio.gather(*producers)
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+    finally:
+        # If ``files`` raised or we were cancelled, no task may outlive the call
+        for task in producers + workers:
+            task.cancel()
+        await asyncio.gather(*producers, *workers, return_exceptions=True)
+    return [
+        errors.get(i) or sorted(results[i], key=lambda page: page.page_index)
+        for i in range(file_count)
+    ]
+
+
+def assemble_markdown(pages: Sequence[str], page_numbers: Optional[Sequence[int]] = None) -> str:
+    """Join per-page Markdown into the final document.
+    
+    ``page_numbers`` (1-based) label the pages when only some of a PDF's
+    pages were OCR'd; by default they are numbered from 1.
+    """
+    if len(pages) > 1:
+        page_numbers = page_numbers or range(1, len(pages) + 1)
+        pages = [f"## Page {number}\n\n{page}" for number, page in zip(page_numbers, pages)]
+    return PAGE_SEPARATOR.join(pages)
+
+
+async def process_file(file_bytes: bytes, filename: str, mime_type: str) -> str:
+    """Process a file (PDF or image) and return formatted Markdown."""
+    pages = await process_pages(file_bytes, mime_type, dpi=settings.pdf_dpi)
+    return assemble_markdown([page.markdown for page in pages])
@@ -0,0 +1,162 @@
+"""
+Preprocessing of uploaded photos before OCR.
+
+Phone photos of a page are usually far larger than the model needs, may
+be stored sideways with an EXIF orientation tag, sit on a dark desk and
+are slightly rotated. ``preprocess_image`` fixes all of that locally:
+
+1. apply the EXIF orientation;
+2. crop to the page, i.e. the bright region, dropping dark margins;
+3. estimate the skew from the text lines and rotate it away;
+4. stretch the contrast of dim or washed-out photos;
+5. downscale to the model's pixel budget.
+
+Analysis runs on a small grayscale copy with NumPy; the full-size image
+is only touched by Pillow's crop, rotate and resize.
+
+The upload is sent unchanged when none of steps 1-3 and 5 applied, or
+when the re-encoded image is not smaller (unless it had to be turned
+upright): contrast alone does not pay for a bigger payload.
+"""
+import io
+import math
+from typing import NamedTuple, Optional, Tuple
+
+import numpy as np
+from PIL import Image, ImageOps
+
+ANALYSIS_SIZE = 1000  # Longest side of the copy used to find the page and the skew
+MAX_SKEW_DEGREES = 5
+SKEW_STEP_DEGREES = 0.1
+MIN_SKEW_DEGREES = 0.2  # Smaller corrections are not worth resampling the image
+MIN_CONTRAST_RANGE = 200  # Gray levels between ink and paper below which contrast is stretched
+ORIENTATION_TAG = 0x0112  # EXIF
+
+
+class PreprocessResult(NamedTuple):
+    image_bytes: bytes
+    mime_type: str
+    original_size: Tuple[int, int]
+    size: Tuple[int, int]
+    skew_degrees: float
+    cropped: bool
+
+
+def otsu_threshold(gray: np.ndarray) -> int:
+    """The gray level that best separates dark and bright pixels."""
+    hist = np.bincount(gray.ravel(), minlength=256).astype(np.float64)
+    levels = np.arange(256)
+    weight_dark = np.cumsum(hist)
+    weight_bright = weight_dark[-1] - weight_dark
+    sum_dark = np.cumsum(hist * levels)
+    mean_dark = sum_dark / np.maximum(weight_dark, 1)
+    mean_bright = (sum_dark[-1] - sum_dark) / np.maximum(weight_bright, 1)
+    between = weight_dark * weight_bright * (mean_dark - mean_bright) ** 2
+    return int(np.argmax(between))
+
+
+def find_page(gray: np.ndarray, threshold: int) -> Optional[Tuple[int, int, int, int]]:
+    """Bounding box (left, top, right, bottom) of the bright page, or None if there are no margins to drop."""
+    bright = gray > threshold
+    rows = np.flatnonzero(bright.mean(axis=1) > 0.5)
+    cols = np.flatnonzero(bright.mean(axis=0) > 0.5)
+    if not len(rows) or not len(cols):
+        return None
+    box = (int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1)
+    height, width = gray.shape
+    area = (box[2] - box[0]) * (box[3] - box[1])
+    # Nothing to crop, or too little left to trust
+    if area > 0.97 * width * height or area < 0.25 * width * height:
+        return None
+    return box
+
+
+def estimate_skew(gray: np.ndarray, threshold: int, max_points: int = 20000) -> float:
+    """Angle in degrees of the text lines; rotating by it makes them horizontal.
+
+    Projects the dark pixels onto the vertical axis at each candidate angle;
+    at the right angle the lines collapse into sharp peaks, which maximizes
+    the sum of squared bin counts.
+    """
+    ys, xs = np.nonzero(gray < threshold)
+    if len(ys) < 100:
+        return 0.0
+    if len(ys) > max_points:
+        pick = np.random.default_rng(0).choice(len(ys), max_points, replace=False)
+        ys, xs = ys[pick], xs[pick]
+
+    angles = np.deg2rad(np.arange(-MAX_SKEW_DEGREES, MAX_SKEW_DEGREES + 1e-9, SKEW_STEP_DEGREES))
+    # One row of projected positions per candidate angle
+    projected = np.rint(ys[None, :] * np.cos(angles)[:, None] - xs[None, :] * np.sin(angles)[:, None]).astype(np.int64)
+    projected -= projected.min(axis=1, keepdims=True)
+    scores = [np.square(np.bincount(row)).sum() for row in projected]
+    return float(np.rad2deg(angles[int(np.argmax(scores))]))
+
+
+def estimate_jpeg_quality(img: Image.Image) -> Optional[int]:
+    """Approximate libjpeg quality setting of a JPEG, from its luminance table."""
+    tables = getattr(img, "quantization", None)
+    if not tables or 0 not in tables:
+        return None
+    # The standard luminance table averages 57.625 at quality 50
+    scale = sum(tables[0]) / len(tables[0]) / 57.625 * 100
+    quality = 5000 / scale if scale > 100 else (200 - scale) / 2
+    return max(1, min(100, round(quality)))
+
+
+def preprocess_image(
+    image_bytes: bytes,
+    mime_type: str,
+    max_pixels: int,
+    jpeg_quality: int = 85
+) -> PreprocessResult:
+    """Normalize a photo of a page for OCR; see the module docstring for the steps.
+    
+    JPEGs are re-encoded at no more than their original quality, which would
+    only add bytes. The result is never larger than the upload unless the
+    EXIF orientation had to be applied.
+    """
+    with Image.open(io.BytesIO(image_bytes)) as original:
+        original_size = original.size
+        jpeg_quality = min(jpeg_quality, estimate_jpeg_quality(original) or jpeg_quality)
+        upright = original.getexif().get(ORIENTATION_TAG, 1) in (0, 1)
+        img = ImageOps.exif_transpose(original).convert("RGB")
+
+    scale = min(1.0, ANALYSIS_SIZE / max(img.size))
+    small = img.convert("L").resize((max(1, round(img.width * scale)), max(1, round(img.height * scale))))
+    gray = np.asarray(small)
+    threshold = otsu_threshold(gray)
+
+    box = find_page(gray, threshold)
+    if box:
+        img = img.crop(tuple(round(v / scale) for v in box))
+        gray = gray[box[1]:box[3], box[0]:box[2]]
+
+    skew = estimate_skew(gray, threshold)
+    if abs(skew) >= MIN_SKEW_DEGREES:
+        img = img.rotate(skew, resample=Image.Resampling.BICUBIC, expand=False, fillcolor=(255, 255, 255))
+    else:
+        skew = 0.0
+
+    # Text covers a few percent of a page at most, so the ink level is a low percentile
+    low, high = np.percentile(gray, [0.1, 99])
+    if high - low < MIN_CONTRAST_RANGE:
+        img = ImageOps.autocontrast(img, cutoff=1, preserve_tone=True)
+
+    downscaled = img.width * img.height > max_pixels
+    if downscaled:
+        factor = math.sqrt(max_pixels / (img.width * img.height))
+        img = img.resize((int(img.width * factor), int(img.height * factor)), Image.Resampling.LANCZOS)
+
+    unchanged = PreprocessResult(image_bytes, mime_type, original_size, original_size, 0.0, False)
+    if upright and box is None and not skew and not downscaled:
+        return unchanged
+    buffer = io.BytesIO()
+    if mime_type == "image/png":
+        img.save(buffer, format="PNG")
+    else:
+        img.save(buffer, format="JPEG", quality=jpeg_quality)
+        mime_type = "image/jpeg"
+    if upright and buffer.tell() >= len(image_bytes):
+        return unchanged
+    return PreprocessResult(buffer.getvalue(), mime_type, original_size, img.size, round(skew, 2), box is not None)
@@ -1,13 +1,53 @@
+import math
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
-from typing import Optional
+from typing import Optional, Tuple
 from app.models import DeviceToken, UserToken
 from app.config import get_settings
 from app.auth import UserInfo
+from app.state import get_state
 
 settings = get_settings()
 
 
+def _balance_key(kind: str, owner_id: str) -> str:
+    return f"balance:{kind}:{owner_id}"
+
+
+async def _cached_balance(key: str) -> Optional[Tuple[int, int]]:
+    """(free uses, paid tokens) from the shared state, if cached."""
+    value = await get_state().get(key)
+    if value is None:
+        return None
+    free_uses, paid_tokens = value.split(b",")
+    return int(free_uses), int(paid_tokens)
+
+
+async def _cache_balance(key: str, free_uses: int, paid_tokens: int) -> None:
+    """Cache a balance; writes store their result, so with a shared state every replica sees it at once."""
+    if settings.token_status_cache_seconds > 0:
+        await get_state().set(key, f"{free_uses},{paid_tokens}".encode(), ttl=settings.token_status_cache_seconds)
+
+
+def reocr_token_cost(page_count: int) -> int:
+    """Tokens charged for re-running ``page_count`` pages of a stored document."""
+    return max(1, math.ceil(page_count / settings.reocr_pages_per_token))
+
+
+def _consume_tokens(record, amount: int) -> tuple[bool, str]:
+    """Take ``amount`` tokens from a balance record, free uses first."""
+    if record.free_uses_remaining + record.paid_tokens < amount:
+        return False, "No tokens available. Please purchase more."
+    
+    from_free = min(record.free_uses_remaining, amount)
+    record.free_uses_remaining -= from_free
+    record.paid_tokens -= amount - from_free
+    
+    if from_free == amount:
+        return True, f"Free use consumed. {record.free_uses_remaining} remaining."
+    return True, f"Paid token consumed. {record.paid_tokens} remaining."
+
+
 # ============== Device Mode (Guest) ==============
 
 async def get_or_create_device(db: AsyncSession, device_id: str) -> DeviceToken:
@@ -30,33 +70,43 @@ async def get_or_create_device(db: AsyncSession, device_id: str) -> DeviceToken:
     return device
 
 
-async def check_and_use_device_token(db: AsyncSession, device_id: str) -> tuple[bool, str]:
-    """Check if device has available tokens and use one."""
+async def check_and_use_device_token(
+    db: AsyncSession,
+    device_id: str,
+    amount: int = 1
+) -> tuple[bool, str]:
+    """Check if device has available tokens and use ``amount`` of them."""
     device = await get_or_create_device(db, device_id)
     
-    if device.free_uses_remaining > 0:
-        device.free_uses_remaining -= 1
+    success, message = _consume_tokens(device, amount)
+    if success:
         await db.commit()
-        return True, f"Free use consumed. {device.free_uses_remaining} remaining."
-    
-    if device.paid_tokens > 0:
-        device.paid_tokens -= 1
-        await db.commit()
-        return True, f"Paid token consumed. {device.paid_tokens} remaining."
-    
-    return False, "No tokens available. Please purchase more."
+    await _cache_balance(_balance_key("device", device_id), device.free_uses_remaining, device.paid_tokens)
+    return success, message
 
 
-async def get_device_token_status(db: AsyncSession, device_id: str) -> dict:
-    """Get token status for a device."""
-    device = await get_or_create_device(db, device_id)
+async def get_device_token_status(db: AsyncSession, device_id: str, use_cache: bool = True) -> dict:
+    """Get token status for a device.
+    
+    Read only: unknown devices get the free allowance without a row being
+    created; that happens on their first OCR.
+    """
+    key = _balance_key("device", device_id)
+    balance = await _cached_balance(key) if use_cache else None
+    if balance is None:
+        result = await db.execute(
+            select(DeviceToken.free_uses_remaining, DeviceToken.paid_tokens).where(DeviceToken.device_id == device_id)
+        )
+        balance = tuple(result.one_or_none() or (settings.free_uses_per_device, 0))
+        await _cache_balance(key, *balance)
+    free_uses, paid_tokens = balance
     return {
         "device_id": device_id,
         "user_id": None,
         "mode": "device",
-        "free_uses_remaining": device.free_uses_remaining,
-        "paid_tokens": device.paid_tokens,
-        "total_available": device.free_uses_remaining + device.paid_tokens
+        "free_uses_remaining": free_uses,
+        "paid_tokens": paid_tokens,
+        "total_available": free_uses + paid_tokens
     }
 
 
@@ -66,6 +116,7 @@ async def add_device_tokens(db: AsyncSession, device_id: str, amount: int) -> De
     device.paid_tokens += amount
     await db.commit()
     await db.refresh(device)
+    await _cache_balance(_balance_key("device", device_id), device.free_uses_remaining, device.paid_tokens)
     return device
 
 
@@ -92,34 +143,40 @@ async def get_or_create_user_token(db: AsyncSession, user: UserInfo) -> UserToke
     return user_token
 
 
-async def check_and_use_user_token(db: AsyncSession, user: UserInfo) -> tuple[bool, str]:
-    """Check if user has available tokens and use one."""
+async def check_and_use_user_token(
+    db: AsyncSession,
+    user: UserInfo,
+    amount: int = 1
+) -> tuple[bool, str]:
+    """Check if user has available tokens and use ``amount`` of them."""
     user_token = await get_or_create_user_token(db, user)
     
-    if user_token.free_uses_remaining > 0:
-        user_token.free_uses_remaining -= 1
-        await db.commit()
-        return True, f"Free use consumed. {user_token.free_uses_remaining} remaining."
-    
-    if user_token.paid_tokens > 0:
-        user_token.paid_tokens -= 1
+    success, message = _consume_tokens(user_token, amount)
+    if success:
         await db.commit()
-        return True, f"Paid token consumed. {user_token.paid_tokens} remaining."
-    
-    return False, "No tokens available. Please purchase more."
+    await _cache_balance(_balance_key("user", user.id), user_token.free_uses_remaining, user_token.paid_tokens)
+    return success, message
 
 
-async def get_user_token_status(db: AsyncSession, user: UserInfo) -> dict:
-    """Get token status for a user."""
-    user_token = await get_or_create_user_token(db, user)
+async def get_user_token_status(db: AsyncSession, user: UserInfo, use_cache: bool = True) -> dict:
+    """Get token status for a user; read only, like ``get_device_token_status``."""
+    key = _balance_key("user", user.id)
+    balance = await _cached_balance(key) if use_cache else None
+    if balance is None:
+        result = await db.execute(
+            select(UserToken.free_uses_remaining, UserToken.paid_tokens).where(UserToken.user_id == user.id)
+        )
+        balance = tuple(result.one_or_none() or (settings.free_uses_per_device, 0))
+        await _cache_balance(key, *balance)
+    free_uses, paid_tokens = balance
     return {
         "device_id": None,
         "user_id": user.id,
-        "phone": user_token.phone,
+        "phone": user.phone,
         "mode": "user",
-        "free_uses_remaining": user_token.free_uses_remaining,
-        "paid_tokens": user_token.paid_tokens,
-        "total_available": user_token.free_uses_remaining + user_token.paid_tokens
+        "free_uses_remaining": free_uses,
+        "paid_tokens": paid_tokens,
+        "total_available": free_uses + paid_tokens
     }
 
 
@@ -134,6 +191,7 @@ async def add_user_tokens(db: AsyncSession, user_id: str, amount: int) -> UserTo
         user_token.paid_tokens += amount
         await db.commit()
         await db.refresh(user_token)
+        await _cache_balance(_balance_key("user", user_id), user_token.free_uses_remaining, user_token.paid_tokens)
         return user_token
     
     # User doesn't exist yet, create with tokens
@@ -145,6 +203,7 @@ async def add_user_tokens(db: AsyncSession, user_id: str, amount: int) -> UserTo
     db.add(user_token)
     await db.commit()
     await db.refresh(user_token)
+    await _cache_balance(_balance_key("user", user_id), user_token.free_uses_remaining, user_token.paid_tokens)
     return user_token
 
 
@@ -153,27 +212,33 @@ async def add_user_tokens(db: AsyncSession, user_id: str, amount: int) -> UserTo
 async def check_and_use_token(
     db: AsyncSession,
     device_id: str,
-    user: Optional[UserInfo] = None
+    user: Optional[UserInfo] = None,
+    amount: int = 1
 ) -> tuple[bool, str]:
     """
-    Check and use token - user mode takes priority.
+    Check and use token(s) - user mode takes priority.
     """
     if user:
-        return await check_and_use_user_token(db, user)
-    return await check_and_use_device_token(db, device_id)
+        return await check_and_use_user_token(db, user, amount)
+    return await check_and_use_device_token(db, device_id, amount)
 
 
 async def get_token_status(
     db: AsyncSession,
     device_id: str,
-    user: Optional[UserInfo] = None
+    user: Optional[UserInfo] = None,
+    use_cache: bool = True
 ) -> dict:
     """
     Get token status - user mode takes priority.
+    
+    Never writes, and serves balances cached for up to
+    ``token_status_cache_seconds``; pass ``use_cache=False`` where a change
+    made by another worker must be visible at once.
     """
     if user:
-        return await get_user_token_status(db, user)
-    return await get_device_token_status(db, device_id)
+        return await get_user_token_status(db, user, use_cache)
+    return await get_device_token_status(db, device_id, use_cache)
 
 
 async def add_tokens(
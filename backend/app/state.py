@@ -0,0 +1,387 @@
+"""
+Shared state: cache entries and counters.
+
+A single process can keep these in memory, but several replicas behind a
+load balancer need one store. ``get_state()`` returns the backend selected
+by ``state_backend``:
+
+- ``memory``: per process, the default for a single replica;
+- ``sql``: two tables in the application database (``app/database.py``);
+- ``redis``: any server speaking the Redis protocol, at ``redis_url``.
+
+Keys are strings and values bytes; callers serialize. Counters read back
+through ``get`` as their decimal digits, as in Redis.
+"""
+import asyncio
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, List, Optional, Tuple, Union
+from urllib.parse import unquote, urlparse
+
+from sqlalchemy import and_, case, delete, func, or_, select
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from app.config import get_settings
+from app.models import StateEntry
+
+
+class StateError(Exception):
+    """Raised when the state store cannot be reached or rejects a command."""
+
+
+class StateBackend(ABC):
+    @abstractmethod
+    async def get(self, key: str) -> Optional[bytes]:
+        """The value of ``key``, or None if missing or expired."""
+
+    @abstractmethod
+    async def set(self, key: str, value: bytes, ttl: Optional[float] = None) -> None:
+        """Store ``value``, expiring after ``ttl`` seconds if given."""
+
+    @abstractmethod
+    async def delete(self, key: str) -> None:
+        ...
+
+    @abstractmethod
+    async def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        """Add ``amount`` to a counter and return the new value.
+
+        ``ttl`` only applies when the counter is created, so a counter
+        counts over a fixed window starting with its first increment.
+        """
+
+    async def purge_expired(self) -> int:
+        """Drop expired entries the backend does not expire by itself; returns how many."""
+        return 0
+
+    async def close(self) -> None:
+        pass
+
+
+# ============== Memory ==============
+
+class MemoryState(StateBackend):
+    """Per-process state; beyond ``max_entries`` entries or ``max_bytes`` of values,
+    the least recently used are evicted first."""
+
+    def __init__(self, max_entries: int = 100_000, max_bytes: int = 256 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, Tuple[Union[bytes, int], Optional[float]]]" = OrderedDict()
+        self._bytes = 0
+
+    def _remove(self, key: str) -> None:
+        value, _ = self._entries.pop(key)
+        if isinstance(value, bytes):
+            self._bytes -= len(value)
+
+    def _lookup(self, key: str):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[1] is not None and entry[1] <= time.monotonic():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _store(self, key: str, value: Union[bytes, int], expires: Optional[float]) -> None:
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (value, expires)
+        if isinstance(value, bytes):
+            self._bytes += len(value)
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+
+    async def get(self, key: str) -> Optional[bytes]:
+        entry = self._lookup(key)
+        if entry is None:
+            return None
+        value = entry[0]
+        return str(value).encode() if isinstance(value, int) else value
+
+    async def set(self, key: str, value: bytes, ttl: Optional[float] = None) -> None:
+        self._store(key, value, time.monotonic() + ttl if ttl else None)
+
+    async def delete(self, key: str) -> None:
+        if key in self._entries:
+            self._remove(key)
+
+    async def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        entry = self._lookup(key)
+        if entry is None:
+            value, expires = amount, time.monotonic() + ttl if ttl else None
+        else:
+            value, expires = int(entry[0]) + amount, entry[1]
+        self._store(key, value, expires)
+        return value
+
+    async def purge_expired(self) -> int:
+        now = time.monotonic()
+        expired = [key for key, (_, expires) in self._entries.items() if expires is not None and expires <= now]
+        for key in expired:
+            self._remove(key)
+        return len(expired)
+
+
+# ============== SQL ==============
+
+class SQLState(StateBackend):
+    """State in the ``state_entries`` table.
+
+    Counters are single ``INSERT ... ON CONFLICT`` statements, so they
+    stay atomic across processes.
+    """
+
+    def __init__(self, engine: AsyncEngine):
+        self.engine = engine
+
+    def _insert(self):
+        if self.engine.dialect.name == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert
+        return insert(StateEntry)
+
+    @staticmethod
+    def _live(now: float):
+        return or_(StateEntry.expires_at.is_(None), StateEntry.expires_at > now)
+
+    async def get(self, key: str) -> Optional[bytes]:
+        async with self.engine.connect() as conn:
+            row = (await conn.execute(
+                select(StateEntry.value, StateEntry.counter).where(StateEntry.key == key, self._live(time.time()))
+            )).one_or_none()
+        if row is None:
+            return None
+        return row.value if row.counter is None else str(row.counter).encode()
+
+    async def set(self, key: str, value: bytes, ttl: Optional[float] = None) -> None:
+        expires = time.time() + ttl if ttl else None
+        statement = self._insert().values(key=key, value=value, counter=None, expires_at=expires)
+        statement = statement.on_conflict_do_update(
+            index_elements=[StateEntry.key],
+            set_={"value": value, "counter": None, "expires_at": expires}
+        )
+        async with self.engine.begin() as conn:
+            await conn.execute(statement)
+
+    async def delete(self, key: str) -> None:
+        async with self.engine.begin() as conn:
+            await conn.execute(delete(StateEntry).where(StateEntry.key == key))
+
+    async def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        now = time.time()
+        expires = now + ttl if ttl else None
+        # Compares the existing row; an expired counter starts over
+        expired = and_(StateEntry.expires_at.is_not(None), StateEntry.expires_at <= now)
+        statement = self._insert().values(key=key, value=None, counter=amount, expires_at=expires)
+        statement = statement.on_conflict_do_update(
+            index_elements=[StateEntry.key],
+            set_={
+                "value": None,
+                "counter": case((expired, amount), else_=func.coalesce(StateEntry.counter, 0) + amount),
+                "expires_at": case((expired, expires), else_=StateEntry.expires_at)
+            }
+        ).returning(StateEntry.counter)
+        async with self.engine.begin() as conn:
+            return (await conn.execute(statement)).scalar_one()
+
+    async def purge_expired(self) -> int:
+        async with self.engine.begin() as conn:
+            result = await conn.execute(
+                delete(StateEntry).where(StateEntry.expires_at.is_not(None), StateEntry.expires_at <= time.time())
+            )
+        return result.rowcount
+
+
+# ============== Redis protocol ==============
+
+class RedisConnection:
+    """One connection speaking RESP2, the Redis wire protocol."""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+
+    @staticmethod
+    def encode(args) -> bytes:
+        parts = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode()
+            parts += [b"$%d\r\n" % len(arg), arg, b"\r\n"]
+        return b"".join(parts)
+
+    async def read_reply(self) -> Any:
+        line = await self.reader.readuntil(b"\r\n")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b"+":
+            return payload.decode()
+        if kind == b"-":
+            raise StateError(payload.decode())
+        if kind == b":":
+            return int(payload)
+        if kind == b"$":
+            length = int(payload)
+            if length < 0:
+                return None
+            return (await self.reader.readexactly(length + 2))[:-2]
+        if kind == b"*":
+            length = int(payload)
+            if length < 0:
+                return None
+            return [await self.read_reply() for _ in range(length)]
+        raise StateError(f"Unexpected reply from the state server: {line!r}")
+
+    async def execute(self, *commands) -> List[Any]:
+        """Send ``commands`` (argument tuples) in one write and return their replies."""
+        self.writer.write(b"".join(self.encode(command) for command in commands))
+        await self.writer.drain()
+        replies, error = [], None
+        # Read every reply, even after an error, so the connection stays in sync
+        for _ in commands:
+            try:
+                replies.append(await self.read_reply())
+            except StateError as e:
+                error = error or e
+                replies.append(None)
+        if error:
+            raise error
+        return replies
+
+    def close(self) -> None:
+        self.writer.close()
+
+
+class RedisState(StateBackend):
+    """State on a Redis-protocol server, over a small pool of connections.
+
+    Keys are prefixed with ``prefix`` so several apps can share a server.
+    """
+
+    def __init__(self, url: str, prefix: str = "", max_connections: int = 10, timeout: float = 5):
+        parsed = urlparse(url)
+        if parsed.scheme != "redis":
+            raise ValueError(f"Unsupported state URL: {url}")
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.username = unquote(parsed.username) if parsed.username else None
+        self.password = unquote(parsed.password) if parsed.password else None
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.prefix = prefix
+        self.timeout = timeout
+        self._idle: List[RedisConnection] = []
+        self._slots = asyncio.Semaphore(max_connections)
+
+    async def _connect(self) -> RedisConnection:
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        connection = RedisConnection(reader, writer)
+        setup = []
+        if self.password:
+            setup.append(("AUTH", self.username, self.password) if self.username else ("AUTH", self.password))
+        if self.db:
+            setup.append(("SELECT", self.db))
+        if setup:
+            try:
+                await connection.execute(*setup)
+            except BaseException:
+                connection.close()
+                raise
+        return connection
+
+    async def _execute(self, *commands) -> List[Any]:
+        async with self._slots:
+            connection = self._idle.pop() if self._idle else None
+            try:
+                if connection is None:
+                    connection = await asyncio.wait_for(self._connect(), self.timeout)
+                replies = await asyncio.wait_for(connection.execute(*commands), self.timeout)
+            except StateError:
+                # A command error leaves the connection usable
+                if connection is not None:
+                    self._idle.append(connection)
+                raise
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+                if connection is not None:
+                    connection.close()
+                raise StateError(f"State server unavailable: {e!r}") from e
+            except BaseException:
+                # Cancelled mid-command: the replies still in flight make the connection unusable
+                if connection is not None:
+                    connection.close()
+                raise
+            self._idle.append(connection)
+            return replies
+
+    def _key(self, key: str) -> str:
+        return self.prefix + key
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return (await self._execute(("GET", self._key(key))))[0]
+
+    async def set(self, key: str, value: bytes, ttl: Optional[float] = None) -> None:
+        if ttl:
+            await self._execute(("SET", self._key(key), value, "PX", max(1, int(ttl * 1000))))
+        else:
+            await self._execute(("SET", self._key(key), value))
+
+    async def delete(self, key: str) -> None:
+        await self._execute(("DEL", self._key(key)))
+
+    async def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        key = self._key(key)
+        if not ttl:
+            return (await self._execute(("INCRBY", key, amount)))[0]
+        # NX: only a counter without an expiry yet, i.e. one just created, gets one
+        value, _ = await self._execute(("INCRBY", key, amount), ("PEXPIRE", key, max(1, int(ttl * 1000)), "NX"))
+        return value
+
+    async def close(self) -> None:
+        while self._idle:
+            self._idle.pop().close()
+
+
+# ============== Selection ==============
+
+_state: Optional[StateBackend] = None
+
+
+def create_state(settings) -> StateBackend:
+    """The backend named by ``settings.state_backend``."""
+    if settings.state_backend == "memory":
+        return MemoryState(settings.state_memory_max_entries, settings.state_memory_max_bytes)
+    if settings.state_backend == "sql":
+        from app.database import get_engine
+        return SQLState(get_engine())
+    if settings.state_backend == "redis":
+        return RedisState(
+            settings.redis_url,
+            prefix=settings.state_key_prefix,
+            max_connections=settings.redis_max_connections,
+            timeout=settings.redis_timeout_seconds
+        )
+    raise ValueError(f"Unknown state backend: {settings.state_backend}")
+
+
+def get_state() -> StateBackend:
+    """The process-wide state backend, created on first use."""
+    global _state
+    if _state is None:
+        _state = create_state(get_settings())
+    return _state
+
+
+def set_state(state: Optional[StateBackend]) -> None:
+    """Replace the process-wide backend; None recreates it from the settings on next use."""
+    global _state
+    _state = state
+
+
+async def close_state() -> None:
+    global _state
+    if _state is not None:
+        state, _state = _state, None
+        await state.close()
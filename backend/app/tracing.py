@@ -0,0 +1,99 @@
+"""
+Optional OpenTelemetry tracing.
+
+Nothing from ``opentelemetry`` is imported unless ``tracing_enabled`` is set,
+and ``span()`` returns a shared no-op context manager while tracing is off.
+Requires ``opentelemetry-sdk`` (plus ``opentelemetry-exporter-otlp-proto-http``
+for the OTLP exporter).
+"""
+from contextlib import nullcontext
+from typing import Optional
+
+_tracer = None
+_provider = None
+_instrumented_engines = set()
+_NOOP = nullcontext()
+
+
+def span(name: str, attributes: Optional[dict] = None):
+    """Context manager for a child span of the current one; no-op when disabled."""
+    if _tracer is None:
+        return _NOOP
+    return _tracer.start_as_current_span(name, attributes=attributes)
+
+
+def set_attributes(current, attributes: dict) -> None:
+    """Set attributes on a span yielded by ``span()``, which is None when disabled."""
+    if current is not None:
+        current.set_attributes(attributes)
+
+
+def setup_tracing(settings) -> None:
+    """Install the tracer provider and exporter configured in ``settings``."""
+    global _tracer, _provider
+    if not settings.tracing_enabled or _tracer is not None:
+        return
+
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+
+    provider = TracerProvider(resource=Resource.create({"service.name": settings.tool_name}))
+    if settings.tracing_exporter == "otlp":
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        exporter = OTLPSpanExporter(endpoint=settings.tracing_otlp_endpoint or None)
+    else:
+        # One JSON object per line, for offline analysis
+        exporter = ConsoleSpanExporter(
+            out=open(settings.tracing_file, "a", encoding="utf-8"),
+            formatter=lambda s: s.to_json(indent=None) + "\n"
+        )
+    provider.add_span_processor(BatchSpanProcessor(exporter))
+
+    _provider = provider
+    _tracer = provider.get_tracer("textbook-ocr")
+
+    from app.database import get_engine
+    instrument_engine(get_engine())
+
+
+def shutdown_tracing() -> None:
+    """Flush pending spans and disable tracing."""
+    global _tracer, _provider
+    if _provider is not None:
+        _provider.shutdown()
+    _tracer = None
+    _provider = None
+
+
+def instrument_engine(engine) -> None:
+    """Record a span for every SQL statement run on an (async) SQLAlchemy engine."""
+    from sqlalchemy import event
+
+    sync_engine = getattr(engine, "sync_engine", engine)
+    if id(sync_engine) in _instrumented_engines:
+        return
+    _instrumented_engines.add(id(sync_engine))
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if _tracer is None:
+            return
+        context._otel_span = _tracer.start_span(
+            "db." + statement.split(None, 1)[0].upper(),
+            attributes={"db.system": sync_engine.dialect.name, "db.statement": statement}
+        )
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        current = getattr(context, "_otel_span", None)
+        if current is not None:
+            current.end()
+
+    @event.listens_for(sync_engine, "handle_error")
+    def handle_error(exception_context):
+        context = exception_context.execution_context
+        current = getattr(context, "_otel_span", None) if context is not None else None
+        if current is not None:
+            current.record_exception(exception_context.original_exception)
+            current.end()
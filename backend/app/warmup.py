@@ -0,0 +1,113 @@
+"""
+Startup warm-up and readiness.
+
+Importing the app is kept cheap: PyMuPDF, Pillow, NumPy, the OpenAI SDK
+and httpx are imported where they are first used, and the LLM clients are
+built on first use. The tables are created before the app serves (see
+``app.main``); ``warm_up`` pays the remaining costs in the background right
+after startup, so the first requests do not:
+
+- builds the LLM client of the configured transport,
+- starts the thread pool and every worker process, each rendering a test
+  PDF page (which imports PyMuPDF and Pillow there),
+- imports the rasterization and preprocessing modules in this process.
+
+``/health`` answers as soon as the process is up (liveness); ``/ready``
+answers 200 only once ``warm_up`` has finished (readiness). A failing
+warm-up is logged and retried; after the last attempt ``/ready`` reports
+the error.
+"""
+import asyncio
+import logging
+import time
+from typing import Dict, Optional
+
+from app.config import get_settings
+from app.services.executor import run_in_process, run_in_thread
+
+logger = logging.getLogger(__name__)
+
+ATTEMPTS = 3
+RETRY_DELAY_SECONDS = 5  # Times the attempt number
+
+
+class Readiness:
+    """Progress of ``warm_up``: ``starting``, ``ready`` or ``failed``."""
+
+    def __init__(self):
+        self.status = "starting"
+        self.error: Optional[str] = None
+        self.steps: Dict[str, float] = {}  # Seconds per finished step
+
+    @property
+    def ready(self) -> bool:
+        return self.status == "ready"
+
+    def to_dict(self) -> dict:
+        body = {"status": self.status, "steps": self.steps}
+        if self.error:
+            body["error"] = self.error
+        return body
+
+
+readiness = Readiness()
+
+
+def render_test_page() -> bytes:
+    """Make a one-page PDF and render it; returns the PDF. Runs in a worker process."""
+    import fitz
+    from app.services.ocr import render_pdf
+
+    with fitz.open() as doc:
+        doc.new_page(width=200, height=200).insert_text((20, 100), "x² + y² = 1")
+        pdf_bytes = doc.tobytes()
+    render_pdf(pdf_bytes, dpi=72)
+    return pdf_bytes
+
+
+def _import_page_modules(pdf_bytes: bytes) -> None:
+    from app.services.ocr import inspect_file
+    from app.services.preprocess import preprocess_image  # noqa: F401 (NumPy)
+
+    inspect_file(pdf_bytes, "application/pdf")
+
+
+async def warm_up(state: Readiness = readiness) -> None:
+    """Run the warm-up steps in order, retrying; if every attempt fails, ``state`` is failed."""
+    settings = get_settings()
+    state.status, state.error, state.steps = "starting", None, {}
+
+    async def step(name: str, coro):
+        start = time.perf_counter()
+        result = await coro
+        state.steps[name] = round(time.perf_counter() - start, 3)
+        return result
+
+    async def llm_client() -> None:
+        from app.services import ocr
+        if settings.llm_transport == "streaming":
+            ocr.get_streaming_llm_client()
+        else:
+            await run_in_thread(ocr.get_llm_client)  # The SDK import takes most of a second
+
+    async def render() -> bytes:
+        workers = max(1, settings.executor_processes)
+        pdfs = await asyncio.gather(*(run_in_process(render_test_page) for _ in range(workers)))
+        return pdfs[0]
+
+    for attempt in range(1, ATTEMPTS + 1):
+        try:
+            await step("llm_client", llm_client())
+            pdf_bytes = await step("render", render())
+            await step("imports", run_in_thread(_import_page_modules, pdf_bytes))
+            break
+        except Exception as e:
+            state.error = f"{type(e).__name__}: {e}"
+            if attempt == ATTEMPTS:
+                logger.error("Warm-up failed after %d attempts, /ready stays 503", ATTEMPTS, exc_info=True)
+                state.status = "failed"
+                return
+            logger.warning("Warm-up attempt %d failed, retrying", attempt, exc_info=True)
+            await asyncio.sleep(RETRY_DELAY_SECONDS * attempt)
+    state.status, state.error = "ready", None
+    logger.info("Warm-up done in %.2fs: %s", sum(state.steps.values()), state.steps)
@@ -0,0 +1,6 @@
+"""Performance benchmarks for the OCR backend.
+
+Run a benchmark from the ``backend`` directory, e.g.::
+
+    python -m benchmarks.bench_export
+"""
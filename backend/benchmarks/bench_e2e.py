@@ -0,0 +1,248 @@
+"""End-to-end pipeline benchmark against a local fake LLM server.
+
+Starts ``benchmarks.fake_llm`` in a child process, points ``llm_proxy_url``
+at it and drives ``POST /api/v1/ocr/process`` in-process with the sample
+files from ``test-files/`` at several concurrency levels::
+
+    python -m benchmarks.bench_e2e --concurrency 1,4,16 --requests 24 --output report.json
+    python -m benchmarks.bench_e2e --compare report.json   # diff against an earlier run
+
+The report contains pages/s, p50/p95/p99 request latency, peak RSS and
+event-loop lag per level, plus the commit it was taken at.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from benchmarks import fake_llm
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+TEST_FILES_DIR = BACKEND_DIR.parent / "test-files"
+MIME_TYPES = {".pdf": "application/pdf", ".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".png": "image/png"}
+
+
+def percentile(values, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(q / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is reported in KiB on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def load_samples():
+    samples = []
+    for path in sorted(TEST_FILES_DIR.iterdir()):
+        mime_type = MIME_TYPES.get(path.suffix.lower())
+        if mime_type:
+            samples.append((path.name, path.read_bytes(), mime_type))
+    return samples
+
+
+class LoopLagMonitor:
+    """Measures how late a periodic timer fires, i.e. how long the loop was blocked."""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - start - self.interval))
+
+    def start(self):
+        self.samples = []
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+
+async def wait_for_server(url: str, timeout: float = 15) -> None:
+    import httpx
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                if (await client.get(f"{url}/health")).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.1)
+    raise RuntimeError(f"Fake LLM server at {url} did not start")
+
+
+async def run_level(client, samples, page_counts, concurrency: int, requests: int, internal_key: str) -> dict:
+    queue = asyncio.Queue()
+    for n in range(requests):
+        queue.put_nowait((n, samples[n % len(samples)]))
+
+    latencies, errors, pages = [], 0, 0
+    error_samples = []
+
+    async def worker():
+        nonlocal errors, pages
+        while True:
+            try:
+                n, (name, data, mime_type) = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            start = time.perf_counter()
+            response = await client.post(
+                "/api/v1/ocr/process",
+                files={"file": (name, data, mime_type)},
+                headers={"X-Device-Id": f"bench-{concurrency}-{n}", "X-Internal-Key": internal_key}
+            )
+            latencies.append(time.perf_counter() - start)
+            if response.status_code == 200:
+                pages += page_counts[name]
+            else:
+                errors += 1
+                if len(error_samples) < 5:
+                    error_samples.append(f"{response.status_code}: {response.text[:200]}")
+
+    monitor = LoopLagMonitor()
+    monitor.start()
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    await monitor.stop()
+
+    return {
+        "concurrency": concurrency,
+        "requests": requests,
+        "errors": errors,
+        "error_samples": error_samples,
+        "pages": pages,
+        "seconds": round(elapsed, 3),
+        "pages_per_second": round(pages / elapsed, 3),
+        "latency_p50": round(percentile(latencies, 50), 4),
+        "latency_p95": round(percentile(latencies, 95), 4),
+        "latency_p99": round(percentile(latencies, 99), 4),
+        "loop_lag_max": round(max(monitor.samples, default=0.0), 4),
+        "loop_lag_p99": round(percentile(monitor.samples, 99), 4),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+
+async def run(args) -> dict:
+    port = free_port()
+    llm_url = f"http://127.0.0.1:{port}"
+    server = multiprocessing.Process(
+        target=fake_llm.serve, args=(fake_llm.config_from_args(args), port), daemon=True
+    )
+    server.start()
+    workdir = tempfile.mkdtemp(prefix="bench-e2e-")
+    try:
+        await wait_for_server(llm_url)
+
+        # Settings are read once, so configure the environment before importing the app
+        os.environ["LLM_PROXY_URL"] = llm_url
+        os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{workdir}/bench.db"
+        import httpx
+        from app.config import get_settings
+        from app.database import init_db
+        from app.main import app
+        from app.services.ocr import count_pages
+
+        await init_db()
+        samples = load_samples()
+        page_counts = {name: count_pages(data, mime_type) for name, data, mime_type in samples}
+        settings = get_settings()
+
+        levels = []
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            for concurrency in args.concurrency:
+                levels.append(await run_level(
+                    client, samples, page_counts, concurrency, args.requests, settings.internal_test_key
+                ))
+                print(json.dumps(levels[-1]), file=sys.stderr)
+    finally:
+        server.terminate()
+        server.join()
+
+    return {
+        "benchmark": "e2e",
+        "commit": git_commit(),
+        "timestamp": int(time.time()),
+        "python": sys.version.split()[0],
+        "samples": [name for name, _, _ in samples],
+        "fake_llm": vars(fake_llm.config_from_args(args)),
+        "levels": levels,
+    }
+
+
+def compare(report: dict, baseline: dict) -> list:
+    """Relative change per concurrency level for the headline numbers."""
+    previous = {level["concurrency"]: level for level in baseline["levels"]}
+    rows = []
+    for level in report["levels"]:
+        before = previous.get(level["concurrency"])
+        if not before:
+            continue
+        row = {"concurrency": level["concurrency"]}
+        for key in ("pages_per_second", "latency_p50", "latency_p95", "latency_p99", "loop_lag_max", "peak_rss_mb"):
+            if before[key]:
+                row[key] = f"{(level[key] - before[key]) / before[key]:+.1%}"
+        rows.append(row)
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--concurrency", type=lambda s: [int(c) for c in s.split(",")], default=[1, 4, 16])
+    parser.add_argument("--requests", type=int, default=24, help="Requests per concurrency level")
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    parser.add_argument("--compare", help="Baseline report to compare against")
+    fake_llm.add_config_arguments(parser)
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    if args.compare:
+        report["compared_to"] = json.loads(Path(args.compare).read_text())["commit"]
+        report["changes"] = compare(report, json.loads(Path(args.compare).read_text()))
+
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        Path(args.output).write_text(text)
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
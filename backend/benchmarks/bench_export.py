@@ -0,0 +1,67 @@
+"""Export throughput: one pandoc process per conversion vs. a warm `pandoc server`.
+
+Usage::
+
+    python -m benchmarks.bench_export [--documents 50] [--concurrency 4] [--format docx]
+
+Prints a JSON report with conversions/s for each mode. Caching is bypassed
+so every conversion actually reaches pandoc.
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from app.services import export
+
+SAMPLE = """## Page {n}
+
+设函数 $f(x) = x^2 + {n}x$，则
+
+$$
+\\int_0^1 f(x)\\,dx = \\frac{{1}}{{3}} + \\frac{{{n}}}{{2}}
+$$
+"""
+
+
+async def run_mode(documents, concurrency: int, fmt: str) -> float:
+    semaphore = asyncio.Semaphore(concurrency)
+    export_format = export.get_export_format(fmt)
+
+    async def convert(markdown: str):
+        async with semaphore:
+            await export._convert(markdown, export_format)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(convert(doc) for doc in documents))
+    return time.perf_counter() - start
+
+
+async def main(args) -> dict:
+    export._semaphore = asyncio.Semaphore(args.concurrency)
+    documents = [SAMPLE.format(n=n) for n in range(args.documents)]
+    report = {"documents": args.documents, "concurrency": args.concurrency, "format": args.format}
+
+    elapsed = await run_mode(documents, args.concurrency, args.format)
+    report["subprocess"] = {"seconds": round(elapsed, 3), "docs_per_second": round(len(documents) / elapsed, 2)}
+
+    export.settings.pandoc_server_enabled = True
+    await export.start_export_server()
+    if export._server is None:
+        report["server"] = None  # pandoc built without server support
+    else:
+        try:
+            elapsed = await run_mode(documents, args.concurrency, args.format)
+        finally:
+            await export.stop_export_server()
+        report["server"] = {"seconds": round(elapsed, 3), "docs_per_second": round(len(documents) / elapsed, 2)}
+
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--documents", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--format", default="docx", choices=sorted(export.EXPORT_FORMATS))
+    print(json.dumps(asyncio.run(main(parser.parse_args())), indent=2))
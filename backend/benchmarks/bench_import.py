@@ -0,0 +1,84 @@
+"""Cold import time of the app.
+
+Imports ``app.main`` in fresh interpreters with ``-X importtime`` and
+reports the wall time, the slowest modules (cumulative) and whether any
+module that should be imported lazily was loaded::
+
+    python -m benchmarks.bench_import
+    python -m benchmarks.bench_import --check --budget 2.0
+
+``--check`` exits non-zero when the median import takes longer than
+``--budget`` seconds or a lazy module was imported eagerly.
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+MODULE = "app.main"
+# Imported on first use (see app.warmup); importing the app must not load them
+LAZY_MODULES = ["fitz", "PIL", "numpy", "openai", "httpx", "aiosqlite"]
+
+
+def import_once(module: str) -> dict:
+    code = (
+        f"import json, sys, {module}\n"
+        f"print(json.dumps(sorted(m for m in {LAZY_MODULES!r} if m in sys.modules)))\n"
+    )
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True, check=True
+    )
+    wall = time.perf_counter() - start
+
+    modules = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if cumulative.strip().isdigit():
+            modules[name.strip()] = int(cumulative) / 1e6
+    return {"wall_s": wall, "modules": modules, "loaded": json.loads(proc.stdout)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--module", default=MODULE)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--check", action="store_true")
+    parser.add_argument("--budget", type=float, default=2.0, help="Seconds, median wall time")
+    args = parser.parse_args()
+
+    runs = [import_once(args.module) for _ in range(args.repeat)]
+    # The first run also pays for cold bytecode and file caches
+    print("wall times:", [round(run["wall_s"], 3) for run in runs], file=sys.stderr)
+    median = statistics.median(run["wall_s"] for run in runs)
+    best = min(runs, key=lambda run: run["wall_s"])
+    top = sorted(best["modules"].items(), key=lambda item: item[1], reverse=True)
+
+    report = {
+        "benchmark": "import",
+        "module": args.module,
+        "median_s": round(median, 3),
+        "min_s": round(best["wall_s"], 3),
+        "slowest_modules": {name: round(seconds, 3) for name, seconds in top[:args.top]},
+        "lazy_modules_loaded": sorted(set().union(*(run["loaded"] for run in runs))),
+    }
+    print(json.dumps(report, indent=2))
+
+    if args.check:
+        failures = []
+        if median > args.budget:
+            failures.append(f"median import {median:.2f}s exceeds {args.budget}s")
+        if report["lazy_modules_loaded"]:
+            failures.append(f"imported eagerly: {', '.join(report['lazy_modules_loaded'])}")
+        if failures:
+            print("FAIL: " + "; ".join(failures), file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
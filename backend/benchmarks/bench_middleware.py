@@ -0,0 +1,112 @@
+"""Per-request overhead of the request metrics middleware.
+
+Calls a minimal FastAPI app directly through ASGI (no HTTP client or
+socket), bare and wrapped in each middleware variant, and reports the
+mean time per request and the overhead over the bare app::
+
+    python -m benchmarks.bench_middleware --requests 20000
+
+``legacy`` is the previous ``@app.middleware("http")`` implementation,
+kept here for comparison.
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+from fastapi import FastAPI, Request
+
+from app.metrics import http_requests, http_request_duration, crawler_visits
+from app.middleware import BOT_PATTERNS, MetricsMiddleware
+
+USER_AGENT = b"Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 Chrome/126.0 Safari/537.36"
+
+
+def create_app(variant: str) -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/status/{checkout_id}")
+    async def status(checkout_id: str):
+        return {"status": "pending"}
+
+    if variant == "asgi":
+        app.add_middleware(MetricsMiddleware)
+    elif variant == "legacy":
+        @app.middleware("http")
+        async def metrics_middleware(request: Request, call_next):
+            start_time = time.time()
+            ua = request.headers.get("user-agent", "")
+            for bot in BOT_PATTERNS:
+                if bot.lower() in ua.lower():
+                    crawler_visits.labels(tool="bench", bot=bot).inc()
+                    break
+            response = await call_next(request)
+            duration = time.time() - start_time
+            http_requests.labels(
+                tool="bench", endpoint=request.url.path, method=request.method, status=response.status_code
+            ).inc()
+            http_request_duration.labels(
+                tool="bench", endpoint=request.url.path, method=request.method
+            ).observe(duration)
+            return response
+    return app
+
+
+async def call(app, n: int) -> None:
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": f"/status/order-{n}",
+        "raw_path": f"/status/order-{n}".encode(),
+        "root_path": "",
+        "query_string": b"",
+        "headers": [(b"host", b"bench"), (b"user-agent", USER_AGENT)],
+        "client": ("127.0.0.1", 1234),
+        "server": ("bench", 80),
+    }
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        pass
+
+    await app(scope, receive, send)
+
+
+async def bench(variant: str, requests: int, warmup: int) -> float:
+    app = create_app(variant)
+    for n in range(warmup):
+        await call(app, n)
+    start = time.perf_counter()
+    for n in range(requests):
+        await call(app, n)
+    return (time.perf_counter() - start) / requests
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--warmup", type=int, default=1000)
+    args = parser.parse_args()
+
+    results = {}
+    for variant in ("bare", "asgi", "legacy"):
+        results[variant] = asyncio.run(bench(variant, args.requests, args.warmup))
+        print(variant, f"{results[variant] * 1e6:.1f}us", file=sys.stderr)
+
+    report = {
+        "benchmark": "middleware",
+        "requests": args.requests,
+        "per_request_us": {k: round(v * 1e6, 2) for k, v in results.items()},
+        "overhead_us": {k: round((v - results["bare"]) * 1e6, 2) for k, v in results.items() if k != "bare"},
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""Effect of image preprocessing on uploaded photos.
+
+For every image in ``test-files/`` (or the files given) this reports the
+size, pixel count and base64 payload sent to the model before and after
+``preprocess_image``, with the preprocessing time::
+
+    python -m benchmarks.bench_preprocess
+    python -m benchmarks.bench_preprocess --max-pixels 1500000 photo.jpg
+
+Vision models bill images by pixels (tiles), so ``pixels_ratio`` is the
+closest proxy for the change in prompt tokens. Photos whose re-encoding
+would not be smaller are sent as uploaded (``bytes_ratio`` 1.0).
+"""
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+
+from PIL import Image
+
+from app.config import get_settings
+from app.services.archive import EXTENSION_TYPES
+from app.services.preprocess import preprocess_image
+
+BENCH_DIR = Path(__file__).resolve().parent
+TEST_FILES_DIR = BENCH_DIR.parent.parent / "test-files"
+
+
+def base64_kb(size: int) -> float:
+    return round(4 * ((size + 2) // 3) / 1024, 1)
+
+
+def bench_image(path: Path, max_pixels: int, repeat: int) -> dict:
+    data = path.read_bytes()
+    mime_type = EXTENSION_TYPES[path.suffix.lower()]
+    with Image.open(path) as img:
+        width, height = img.size
+
+    best, result = float("inf"), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = preprocess_image(data, mime_type, max_pixels)
+        best = min(best, time.perf_counter() - start)
+
+    return {
+        "original": f"{width}x{height}",
+        "original_kb": round(len(data) / 1024, 1),
+        "original_base64_kb": base64_kb(len(data)),
+        "size": f"{result.size[0]}x{result.size[1]}",
+        "kb": round(len(result.image_bytes) / 1024, 1),
+        "base64_kb": base64_kb(len(result.image_bytes)),
+        "pixels_ratio": round(result.size[0] * result.size[1] / (width * height), 3),
+        "bytes_ratio": round(len(result.image_bytes) / len(data), 3),
+        "skew_degrees": result.skew_degrees,
+        "cropped": result.cropped,
+        "preprocess_s": round(best, 4),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("files", nargs="*", type=Path)
+    parser.add_argument("--max-pixels", type=int, default=get_settings().image_max_pixels)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    paths = args.files or sorted(
+        path for path in TEST_FILES_DIR.iterdir()
+        if path.suffix.lower() in EXTENSION_TYPES and path.suffix.lower() != ".pdf"
+    )
+    results = {}
+    for path in paths:
+        results[path.name] = bench_image(path, args.max_pixels, args.repeat)
+        print(path.name, json.dumps(results[path.name]), file=sys.stderr)
+
+    print(json.dumps({"benchmark": "preprocess", "max_pixels": args.max_pixels, "results": results}, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""Micro-benchmarks for PDF rasterization and image encoding.
+
+For every page of the sample PDFs in ``test-files/`` and each DPI this
+measures render time, PNG (PyMuPDF and PIL)/JPEG/WebP encoding cost and size, base64
+expansion, and peak Python memory (``tracemalloc``) of the production
+path ``pdf_to_images`` + ``image_to_base64``::
+
+    python -m benchmarks.bench_raster                    # print a report
+    python -m benchmarks.bench_raster --save-baseline    # record benchmarks/baselines/raster.json
+    python -m benchmarks.bench_raster --check            # exit 1 on regressions
+
+Timings are the best of ``--repeat`` runs. Baselines are machine specific;
+record them on the machine that runs ``--check``.
+"""
+import argparse
+import base64
+import io
+import json
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+import fitz
+from PIL import Image
+
+from app.services.ocr import pdf_to_images, image_to_base64
+
+BENCH_DIR = Path(__file__).resolve().parent
+TEST_FILES_DIR = BENCH_DIR.parent.parent / "test-files"
+BASELINE_PATH = BENCH_DIR / "baselines" / "raster.json"
+
+# Metrics compared against the baseline; sizes are deterministic, so only time and memory
+CHECKED_METRICS = ("render_s", "mupdf_png_s", "png_s", "jpeg_s", "webp_s", "base64_s", "pipeline_s", "pipeline_peak_mb")
+
+
+def best_of(repeat: int, fn):
+    """Run ``fn`` ``repeat`` times; return (best seconds, last result)."""
+    best, result = float("inf"), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def encode(img: Image.Image, fmt: str, **options) -> bytes:
+    buffer = io.BytesIO()
+    img.save(buffer, format=fmt, **options)
+    return buffer.getvalue()
+
+
+def bench_page(pdf_bytes: bytes, page_index: int, dpi: int, repeat: int) -> dict:
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+        page = doc.load_page(page_index)
+        matrix = fitz.Matrix(dpi / 72, dpi / 72)
+        render_s, pix = best_of(repeat, lambda: page.get_pixmap(matrix=matrix))
+        mupdf_png_s, mupdf_png = best_of(repeat, lambda: pix.tobytes("png"))
+        img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+
+    png_s, png = best_of(repeat, lambda: encode(img, "PNG", optimize=True))
+    jpeg_s, jpeg = best_of(repeat, lambda: encode(img, "JPEG", quality=90))
+    webp_s, webp = best_of(repeat, lambda: encode(img, "WEBP", quality=90))
+    base64_s, encoded = best_of(repeat, lambda: base64.b64encode(png))
+
+    # The production path for a single page, end to end
+    def pipeline():
+        images = pdf_to_images(pdf_bytes, dpi=dpi, page_indices=[page_index])
+        return image_to_base64(images[0][0])
+
+    pipeline_s, _ = best_of(repeat, pipeline)
+    tracemalloc.start()
+    pipeline()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "width": pix.width,
+        "height": pix.height,
+        "raw_mb": round(len(pix.samples) / 2**20, 2),
+        "render_s": round(render_s, 4),
+        "mupdf_png_s": round(mupdf_png_s, 4),
+        "mupdf_png_kb": round(len(mupdf_png) / 1024, 1),
+        "png_s": round(png_s, 4),
+        "png_kb": round(len(png) / 1024, 1),
+        "jpeg_s": round(jpeg_s, 4),
+        "jpeg_kb": round(len(jpeg) / 1024, 1),
+        "webp_s": round(webp_s, 4),
+        "webp_kb": round(len(webp) / 1024, 1),
+        "base64_s": round(base64_s, 4),
+        "base64_kb": round(len(encoded) / 1024, 1),
+        "base64_expansion": round(len(encoded) / len(png), 3),
+        "pipeline_s": round(pipeline_s, 4),
+        "pipeline_peak_mb": round(peak / 2**20, 2),
+    }
+
+
+def run(dpis, repeat: int) -> dict:
+    results = {}
+    for path in sorted(TEST_FILES_DIR.glob("*.pdf")):
+        pdf_bytes = path.read_bytes()
+        with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+            page_count = len(doc)
+        for page_index in range(page_count):
+            for dpi in dpis:
+                key = f"{path.name}#{page_index + 1}@{dpi}"
+                results[key] = bench_page(pdf_bytes, page_index, dpi, repeat)
+                print(key, json.dumps(results[key]), file=sys.stderr)
+    return results
+
+
+def find_regressions(results: dict, baseline: dict, threshold: float, min_delta: float) -> list:
+    """Metrics worse than baseline by more than ``threshold`` (relative) and ``min_delta`` (absolute)."""
+    regressions = []
+    for key, metrics in results.items():
+        before = baseline.get(key)
+        if not before:
+            continue
+        for metric in CHECKED_METRICS:
+            if not before.get(metric):
+                continue
+            delta = metrics[metric] - before[metric]
+            if delta > before[metric] * threshold and delta > min_delta:
+                regressions.append({
+                    "case": key,
+                    "metric": metric,
+                    "baseline": before[metric],
+                    "current": metrics[metric],
+                    "change": f"{metrics[metric] / before[metric] - 1:+.1%}",
+                })
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dpi", type=lambda s: [int(d) for d in s.split(",")], default=[150, 300, 600])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--threshold", type=float, default=0.25, help="Allowed slowdown before failing --check")
+    parser.add_argument("--min-delta", type=float, default=0.005,
+                        help="Ignore absolute changes below this (seconds or MB), which are noise")
+    parser.add_argument("--baseline", type=Path, default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--check", action="store_true")
+    args = parser.parse_args()
+
+    results = run(args.dpi, args.repeat)
+    report = {"benchmark": "raster", "results": results}
+
+    if args.save_baseline:
+        args.baseline.parent.mkdir(parents=True, exist_ok=True)
+        args.baseline.write_text(json.dumps(results, indent=2, sort_keys=True) + "\n")
+
+    exit_code = 0
+    if args.check:
+        baseline = json.loads(args.baseline.read_text())
+        report["regressions"] = find_regressions(results, baseline, args.threshold, args.min_delta)
+        exit_code = 1 if report["regressions"] else 0
+
+    print(json.dumps(report, indent=2))
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""A local stand-in for the OpenAI-compatible llm-proxy.
+
+Serves ``POST /chat/completions`` (and ``/v1/chat/completions``) with
+configurable latency, output token rate and error rate, so the OCR
+pipeline can be exercised and measured offline::
+
+    python -m benchmarks.fake_llm --port 8100 --latency-dist lognormal --latency-mean 1.5
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from dataclasses import dataclass, asdict
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse
+from starlette.routing import Route
+
+OCR_OUTPUT = """# 第一章 函数与极限
+
+设函数 $f(x) = \\frac{x^2 - 1}{x - 1}$，当 $x \\to 1$ 时，
+
+$$
+\\lim_{x \\to 1} f(x) = \\lim_{x \\to 1} (x + 1) = 2
+$$
+
+因此函数在 $x = 1$ 处的极限存在。
+"""
+
+
+@dataclass
+class FakeLLMConfig:
+    latency_dist: str = "fixed"  # fixed, uniform, lognormal
+    latency_mean: float = 0.5  # Seconds before the first token
+    latency_spread: float = 0.5  # Uniform: +/- fraction of the mean; lognormal: sigma
+    token_rate: float = 0  # Completion tokens per second, 0 for instant
+    error_rate: float = 0  # Fraction of requests answered with HTTP 500
+    seed: int = 0
+
+
+def sample_latency(config: FakeLLMConfig, rng: random.Random) -> float:
+    if config.latency_dist == "uniform":
+        spread = config.latency_mean * config.latency_spread
+        return max(0.0, rng.uniform(config.latency_mean - spread, config.latency_mean + spread))
+    if config.latency_dist == "lognormal":
+        # Scaled so that the median equals latency_mean
+        return config.latency_mean * rng.lognormvariate(0, config.latency_spread)
+    return config.latency_mean
+
+
+def create_app(config: FakeLLMConfig) -> Starlette:
+    rng = random.Random(config.seed)
+    stats = {"requests": 0, "errors": 0}
+
+    async def chat_completions(request: Request):
+        body = await request.json()
+        stats["requests"] += 1
+        prompt_chars = len(json.dumps(body["messages"], ensure_ascii=False))
+
+        await asyncio.sleep(sample_latency(config, rng))
+        if rng.random() < config.error_rate:
+            stats["errors"] += 1
+            return JSONResponse({"error": {"message": "injected failure", "type": "server_error"}}, status_code=500)
+
+        # OCR requests carry an image; format requests get their input echoed back
+        last = body["messages"][-1]["content"]
+        content = OCR_OUTPUT if isinstance(last, list) else last
+        completion_tokens = max(1, len(content) // 2)
+        if config.token_rate > 0:
+            await asyncio.sleep(completion_tokens / config.token_rate)
+
+        return JSONResponse({
+            "id": f"chatcmpl-fake-{stats['requests']}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "fake"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop"
+            }],
+            "usage": {
+                "prompt_tokens": prompt_chars // 4,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_chars // 4 + completion_tokens
+            }
+        })
+
+    async def get_stats(request: Request):
+        return JSONResponse({**stats, "config": asdict(config)})
+
+    async def health(request: Request):
+        return PlainTextResponse("ok")
+
+    return Starlette(routes=[
+        Route("/chat/completions", chat_completions, methods=["POST"]),
+        Route("/v1/chat/completions", chat_completions, methods=["POST"]),
+        Route("/stats", get_stats),
+        Route("/health", health),
+    ])
+
+
+def serve(config: FakeLLMConfig, port: int) -> None:
+    """Run the fake server in the current process until interrupted."""
+    import uvicorn
+    uvicorn.run(create_app(config), host="127.0.0.1", port=port, log_level="warning")
+
+
+def add_config_arguments(parser: argparse.ArgumentParser) -> None:
+    defaults = FakeLLMConfig()
+    parser.add_argument("--latency-dist", choices=["fixed", "uniform", "lognormal"], default=defaults.latency_dist)
+    parser.add_argument("--latency-mean", type=float, default=defaults.latency_mean)
+    parser.add_argument("--latency-spread", type=float, default=defaults.latency_spread)
+    parser.add_argument("--token-rate", type=float, default=defaults.token_rate)
+    parser.add_argument("--error-rate", type=float, default=defaults.error_rate)
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+
+
+def config_from_args(args: argparse.Namespace) -> FakeLLMConfig:
+    return FakeLLMConfig(
+        latency_dist=args.latency_dist,
+        latency_mean=args.latency_mean,
+        latency_spread=args.latency_spread,
+        token_rate=args.token_rate,
+        error_rate=args.error_rate,
+        seed=args.seed
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8100)
+    add_config_arguments(parser)
+    args = parser.parse_args()
+    serve(config_from_args(args), args.port)
@@ -0,0 +1,20 @@
+#!/bin/sh
+# Container entrypoint: uvicorn with one worker per core when state is shared, otherwise one.
+set -e
+
+# Caches, rate limits and admission queues of the memory state backend are per process,
+# so several workers would each enforce the limits separately
+if [ -z "$WEB_CONCURRENCY" ]; then
+    if [ "${STATE_BACKEND:-memory}" = "memory" ]; then
+        WEB_CONCURRENCY=1
+    else
+        WEB_CONCURRENCY=$(nproc)
+    fi
+elif [ "$WEB_CONCURRENCY" -gt 1 ] && [ "${STATE_BACKEND:-memory}" = "memory" ]; then
+    echo "WEB_CONCURRENCY=$WEB_CONCURRENCY needs a shared state backend: set STATE_BACKEND=sql or redis" >&2
+    exit 1
+fi
+
+# Workers share metrics through PROMETHEUS_MULTIPROC_DIR, which must be emptied before they start
+rm -rf "$PROMETHEUS_MULTIPROC_DIR" && mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+exec uvicorn app.main:app --host 0.0.0.0 --port 8000 --workers "$WEB_CONCURRENCY"
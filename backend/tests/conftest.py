@@ -6,6 +6,7 @@ from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, Asyn
 
 from app.main import app
 from app.database import Base, get_db
+from app.state import MemoryState, set_state
 
 # Test database
 TEST_DATABASE_URL = "sqlite+aiosqlite:///./test.db"
@@ -24,6 +25,8 @@ def event_loop():
 async def db_session():
     async with test_engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+    # Cached balances belong to the database being dropped
+    set_state(MemoryState())
     
     async with TestSessionLocal() as session:
         yield session
@@ -61,3 +64,170 @@ def sample_image():
         "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk+M9QDwADhgGAWjR9awAAAABJRU5ErkJggg=="
     )
     return png_data
+
+
+FAKE_PANDOC = """
+import base64, json, sys
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+LOG = {log!r}
+
+if sys.argv[1] == "server":
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write(b"3.1")
+
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            with open(LOG, "a") as log:
+                log.write("server " + request["to"] + "\\n")
+            body = json.dumps({{
+                "output": base64.b64encode(request["text"].encode()).decode(),
+                "base64": True,
+                "messages": []
+            }}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    HTTPServer(("127.0.0.1", int(sys.argv[2].split("=")[1])), Handler).serve_forever()
+else:
+    with open(LOG, "a") as log:
+        log.write("run " + " ".join(sys.argv[1:]) + "\\n")
+    sys.stdout.buffer.write(sys.stdin.buffer.read())
+"""
+
+
+@pytest.fixture
+def fake_pandoc(tmp_path, monkeypatch):
+    """A stand-in pandoc that echoes its input and logs each invocation."""
+    import sys
+    from app.services import export
+    
+    log = tmp_path / "calls.log"
+    log.touch()
+    script = tmp_path / "pandoc"
+    script.write_text(f"#!{sys.executable}\n" + FAKE_PANDOC.format(log=str(log)))
+    script.chmod(0o755)
+    monkeypatch.setattr(export.settings, "pandoc_path", str(script))
+    # Conversions are cached in the state backend
+    set_state(MemoryState())
+    yield log
+    set_state(MemoryState())
+
+
+class FakeCompletions:
+    """Stand-in for ``AsyncOpenAI().chat.completions`` that records each call."""
+    
+    def __init__(self):
+        self.calls = []
+    
+    async def create(self, **kwargs):
+        from types import SimpleNamespace
+        self.calls.append(kwargs)
+        content = kwargs["messages"][-1]["content"]
+        if isinstance(content, list):
+            content = "# OCR\n\n$x^2$"
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+            usage=SimpleNamespace(prompt_tokens=100, completion_tokens=20)
+        )
+
+
+@pytest.fixture
+def fake_llm(monkeypatch):
+    from types import SimpleNamespace
+    completions = FakeCompletions()
+    monkeypatch.setattr(
+        "app.services.ocr.llm_client",
+        SimpleNamespace(chat=SimpleNamespace(completions=completions))
+    )
+    return completions
+
+
+class FakeRedisServer:
+    """A stand-in Redis server speaking RESP2, with the commands ``app.state.RedisState`` uses."""
+    
+    def __init__(self):
+        self.data = {}  # key -> (value, expires or None)
+        self.commands = []
+        self.server = None
+    
+    async def start(self) -> str:
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        return "redis://127.0.0.1:%d/0" % self.server.sockets[0].getsockname()[1]
+    
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+    
+    def lookup(self, key):
+        import time
+        entry = self.data.get(key)
+        if entry and entry[1] is not None and entry[1] <= time.monotonic():
+            del self.data[key]
+            return None
+        return entry
+    
+    async def handle(self, reader, writer):
+        from app.state import RedisConnection
+        connection = RedisConnection(reader, writer)
+        try:
+            while True:
+                try:
+                    command = await connection.read_reply()
+                except asyncio.IncompleteReadError:
+                    break
+                self.commands.append(command[0].decode().upper())
+                writer.write(await self.run(command[0].decode().upper(), command[1:]))
+                await writer.drain()
+        finally:
+            writer.close()
+    
+    async def run(self, name, args):
+        import time
+        if name in ("PING", "AUTH", "SELECT"):
+            return b"+OK\r\n"
+        if name == "GET":
+            entry = self.lookup(args[0])
+            return bulk(entry and entry[0])
+        if name == "SET":
+            expires = time.monotonic() + int(args[3]) / 1000 if len(args) > 3 else None
+            self.data[args[0]] = (args[1], expires)
+            return b"+OK\r\n"
+        if name == "DEL":
+            return b":%d\r\n" % (self.data.pop(args[0], None) is not None)
+        if name == "INCRBY":
+            entry = self.lookup(args[0])
+            value = int(entry[0] if entry else 0) + int(args[1])
+            self.data[args[0]] = (str(value).encode(), entry[1] if entry else None)
+            return b":%d\r\n" % value
+        if name == "PEXPIRE":
+            entry = self.lookup(args[0])
+            if not entry or (b"NX" in args[2:] and entry[1] is not None):
+                return b":0\r\n"
+            self.data[args[0]] = (entry[0], time.monotonic() + int(args[1]) / 1000)
+            return b":1\r\n"
+        return b"-ERR unknown command '%s'\r\n" % name.encode()
+
+
+def bulk(value) -> bytes:
+    if value is None:
+        return b"$-1\r\n"
+    return b"$%d\r\n%s\r\n" % (len(value), value)
+
+
+@pytest_asyncio.fixture
+async def fake_redis():
+    server = FakeRedisServer()
+    url = await server.start()
+    server.url = url
+    yield server
+    await server.stop()
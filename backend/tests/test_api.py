@@ -12,6 +12,40 @@ async def test_health(client: AsyncClient):
     assert data["service"] == "textbook-ocr"
 
 
+@pytest.mark.asyncio
+async def test_ready_after_warm_up(client: AsyncClient, monkeypatch):
+    from app import warmup
+    from app.config import get_settings
+    
+    monkeypatch.setattr(get_settings(), "executor_processes", 0)
+    monkeypatch.setattr(warmup, "RETRY_DELAY_SECONDS", 0)
+    state = warmup.Readiness()
+    monkeypatch.setattr(warmup, "readiness", state)
+    monkeypatch.setattr("app.main.readiness", state)
+    
+    response = await client.get("/ready")
+    assert response.status_code == 503
+    assert response.json()["status"] == "starting"
+    
+    await warmup.warm_up(state)
+    response = await client.get("/ready")
+    assert response.status_code == 200
+    assert set(response.json()["steps"]) == {"llm_client", "render", "imports"}
+    
+    attempts = []
+    
+    def broken_render():
+        attempts.append(1)
+        return 1 / 0
+    
+    monkeypatch.setattr(warmup, "render_test_page", broken_render)
+    await warmup.warm_up(state)
+    assert len(attempts) == warmup.ATTEMPTS
+    response = await client.get("/ready")
+    assert response.status_code == 503
+    assert response.json()["error"].startswith("ZeroDivisionError")
+
+
 @pytest.mark.asyncio
 async def test_root(client: AsyncClient):
     response = await client.get("/")
@@ -136,3 +170,551 @@ async def test_error_detail_format_400(client: AsyncClient, device_id: str):
     detail = data.get("detail")
     
     assert isinstance(detail, str), f"detail should be string, got {type(detail)}: {detail}"
+
+
+@pytest.fixture
+def fake_process_pages(monkeypatch):
+    from app.services.ocr import FileInfo, PageInfo, PageResult
+    calls = []
+    
+    async def fake(file_bytes, mime_type, dpi=600, model=None, page_indices=None, on_page=None):
+        calls.append({"dpi": dpi, "model": model, "page_indices": list(page_indices)})
+        results = []
+        for i in page_indices:
+            if file_bytes.endswith(b"fail") and i == 1 and len(calls) == 1:
+                raise RuntimeError("LLM proxy unavailable")
+            results.append(PageResult(i, f"page {i} by {model or 'default'}", []))
+            if on_page:
+                await on_page(results[-1])
+        return results
+    
+    monkeypatch.setattr("app.api.v1.ocr.process_pages", fake)
+    monkeypatch.setattr(
+        "app.api.v1.ocr.inspect_file",
+        lambda file_bytes, mime_type: FileInfo(mime_type, 3, False, False, [PageInfo(i, 612, 792, False) for i in range(3)])
+    )
+    return calls
+
+
+@pytest.mark.asyncio
+async def test_reocr_selected_pages(client: AsyncClient, device_id: str, fake_process_pages):
+    files = {"file": ("book.pdf", io.BytesIO(b"%PDF-1.4"), "application/pdf")}
+    response = await client.post(
+        "/api/v1/ocr/process",
+        files=files,
+        headers={"X-Device-Id": device_id}
+    )
+    assert response.status_code == 200
+    data = response.json()
+    document_id = data["document_id"]
+    assert data["tokens_remaining"] == 2
+    
+    response = await client.post(
+        f"/api/v1/ocr/documents/{document_id}/reocr",
+        json={"pages": [1], "model": "gemini-2.5-flash", "dpi": 300},
+        headers={"X-Device-Id": device_id}
+    )
+    assert response.status_code == 200
+    data = response.json()
+    assert data["tokens_remaining"] == 1
+    assert fake_process_pages[-1] == {"dpi": 300, "model": "gemini-2.5-flash", "page_indices": [1]}
+    assert "page 0 by default" in data["markdown"]
+    assert "page 1 by gemini-2.5-flash" in data["markdown"]
+    
+    response = await client.get(
+        f"/api/v1/ocr/documents/{document_id}",
+        headers={"X-Device-Id": device_id}
+    )
+    assert response.status_code == 200
+    pages = response.json()["pages"]
+    assert [p["dpi"] for p in pages] == [600, 300, 600]
+
+
+@pytest.mark.asyncio
+async def test_reocr_counts_every_token_charged(
+    client: AsyncClient, device_id: str, fake_process_pages, monkeypatch
+):
+    from prometheus_client import REGISTRY
+    from app.config import get_settings
+    
+    files = {"file": ("book.pdf", io.BytesIO(b"%PDF-1.4"), "application/pdf")}
+    response = await client.post("/api/v1/ocr/process", files=files, headers={"X-Device-Id": device_id})
+    document_id = response.json()["document_id"]
+    
+    monkeypatch.setattr(get_settings(), "reocr_pages_per_token", 1)
+    before = REGISTRY.get_sample_value("tokens_consumed_total", {"tool": "textbook-ocr"})
+    response = await client.post(
+        f"/api/v1/ocr/documents/{document_id}/reocr",
+        json={"pages": [0, 2]},
+        headers={"X-Device-Id": device_id}
+    )
+    assert response.status_code == 200
+    assert response.json()["tokens_remaining"] == 0
+    assert REGISTRY.get_sample_value("tokens_consumed_total", {"tool": "textbook-ocr"}) == before + 2
+
+
+@pytest.mark.asyncio
+async def test_reocr_rejects_other_device(client: AsyncClient, device_id: str, fake_process_pages):
+    files = {"file": ("book.pdf", io.BytesIO(b"%PDF-1.4"), "application/pdf")}
+    response = await client.post(
+        "/api/v1/ocr/process",
+        files=files,
+        headers={"X-Device-Id": device_id}
+    )
+    document_id = response.json()["document_id"]
+    
+    response = await client.post(
+        f"/api/v1/ocr/documents/{document_id}/reocr",
+        json={"pages": [0]},
+        headers={"X-Device-Id": "someone-else"}
+    )
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_reocr_page_out_of_range(client: AsyncClient, device_id: str, fake_process_pages):
+    files = {"file": ("book.pdf", io.BytesIO(b"%PDF-1.4"), "application/pdf")}
+    response = await client.post(
+        "/api/v1/ocr/process",
+        files=files,
+        headers={"X-Device-Id": device_id}
+    )
+    document_id = response.json()["document_id"]
+    
+    response = await client.post(
+        f"/api/v1/ocr/documents/{document_id}/reocr",
+        json={"pages": [3]},
+        headers={"X-Device-Id": device_id}
+    )
+    assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_process_resumes_from_checkpoint(client: AsyncClient, device_id: str, fake_process_pages):
+    files = {"file": ("book.pdf", io.BytesIO(b"%PDF-1.4 fail"), "application/pdf")}
+    response = await client.post(
+        "/api/v1/ocr/process",
+        files=files,
+        headers={"X-Device-Id": device_id}
+    )
+    assert response.status_code == 500
+    
+    # Retrying the same file skips the checkpointed page and is not charged again
+    files = {"file": ("book.pdf", io.BytesIO(b"%PDF-1.4 fail"), "application/pdf")}
+    response = await client.post(
+        "/api/v1/ocr/process",
+        files=files,
+        headers={"X-Device-Id": device_id}
+    )
+    assert response.status_code == 200
+    data = response.json()
+    assert data["tokens_remaining"] == 2
+    assert fake_process_pages[-1]["page_indices"] == [1, 2]
+    assert "page 0 by default" in data["markdown"]
+    assert "page 2 by default" in data["markdown"]
+
+
+@pytest.mark.asyncio
+async def test_process_rate_limited_and_shed(
+    client: AsyncClient, device_id: str, sample_image, fake_process_pages, monkeypatch
+):
+    from app.config import get_settings
+    from app.services import admission
+    
+    def post():
+        return client.post(
+            "/api/v1/ocr/process",
+            files={"file": ("photo.png", sample_image, "image/png")},
+            headers={"X-Device-Id": device_id}
+        )
+    
+    # Saturated worker: shed before a token is charged
+    busy = admission.AdmissionController(capacity=1, max_wait=0, default_seconds=30)
+    busy.in_flight = 1
+    monkeypatch.setattr(admission, "_controller", busy)
+    response = await post()
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "30"
+    
+    monkeypatch.setattr(admission, "_controller", admission.AdmissionController(1, 0, 30))
+    monkeypatch.setattr(get_settings(), "rate_limit_requests_per_minute", 1)
+    assert (await post()).status_code == 200
+    response = await post()
+    assert response.status_code == 429
+    assert 1 <= int(response.headers["Retry-After"]) <= 60
+    
+    status = await client.get("/api/v1/ocr/tokens", headers={"X-Device-Id": device_id})
+    assert status.json()["free_uses_remaining"] == 2
+
+
+@pytest.mark.asyncio
+async def test_process_cancelled_on_disconnect_keeps_finished_pages(
+    client: AsyncClient, device_id: str, fake_process_pages, monkeypatch
+):
+    import asyncio
+    from starlette.requests import Request
+    from app.api.v1 import ocr as ocr_api
+    from app.config import get_settings
+    from app.services.ocr import PageResult
+    
+    finished = asyncio.Event()
+    
+    async def hang_after_first_page(file_bytes, mime_type, dpi=600, model=None, page_indices=None, on_page=None):
+        await on_page(PageResult(page_indices[0], "page 0 before the disconnect", []))
+        finished.set()
+        await asyncio.sleep(3600)
+    
+    async def is_disconnected(self):
+        return finished.is_set()
+    
+    monkeypatch.setattr(get_settings(), "disconnect_poll_seconds", 0.01)
+    monkeypatch.setattr(Request, "is_disconnected", is_disconnected)
+    resume = ocr_api.process_pages
+    monkeypatch.setattr(ocr_api, "process_pages", hang_after_first_page)
+    
+    files = {"file": ("book.pdf", io.BytesIO(b"%PDF-1.4"), "application/pdf")}
+    response = await asyncio.wait_for(
+        client.post("/api/v1/ocr/process", files=files, headers={"X-Device-Id": device_id}), 5
+    )
+    assert response.status_code == 499
+    
+    # Submitting again resumes after the checkpointed page, without a second charge
+    finished.clear()
+    monkeypatch.setattr(ocr_api, "process_pages", resume)
+    files = {"file": ("book.pdf", io.BytesIO(b"%PDF-1.4"), "application/pdf")}
+    response = await client.post("/api/v1/ocr/process", files=files, headers={"X-Device-Id": device_id})
+    assert response.status_code == 200
+    assert fake_process_pages[-1]["page_indices"] == [1, 2]
+    assert "page 0 before the disconnect" in response.json()["markdown"]
+    assert response.json()["tokens_remaining"] == 2
+
+
+@pytest.mark.asyncio
+async def test_convert_docx(client: AsyncClient, fake_pandoc):
+    response = await client.post(
+        "/api/v1/ocr/convert-docx",
+        json={"markdown": "# Hello"}
+    )
+    assert response.status_code == 200
+    assert response.content == b"# Hello"
+    assert "ocr-result.docx" in response.headers["content-disposition"]
+
+
+@pytest.mark.asyncio
+async def test_export_batch(client: AsyncClient, fake_pandoc):
+    import zipfile
+    
+    response = await client.post(
+        "/api/v1/ocr/export/batch",
+        json={
+            "format": "html",
+            "documents": [
+                {"name": "chapter 1", "markdown": "one"},
+                {"name": "../chapter 2", "markdown": "two"}
+            ]
+        }
+    )
+    assert response.status_code == 200
+    archive = zipfile.ZipFile(io.BytesIO(response.content))
+    assert archive.namelist() == ["chapter_1.html", "chapter_2.html"]
+    assert archive.read("chapter_2.html") == b"two"
+
+
+@pytest.mark.asyncio
+async def test_export_unsupported_format(client: AsyncClient):
+    response = await client.post(
+        "/api/v1/ocr/export",
+        json={"markdown": "# Hi", "format": "rtf"}
+    )
+    assert response.status_code == 400
+    assert "Unsupported format" in response.json()["detail"]
+
+
+@pytest.mark.asyncio
+async def test_metrics_label_by_route_template(client: AsyncClient):
+    for checkout_id in ("order-a", "order-b"):
+        await client.get(f"/api/v1/payment/status/{checkout_id}")
+    await client.get("/no-such-page", headers={"User-Agent": "Mozilla/5.0 (compatible; googlebot/2.1)"})
+    
+    text = (await client.get("/metrics")).text
+    assert 'endpoint="/api/v1/payment/status/{checkout_id}"' in text
+    assert "order-a" not in text
+    assert 'endpoint="<unmatched>"' in text
+    assert 'crawler_visits_total{bot="Googlebot",tool="textbook-ocr"}' in text
+
+
+@pytest.mark.asyncio
+async def test_admin_requires_internal_key(client: AsyncClient):
+    response = await client.get("/api/v1/admin/loop-blocks")
+    assert response.status_code == 403
+
+
+@pytest.mark.asyncio
+async def test_admin_sampling_profile(client: AsyncClient):
+    from app.config import get_settings
+    headers = {"X-Internal-Key": get_settings().internal_test_key}
+    
+    response = await client.get("/api/v1/admin/profile?seconds=0.1&format=collapsed", headers=headers)
+    assert response.status_code == 200
+    assert "MainThread;" in response.text
+    
+    response = await client.get("/api/v1/admin/profile?seconds=0.1", headers=headers)
+    profile = response.json()
+    assert profile["profiles"] and profile["shared"]["frames"]
+
+
+@pytest.mark.asyncio
+async def test_request_profile(client: AsyncClient):
+    from app.config import get_settings
+    headers = {"X-Internal-Key": get_settings().internal_test_key}
+    
+    response = await client.get("/health", headers={**headers, "X-Profile": "1"})
+    assert response.status_code == 200
+    profile_id = response.headers["X-Profile-Id"]
+    assert "X-Profile-Id" not in (await client.get("/health", headers=headers)).headers
+    
+    response = await client.get(f"/api/v1/admin/profile/requests/{profile_id}", headers=headers)
+    assert response.status_code == 200
+    assert "function calls" in response.text
+
+
+LOOP_LAG_BUDGET = 0.25  # Seconds the event loop may be blocked while serving a request
+
+
+@pytest.mark.asyncio
+async def test_request_paths_do_not_block_event_loop(client: AsyncClient, fake_llm, fake_pandoc, monkeypatch):
+    import asyncio
+    import os
+    import fitz
+    from PIL import Image
+    from app.config import get_settings
+    
+    # A page of noise takes over a second to encode as optimized PNG
+    noise = Image.frombytes("RGB", (300, 300), os.urandom(300 * 300 * 3))
+    buffer = io.BytesIO()
+    noise.save(buffer, format="PNG")
+    with fitz.open() as doc:
+        page = doc.new_page(width=300, height=300)
+        page.insert_image(page.rect, stream=buffer.getvalue())
+        pdf_bytes = doc.tobytes()
+    monkeypatch.setattr(get_settings(), "pdf_dpi", 150)
+    
+    lags = []
+    
+    async def measure_lag():
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(0.01)
+            lags.append(loop.time() - start - 0.01)
+    
+    monitor = asyncio.create_task(measure_lag())
+    try:
+        headers = {"X-Device-Id": "lag-device", "X-Internal-Key": get_settings().internal_test_key}
+        response = await client.post(
+            "/api/v1/ocr/process",
+            files={"file": ("noise.pdf", pdf_bytes, "application/pdf")},
+            headers=headers
+        )
+        assert response.status_code == 200
+        document_id = response.json()["document_id"]
+        assert (await client.get(f"/api/v1/ocr/documents/{document_id}", headers=headers)).status_code == 200
+        response = await client.post(
+            "/api/v1/ocr/export/batch",
+            json={"documents": [{"name": "a", "markdown": "x" * 100000}], "format": "docx"}
+        )
+        assert response.status_code == 200
+    finally:
+        monitor.cancel()
+    
+    assert max(lags) < LOOP_LAG_BUDGET, f"Event loop blocked for {max(lags):.2f}s"
+
+
+@pytest.mark.asyncio
+async def test_process_batch_with_zip(client: AsyncClient, device_id: str, fake_llm, sample_image, monkeypatch):
+    import zipfile
+    import fitz
+    from app.config import get_settings
+    
+    monkeypatch.setattr(get_settings(), "pdf_dpi", 72)
+    with fitz.open() as doc:
+        doc.new_page()
+        doc.new_page()
+        pdf_bytes = doc.tobytes()
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w") as zf:
+        zf.writestr("chapter/b-scan.png", sample_image)
+        zf.writestr("chapter/a-book.pdf", pdf_bytes)
+        zf.writestr("chapter/notes.txt", "ignored")
+        zf.writestr("__MACOSX/chapter/._a-book.pdf", "ignored")
+    
+    response = await client.post(
+        "/api/v1/ocr/process/batch",
+        files=[
+            ("files", ("photo.png", sample_image, "image/png")),
+            ("files", ("chapters.zip", archive.getvalue(), "application/zip")),
+        ],
+        headers={"X-Device-Id": device_id}
+    )
+    assert response.status_code == 200
+    data = response.json()
+    assert data["success"] is True
+    assert [f["filename"] for f in data["files"]] == ["photo.png", "a-book.pdf", "b-scan.png"]
+    assert [f["page_count"] for f in data["files"]] == [1, 2, 1]
+    assert "## Page 2" in data["files"][1]["markdown"]
+    assert data["markdown"].startswith("# photo.png\n\n# OCR")
+    assert len(fake_llm.calls) == 4
+    # Charged once, one token per file
+    assert data["tokens_remaining"] == 0
+    
+    response = await client.post(
+        "/api/v1/ocr/process/batch",
+        files=[("files", ("photo.png", sample_image + b"\0", "image/png"))],
+        headers={"X-Device-Id": device_id}
+    )
+    assert response.status_code == 402
+
+
+@pytest.mark.asyncio
+async def test_process_batch_limits(client: AsyncClient, device_id: str, sample_image, monkeypatch):
+    from app.config import get_settings
+    monkeypatch.setattr(get_settings(), "batch_max_files", 1)
+    
+    response = await client.post(
+        "/api/v1/ocr/process/batch",
+        files=[("files", ("a.png", sample_image, "image/png")), ("files", ("b.png", sample_image, "image/png"))],
+        headers={"X-Device-Id": device_id}
+    )
+    assert response.status_code == 400
+    assert "Too many files" in response.json()["detail"]
+    
+    response = await client.post(
+        "/api/v1/ocr/process/batch",
+        files=[("files", ("a.zip", b"not a zip", "application/zip"))],
+        headers={"X-Device-Id": device_id}
+    )
+    assert response.status_code == 400
+
+    # An encrypted entry and a corrupt deflate stream are bad uploads too
+    import zipfile
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("a.png", bytes(range(256)) * 40)
+    archive = buffer.getvalue()
+    central = archive.index(b"PK\x01\x02")
+    encrypted = bytearray(archive)
+    encrypted[6] |= 0x1
+    encrypted[central + 8] |= 0x1
+    corrupt = bytearray(archive)
+    corrupt[35:55] = b"\xff" * 20
+    for data, detail in ((encrypted, "Encrypted"), (corrupt, "Invalid ZIP")):
+        response = await client.post(
+            "/api/v1/ocr/process/batch",
+            files=[("files", ("a.zip", bytes(data), "application/zip"))],
+            headers={"X-Device-Id": device_id}
+        )
+        assert response.status_code == 400
+        assert detail in response.json()["detail"]
+
+
+@pytest.mark.asyncio
+async def test_inspect_pdf(client: AsyncClient):
+    import fitz
+    with fitz.open() as doc:
+        doc.new_page(width=595, height=842).insert_text((72, 72), "Chapter 1")
+        doc.new_page(width=612, height=792)
+        pdf_bytes = doc.tobytes()
+    
+    response = await client.post(
+        "/api/v1/ocr/inspect",
+        files={"file": ("book.pdf", pdf_bytes, "application/pdf")}
+    )
+    assert response.status_code == 200
+    data = response.json()
+    assert data["page_count"] == 2
+    assert data["encrypted"] is False
+    assert data["text_pages"] == 1
+    assert data["pages"][0] == {"page_index": 0, "width": 595, "height": 842, "has_text": True}
+    assert data["within_limits"] is True
+    
+    with fitz.open() as doc:
+        doc.new_page()
+        locked = doc.tobytes(encryption=fitz.PDF_ENCRYPT_AES_256, user_pw="secret", owner_pw="owner")
+    data = (await client.post("/api/v1/ocr/inspect", files={"file": ("locked.pdf", locked, "application/pdf")})).json()
+    assert data["needs_password"] is True and data["within_limits"] is False
+
+
+@pytest.mark.asyncio
+async def test_process_page_range(client: AsyncClient, device_id: str, fake_process_pages, monkeypatch):
+    from app.config import get_settings
+    files = {"file": ("book.pdf", io.BytesIO(b"%PDF-1.4 range"), "application/pdf")}
+    
+    response = await client.post(
+        "/api/v1/ocr/process", files=files, data={"pages": "2-3"}, headers={"X-Device-Id": device_id}
+    )
+    assert response.status_code == 200
+    assert fake_process_pages[-1]["page_indices"] == [1, 2]
+    assert response.json()["markdown"].startswith("## Page 2\n\npage 1")
+    
+    for pages in ("3-5", "x", "2-1"):
+        response = await client.post(
+            "/api/v1/ocr/process", files=files, data={"pages": pages}, headers={"X-Device-Id": device_id}
+        )
+        assert response.status_code == 400
+    
+    monkeypatch.setattr(get_settings(), "max_pages_per_request", 2)
+    response = await client.post("/api/v1/ocr/process", files=files, headers={"X-Device-Id": device_id})
+    assert response.status_code == 400
+    assert "at most 2" in response.json()["detail"]
+    # Rejected up front, nothing charged
+    tokens = await client.get("/api/v1/ocr/tokens", headers={"X-Device-Id": device_id})
+    assert tokens.json()["free_uses_remaining"] == 2
+
+
+@pytest.mark.asyncio
+async def test_document_etag_and_compression(client: AsyncClient, device_id: str, fake_process_pages, monkeypatch):
+    from app.config import get_settings
+    monkeypatch.setattr(get_settings(), "compression_min_bytes", 100)
+    files = {"file": ("book.pdf", io.BytesIO(b"%PDF-1.4 etag"), "application/pdf")}
+    document_id = (await client.post(
+        "/api/v1/ocr/process", files=files, headers={"X-Device-Id": device_id}
+    )).json()["document_id"]
+    
+    url = f"/api/v1/ocr/documents/{document_id}"
+    response = await client.get(url, headers={"X-Device-Id": device_id, "Accept-Encoding": "gzip"})
+    assert response.status_code == 200
+    assert response.headers["content-encoding"] == "gzip"
+    assert "Accept-Encoding" in response.headers["vary"]
+    etag = response.headers["etag"]
+    assert etag.endswith('-gzip"')
+    
+    # Either representation's tag validates, and the 304 keeps the client's tag
+    for tag in (etag, etag.replace("-gzip", "")):
+        response = await client.get(
+            url, headers={"X-Device-Id": device_id, "Accept-Encoding": "gzip", "If-None-Match": tag}
+        )
+        assert response.status_code == 304
+        assert response.content == b""
+        assert response.headers["etag"] == tag
+    
+    response = await client.get(url, headers={"X-Device-Id": device_id, "Accept-Encoding": "identity"})
+    assert "content-encoding" not in response.headers
+    assert response.headers["etag"] == etag.replace("-gzip", "")
+    assert response.json()["document_id"] == document_id
+
+
+@pytest.mark.asyncio
+async def test_export_not_modified(client: AsyncClient, fake_pandoc):
+    request = {"markdown": "# Hello", "format": "html"}
+    response = await client.post("/api/v1/ocr/export", json=request)
+    # Below compression_min_bytes, so sent as is
+    assert "content-encoding" not in response.headers
+    
+    response = await client.post(
+        "/api/v1/ocr/export", json=request, headers={"If-None-Match": response.headers["etag"]}
+    )
+    assert response.status_code == 304
+    response = await client.post(
+        "/api/v1/ocr/export", json={**request, "markdown": "# Changed"}, headers={"If-None-Match": response.headers["etag"]}
+    )
+    assert response.status_code == 200
@@ -115,3 +115,808 @@ def test_pdf_to_images_invalid():
     """Test PDF conversion with invalid data."""
     with pytest.raises(Exception):
         pdf_to_images(b"not a pdf")
+
+
+def test_assemble_markdown_single_page():
+    from app.services.ocr import assemble_markdown
+    assert assemble_markdown(["only page"]) == "only page"
+
+
+def test_assemble_markdown_multi_page():
+    from app.services.ocr import assemble_markdown
+    result = assemble_markdown(["first", "second"])
+    assert result == "## Page 1\n\nfirst\n\n---\n\n## Page 2\n\nsecond"
+
+
+def test_reocr_token_cost():
+    from app.services.tokens import reocr_token_cost
+    assert reocr_token_cost(1) == 1
+    assert reocr_token_cost(5) == 1
+    assert reocr_token_cost(6) == 2
+
+
+@pytest.mark.asyncio
+async def test_check_and_use_token_amount(db_session):
+    device_id = "multi-token-device"
+    
+    success, msg = await check_and_use_token(db_session, device_id, amount=2)
+    assert success is True
+    assert "1 remaining" in msg
+    
+    # Not enough left for another two
+    success, msg = await check_and_use_token(db_session, device_id, amount=2)
+    assert success is False
+    
+    status = await get_token_status(db_session, device_id)
+    assert status["free_uses_remaining"] == 1
+
+
+@pytest.mark.asyncio
+async def test_delete_stale_documents(db_session):
+    from app.services.documents import create_document, save_page, get_document, delete_stale_documents
+    from app.services.ocr import PageResult
+    
+    unfinished = await create_document(
+        db_session, filename="a.pdf", mime_type="application/pdf", source=b"a",
+        page_count=2, status="processing"
+    )
+    await save_page(db_session, unfinished.document_id, PageResult(0, "page", []), "model", 600)
+    finished = await create_document(
+        db_session, filename="b.pdf", mime_type="application/pdf", source=b"b",
+        pages=[PageResult(0, "page", [])], model="model"
+    )
+    
+    # Nothing is stale yet
+    assert await delete_stale_documents(db_session, 3600) == 0
+    
+    # Only unfinished documents are removed once past the TTL
+    assert await delete_stale_documents(db_session, -3600) == 1
+    assert await get_document(db_session, unfinished.document_id) is None
+    assert await get_document(db_session, finished.document_id) is not None
+    
+    # Completed documents, source included, go once past the retention
+    assert await delete_stale_documents(db_session, 3600, "completed") == 0
+    assert await delete_stale_documents(db_session, -3600, "completed") == 1
+    assert await get_document(db_session, finished.document_id) is None
+
+
+@pytest.mark.asyncio
+async def test_save_page_races_another_checkpoint(db_session):
+    from sqlalchemy import select
+    from app.models import OCRPage
+    from app.services.documents import create_document, get_document_pages, save_page
+    from app.services.ocr import PageResult
+    from tests.conftest import TestSessionLocal
+
+    document = await create_document(
+        db_session, filename="a.pdf", mime_type="application/pdf", source=b"a",
+        page_count=2, status="processing"
+    )
+    document_id = document.document_id
+    await save_page(db_session, document_id, PageResult(1, "old", []), "model", 600)
+    loaded = await get_document_pages(db_session, document_id)
+
+    # Another request checkpoints the same page right before this one writes it
+    execute = db_session.execute
+    raced = []
+
+    async def racing_execute(statement, *args, **kwargs):
+        if not raced and not str(statement).lstrip().upper().startswith("SELECT"):
+            raced.append(True)
+            async with TestSessionLocal() as other:
+                other.add(OCRPage(document_id=document_id, page_index=0, markdown="theirs", model="model"))
+                await other.commit()
+        return await execute(statement, *args, **kwargs)
+
+    db_session.execute = racing_execute
+    await save_page(db_session, document_id, PageResult(0, "ours", []), "model", 600)
+    del db_session.execute
+    await save_page(db_session, document_id, PageResult(1, "new", []), "model", 600)
+
+    # Objects loaded before stay usable and current, without a lazy load
+    assert document.mime_type == "application/pdf"
+    assert loaded[0].markdown == "new"
+    async with TestSessionLocal() as fresh:
+        pages = (await fresh.execute(select(OCRPage).order_by(OCRPage.page_index))).scalars().all()
+    assert [page.markdown for page in pages] == ["ours", "new"]
+
+
+@pytest.mark.asyncio
+async def test_convert_markdown_is_cached(fake_pandoc):
+    from app.services.export import cache_key, convert_markdown
+    from app.state import get_state
+    
+    assert await convert_markdown("# Title", "docx") == b"# Title"
+    assert await convert_markdown("# Title", "docx") == b"# Title"
+    assert fake_pandoc.read_text().count("run") == 1
+    # In the state backend, so other workers and replicas reuse it
+    assert await get_state().get(f"export:{cache_key('# Title', 'docx')}") == b"# Title"
+
+
+@pytest.mark.asyncio
+async def test_convert_markdown_survives_first_caller_cancelling(monkeypatch):
+    import asyncio
+    from app.services import export
+    from app.state import MemoryState, set_state
+
+    set_state(MemoryState())
+    release = asyncio.Event()
+    runs = []
+
+    async def slow_convert(markdown, fmt):
+        runs.append(markdown)
+        await release.wait()
+        return markdown.encode()
+
+    monkeypatch.setattr(export, "_convert", slow_convert)
+    first = asyncio.create_task(export.convert_markdown("# Shared", "docx"))
+    second = asyncio.create_task(export.convert_markdown("# Shared", "docx"))
+    await asyncio.sleep(0)
+    first.cancel()
+    await asyncio.sleep(0)
+    release.set()
+
+    assert await second == b"# Shared"
+    assert first.cancelled()
+    assert runs == ["# Shared"]
+    assert await export.convert_markdown("# Shared", "docx") == b"# Shared"
+    assert runs == ["# Shared"]
+
+
+@pytest.mark.asyncio
+async def test_convert_markdown_failure(tmp_path, monkeypatch):
+    from app.services import export
+    from app.state import MemoryState, set_state
+    
+    script = tmp_path / "pandoc"
+    script.write_text("#!/bin/sh\necho broken >&2\nexit 1\n")
+    script.chmod(0o755)
+    monkeypatch.setattr(export.settings, "pandoc_path", str(script))
+    set_state(MemoryState())
+    
+    with pytest.raises(export.ExportError, match="broken"):
+        await export.convert_markdown("# Title", "docx")
+
+
+@pytest.mark.asyncio
+async def test_convert_markdown_html_uses_mathml(fake_pandoc):
+    from app.services.export import convert_markdown
+    
+    assert await convert_markdown("$x$", "html") == b"$x$"
+    assert "--to=html --standalone --mathml" in fake_pandoc.read_text()
+
+
+@pytest.mark.asyncio
+async def test_pandoc_server_mode(fake_pandoc, monkeypatch):
+    from app.services import export
+    
+    monkeypatch.setattr(export.settings, "pandoc_server_enabled", True)
+    await export.start_export_server()
+    try:
+        assert export._server is not None
+        assert await export.convert_markdown("# Served", "latex") == b"# Served"
+    finally:
+        await export.stop_export_server()
+    
+    assert export._server is None
+    assert fake_pandoc.read_text() == "server latex\n"
+
+
+def test_repair_markdown_fixes_common_errors():
+    from app.services.latex import repair_markdown
+    
+    result = repair_markdown("设 $\\frac{a}{b$ 且 $$\\left( x + y$$ 成立")
+    assert result.markdown == "设 $\\frac{a}{b}$ 且\n$$\n\\left( x + y\\right.\n$$\n成立"
+    assert [d.code for d in result.diagnostics] == ["unclosed-brace", "unclosed-left"]
+    assert result.unresolved == []
+
+
+def test_repair_markdown_environments_and_delimiters():
+    from app.services.latex import repair_markdown
+    
+    result = repair_markdown("\\[ \\begin{aligned} a &= b \\]")
+    assert result.markdown == "$$\n\\begin{aligned} a &= b\\end{aligned}\n$$"
+    assert all(d.fixed for d in result.diagnostics)
+
+
+def test_repair_markdown_reports_unknown_commands():
+    from app.services.latex import repair_markdown
+    
+    result = repair_markdown("$\\mathbbm{R}$ and $\\foo x$")
+    assert result.markdown == "$\\mathbb{R}$ and $\\foo x$"
+    assert [d.message for d in result.unresolved] == ["Unsupported command \\foo"]
+
+
+def test_repair_markdown_accepts_common_katex_commands():
+    from app.services.latex import repair_markdown
+
+    text = (
+        "$$\n\\begin{aligned} a &= b \\nonumber \\\\ c &= d \\mbox{ if } \\ket{\\psi}\\end{aligned}\n$$\n\n"
+        "$\\emph{x}, \\braket{\\phi|\\psi}, \\iddots$"
+    )
+    result = repair_markdown(text)
+    assert result.markdown == text
+    assert result.diagnostics == []
+
+
+def test_repair_markdown_leaves_dollars_and_code_alone():
+    from app.services.latex import repair_markdown
+    
+    text = "It costs $5 and $10.\n\n```\n$$ {\n```\n`$x`"
+    result = repair_markdown(text)
+    assert result.markdown == text
+    assert result.diagnostics == []
+
+
+@pytest.mark.asyncio
+async def test_clean_markdown_only_calls_llm_when_needed(monkeypatch):
+    from app.services import ocr
+    
+    calls = []
+    
+    async def fake_format(raw_text):
+        calls.append(raw_text)
+        return "formatted"
+    
+    monkeypatch.setattr(ocr, "format_markdown", fake_format)
+    monkeypatch.setattr(ocr.settings, "format_mode", "auto")
+    
+    markdown, diagnostics = await ocr.clean_markdown("$x^{2$")
+    assert markdown == "$x^{2}$"
+    assert diagnostics[0]["fixed"] is True
+    assert calls == []
+    
+    markdown, _ = await ocr.clean_markdown("$\\foo$")
+    assert markdown == "formatted"
+    assert calls == ["$\\foo$"]
+
+
+@pytest.mark.asyncio
+async def test_process_pages_records_stage_metrics(fake_llm, sample_image):
+    from prometheus_client import REGISTRY
+    from app.services.ocr import process_pages
+    
+    def sample(name, **labels):
+        return REGISTRY.get_sample_value(name, {"tool": "textbook-ocr", **labels}) or 0
+    
+    ocr_before = sample("ocr_stage_duration_seconds_count", stage="ocr", model="gemini-2.5-pro")
+    tokens_before = sample("llm_tokens_total", model="gemini-2.5-pro", kind="completion")
+    
+    pages = await process_pages(sample_image, "image/png")
+    
+    assert pages[0].markdown == "# OCR\n\n$x^2$"
+    assert sample("ocr_stage_duration_seconds_count", stage="ocr", model="gemini-2.5-pro") == ocr_before + 1
+    assert sample("llm_tokens_total", model="gemini-2.5-pro", kind="completion") == tokens_before + 20
+    assert sample("ocr_stage_in_flight", stage="ocr") == 0
+
+
+@pytest.mark.asyncio
+async def test_admission_controller_queues_then_sheds():
+    import asyncio
+    from app.services.admission import AdmissionController, Overloaded, estimate_cost
+    
+    assert estimate_cost("application/pdf", 12, 10**6) == 12
+    assert estimate_cost("image/png", 1, 9 * 2**20) == 3
+    
+    controller = AdmissionController(capacity=4, max_wait=1, default_seconds=2)
+    order = []
+    
+    async def job(name, cost, release):
+        async with controller.admit(cost):
+            order.append(name)
+            await release.wait()
+    
+    first, second = asyncio.Event(), asyncio.Event()
+    running = asyncio.create_task(job("first", 3, first))
+    await asyncio.sleep(0)
+    # 1 page over capacity at 2 s per 4 pages: queued rather than shed
+    queued = asyncio.create_task(job("second", 2, second))
+    await asyncio.sleep(0)
+    assert controller.queued == 2
+    
+    with pytest.raises(Overloaded) as shed:
+        async with controller.admit(4):
+            pass
+    assert shed.value.retry_after == 3
+    
+    first.set()
+    await running
+    second.set()
+    await queued
+    assert order == ["first", "second"]
+    assert controller.in_flight == controller.queued == 0
+
+
+@pytest.mark.asyncio
+async def test_deadline_caps_llm_timeout_and_cancels(fake_llm, sample_image, monkeypatch):
+    import asyncio
+    from app.config import get_settings
+    from app.services.deadline import (
+        ClientDisconnected, DeadlineExceeded, cancel_on_disconnect, deadline, request_budget
+    )
+    from app.services.ocr import ocr_image
+    
+    monkeypatch.setattr(get_settings(), "request_deadline_base_seconds", 60)
+    monkeypatch.setattr(get_settings(), "request_deadline_seconds_per_page", 100)
+    assert request_budget(10, concurrency=4) == 60 + 3 * 100
+    
+    await ocr_image(sample_image, "image/png")
+    assert fake_llm.calls[-1]["timeout"] == get_settings().llm_timeout_seconds
+    async with deadline(5):
+        await ocr_image(sample_image, "image/png")
+    assert 4 < fake_llm.calls[-1]["timeout"] <= 5
+    
+    with pytest.raises(DeadlineExceeded):
+        async with deadline(0.05):
+            await asyncio.sleep(10)
+    
+    gone = asyncio.Event()
+    
+    async def is_disconnected():
+        return gone.is_set()
+    
+    asyncio.get_running_loop().call_later(0.05, gone.set)
+    with pytest.raises(ClientDisconnected):
+        async with cancel_on_disconnect(is_disconnected, poll_interval=0.01):
+            await asyncio.sleep(10)
+
+
+def test_tracing_disabled_does_not_import_opentelemetry():
+    import subprocess
+    import sys
+    code = (
+        "import sys, app.main\n"
+        "assert not [m for m in sys.modules if m.startswith('opentelemetry')]\n"
+    )
+    subprocess.run([sys.executable, "-c", code], check=True)
+
+
+def test_importing_app_skips_heavy_modules():
+    import subprocess
+    import sys
+    code = (
+        "import sys, app.main\n"
+        "heavy = {'fitz', 'PIL', 'numpy', 'openai', 'httpx', 'aiosqlite'} & set(sys.modules)\n"
+        "assert not heavy, heavy\n"
+    )
+    subprocess.run([sys.executable, "-c", code], check=True)
+
+
+@pytest.mark.asyncio
+async def test_tracing_file_exporter(fake_llm, sample_image, tmp_path):
+    pytest.importorskip("opentelemetry.sdk")
+    import json
+    from types import SimpleNamespace
+    from app import tracing
+    from app.services.ocr import process_pages
+    
+    trace_file = tmp_path / "traces.jsonl"
+    tracing.setup_tracing(SimpleNamespace(
+        tracing_enabled=True,
+        tracing_exporter="file",
+        tracing_file=str(trace_file),
+        tool_name="textbook-ocr"
+    ))
+    try:
+        await process_pages(sample_image, "image/png")
+    finally:
+        tracing.shutdown_tracing()
+    
+    spans = {s["name"]: s for s in map(json.loads, trace_file.read_text().splitlines())}
+    assert spans["ocr.ocr"]["attributes"]["ocr.model"] == "gemini-2.5-pro"
+    assert spans["ocr.ocr"]["parent_id"] == spans["ocr.page"]["context"]["span_id"]
+
+
+def test_multiprocess_metrics(tmp_path):
+    import os
+    import subprocess
+    import sys
+    code = (
+        "import multiprocessing, os\n"
+        "from app import metrics\n"
+        "def work():\n"
+        "    metrics.ocr_requests.labels(tool='t', file_type='pdf').inc()\n"
+        "    metrics.pipeline_in_flight.labels(tool='t', stage='ocr').inc()\n"
+        "ctx = multiprocessing.get_context('fork')\n"
+        "workers = [ctx.Process(target=work) for _ in range(2)]\n"
+        "[w.start() for w in workers]; [w.join() for w in workers]\n"
+        "text = metrics.generate_metrics().decode()\n"
+        "assert 'ocr_requests_total{file_type=\"pdf\",tool=\"t\"} 2.0' in text, text\n"
+        "assert 'ocr_stage_in_flight{stage=\"ocr\",tool=\"t\"} 2.0' in text, text\n"
+        "metrics.cleanup_dead_processes()\n"
+        "assert 'ocr_stage_in_flight{' not in metrics.generate_metrics().decode()\n"
+    )
+    env = {**os.environ, "PROMETHEUS_MULTIPROC_DIR": str(tmp_path)}
+    subprocess.run([sys.executable, "-c", code], check=True, env=env)
+
+
+@pytest.mark.asyncio
+async def test_loop_watchdog_captures_blocking_stack():
+    import asyncio
+    import time
+    from app.profiling import LoopWatchdog
+    
+    watchdog = LoopWatchdog(threshold=0.1)
+    watchdog.start()
+    try:
+        await asyncio.sleep(0.05)
+        time.sleep(0.4)
+        await asyncio.sleep(0.05)
+    finally:
+        watchdog.stop()
+    
+    assert len(watchdog.events) == 1
+    assert "test_loop_watchdog_captures_blocking_stack" in watchdog.events[0]["stack"]
+
+
+def test_render_pdf_avoids_raw_pixel_copies():
+    import io
+    import tracemalloc
+    import fitz
+    from PIL import Image
+    from app.services.ocr import render_pdf
+    
+    with fitz.open() as doc:
+        doc.new_page().insert_text((72, 72), "x² + y² = z²")
+        pdf_bytes = doc.tobytes()
+    dpi = 150
+    
+    # The previous path: raw samples -> PIL image -> optimized PNG
+    tracemalloc.start()
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+        pix = doc.load_page(0).get_pixmap(matrix=fitz.Matrix(dpi / 72, dpi / 72))
+        raw_bytes = pix.width * pix.height * pix.n
+        img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+        buffer = io.BytesIO()
+        img.save(buffer, format="PNG", optimize=True)
+        buffer.getvalue()
+    _, pil_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del pix, img, buffer
+    
+    tracemalloc.start()
+    pages = render_pdf(pdf_bytes, dpi=dpi)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    
+    assert pages[0].image_bytes.startswith(b"\x89PNG")
+    assert pil_peak > raw_bytes
+    assert peak < raw_bytes / 4
+
+
+COMPLETION = {
+    "id": "chatcmpl-test",
+    "object": "chat.completion",
+    "created": 0,
+    "model": "test",
+    "choices": [{"index": 0, "message": {"role": "assistant", "content": "# OCR"}, "finish_reason": "stop"}],
+    "usage": {"prompt_tokens": 10, "completion_tokens": 3, "total_tokens": 13}
+}
+
+
+@pytest.mark.asyncio
+async def test_streaming_chat_client_body():
+    import base64
+    import json
+    import os
+    import httpx
+    from app.services.llm import ImageData, StreamingChatClient
+    
+    image = os.urandom(200_001)
+    requests = []
+    
+    async def handler(request: httpx.Request):
+        body = await request.aread()
+        assert int(request.headers["Content-Length"]) == len(body)
+        requests.append(json.loads(body))
+        return httpx.Response(200, json=COMPLETION)
+    
+    client = StreamingChatClient(
+        "http://llm/v1", "key", http_client=httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    )
+    result = await client.create(
+        model="m",
+        messages=[{"role": "user", "content": [
+            {"type": "text", "text": "识别"},
+            {"type": "image_url", "image_url": {"url": ImageData(image, "image/png")}}
+        ]}],
+        temperature=0.1
+    )
+    
+    assert result.content == "# OCR" and result.usage.completion_tokens == 3
+    url = requests[0]["messages"][0]["content"][1]["image_url"]["url"]
+    assert url.startswith("data:image/png;base64,")
+    assert base64.b64decode(url.split(",", 1)[1]) == image
+    assert requests[0]["messages"][0]["content"][0]["text"] == "识别"
+
+
+@pytest.mark.asyncio
+async def test_streaming_transport_lowers_peak_memory(monkeypatch):
+    import os
+    import tracemalloc
+    import httpx
+    from openai import AsyncOpenAI
+    from app.services import ocr
+    
+    class DiscardingTransport(httpx.AsyncBaseTransport):
+        async def handle_async_request(self, request):
+            async for _ in request.stream:
+                pass
+            return httpx.Response(200, json=COMPLETION)
+    
+    monkeypatch.setattr(ocr, "llm_client", AsyncOpenAI(
+        base_url="http://llm/v1", api_key="key", http_client=httpx.AsyncClient(transport=DiscardingTransport())
+    ))
+    monkeypatch.setattr(ocr, "streaming_llm_client", ocr.StreamingChatClient(
+        "http://llm/v1", "key", http_client=httpx.AsyncClient(transport=DiscardingTransport())
+    ))
+    image = os.urandom(3 * 2**20)
+    
+    peaks = {}
+    for transport in ("openai", "streaming"):
+        monkeypatch.setattr(ocr.settings, "llm_transport", transport)
+        await ocr.ocr_image(image, "image/png")  # Warm up
+        tracemalloc.start()
+        assert await ocr.ocr_image(image, "image/png") == "# OCR"
+        peaks[transport] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    
+    base64_size = len(image) * 4 / 3
+    assert peaks["openai"] > 2 * base64_size
+    assert peaks["streaming"] < base64_size / 4, peaks
+
+
+@pytest.mark.asyncio
+async def test_process_batch_isolates_failures(fake_llm, sample_image, monkeypatch):
+    import asyncio
+    from app.services import ocr
+    
+    running, peak = 0, 0
+    original = ocr.ocr_image
+    
+    async def slow_ocr_image(*args, **kwargs):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        return await original(*args, **kwargs)
+    
+    monkeypatch.setattr(ocr, "ocr_image", slow_ocr_image)
+    seen = []
+    
+    async def on_page(file_index, page):
+        seen.append(file_index)
+    
+    files = [ocr.BatchFile(sample_image, "image/png")] * 3 + [ocr.BatchFile(b"not a pdf", "application/pdf")]
+    outcomes = await ocr.process_batch(files, dpi=72, concurrency=2, on_page=on_page)
+    
+    assert [page.page_index for page in outcomes[0]] == [0]
+    assert isinstance(outcomes[3], Exception)
+    assert sorted(seen) == [0, 1, 2]
+    assert peak == 2
+
+
+@pytest.mark.asyncio
+async def test_process_batch_renders_in_windows(fake_llm, monkeypatch):
+    import fitz
+    from app.services import ocr
+
+    with fitz.open() as doc:
+        for i in range(9):
+            doc.new_page(width=100, height=100).insert_text((10, 50), f"page {i}")
+        pdf_bytes = doc.tobytes()
+    monkeypatch.setattr(ocr.settings, "render_window_pages", 2)
+
+    windows, rendered, done, held = [], 0, 0, 0
+    render_file, ocr_page = ocr.render_file, ocr.ocr_page
+
+    async def counting_render_file(*args, **kwargs):
+        nonlocal rendered, held
+        images = await render_file(*args, **kwargs)
+        windows.append(len(images))
+        rendered += len(images)
+        held = max(held, rendered - done)
+        return images
+
+    async def counting_ocr_page(*args, **kwargs):
+        nonlocal done
+        result = await ocr_page(*args, **kwargs)
+        done += 1
+        return result
+
+    monkeypatch.setattr(ocr, "render_file", counting_render_file)
+    monkeypatch.setattr(ocr, "ocr_page", counting_ocr_page)
+    outcomes = await ocr.process_batch([ocr.BatchFile(pdf_bytes, "application/pdf")], dpi=72, concurrency=1)
+
+    assert [page.page_index for page in outcomes[0]] == list(range(9))
+    assert windows == [2, 2, 2, 2, 1]
+    # The queue (2), one window and the page being OCR'd, never the whole PDF
+    assert held <= 5
+
+
+@pytest.mark.asyncio
+async def test_process_batch_stops_workers_when_files_fail(fake_llm, sample_image):
+    import asyncio
+    from app.services import ocr
+
+    def files():
+        yield ocr.BatchFile(sample_image, "image/png")
+        raise OSError("disk gone")
+
+    before = asyncio.all_tasks()
+    with pytest.raises(OSError):
+        await asyncio.wait_for(ocr.process_batch(files(), dpi=72, concurrency=2), 5)
+    assert asyncio.all_tasks() == before
+
+
+def test_preprocess_image_straightens_page_photo():
+    import io
+    from PIL import Image, ImageDraw
+    from app.services.preprocess import preprocess_image
+    
+    # A page of text lines, tilted 3° and lying on a dark desk
+    page = Image.new("L", (1200, 1600), 200)
+    draw = ImageDraw.Draw(page)
+    for y in range(150, 1450, 60):
+        draw.rectangle((120, y, 1080, y + 14), fill=70)
+    page = page.rotate(3, resample=Image.Resampling.BICUBIC, expand=True, fillcolor=200)
+    photo = Image.new("L", (page.width + 600, page.height + 600), 30)
+    photo.paste(page, (300, 300))
+    # Stored sideways, with the camera's orientation tag
+    photo = photo.rotate(90, expand=True)
+    exif = Image.Exif()
+    exif[0x0112] = 8
+    buffer = io.BytesIO()
+    photo.convert("RGB").save(buffer, format="JPEG", quality=90, exif=exif)
+    
+    result = preprocess_image(buffer.getvalue(), "image/jpeg", max_pixels=1_000_000)
+    
+    assert result.original_size == photo.size
+    assert result.cropped
+    assert result.skew_degrees == pytest.approx(-3, abs=0.3)
+    assert result.size[0] * result.size[1] <= 1_000_000
+    assert result.size[1] > result.size[0]  # Upright and without the desk
+    with Image.open(io.BytesIO(result.image_bytes)) as img:
+        gray = img.convert("L")
+        assert gray.getextrema()[0] < 40  # Ink stretched towards black
+
+
+def test_preprocess_image_never_grows_a_plain_photo():
+    import io
+    import os
+    from PIL import Image, ImageDraw
+    from app.services.preprocess import preprocess_image
+    
+    # Straight, uncropped, dim: only contrast (and the pixel budget) would apply
+    page = Image.new("L", (1600, 2000), 170)
+    draw = ImageDraw.Draw(page)
+    for y in range(100, 1900, 40):
+        draw.rectangle((100, y, 1500, y + 12), fill=110)
+    noise = Image.frombytes("L", page.size, os.urandom(page.width * page.height)).point(lambda v: v // 16)
+    photo = Image.merge("RGB", [Image.blend(page, noise, 0.1)] * 3)
+    buffer = io.BytesIO()
+    photo.save(buffer, format="JPEG", quality=60)
+    data = buffer.getvalue()
+    
+    for max_pixels in (4_000_000, 2_500_000, 1_000_000):
+        result = preprocess_image(data, "image/jpeg", max_pixels)
+        assert len(result.image_bytes) <= len(data)
+    assert preprocess_image(data, "image/jpeg", 4_000_000).image_bytes == data
+
+
+@pytest.mark.asyncio
+async def test_token_status_is_read_only_and_cached(db_session):
+    from sqlalchemy import event, func, select
+    from app.models import DeviceToken
+    
+    statements = []
+    
+    def count_statement(*args):
+        statements.append(args[2])
+    
+    engine = db_session.bind.sync_engine
+    event.listen(engine, "before_cursor_execute", count_statement)
+    try:
+        status = await get_token_status(db_session, "polling-device")
+        await get_token_status(db_session, "polling-device")
+    finally:
+        event.remove(engine, "before_cursor_execute", count_statement)
+    
+    assert status["total_available"] == 3
+    assert len(statements) == 1 and statements[0].lstrip().upper().startswith("SELECT")
+    assert await db_session.scalar(select(func.count()).select_from(DeviceToken)) == 0
+    
+    # Spending and buying update the cached balance
+    await check_and_use_token(db_session, "polling-device")
+    assert (await get_token_status(db_session, "polling-device"))["total_available"] == 2
+    await add_tokens(db_session, 5, device_id="polling-device")
+    assert (await get_token_status(db_session, "polling-device"))["total_available"] == 7
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("backend", ["memory", "sql", "redis"])
+async def test_state_backends(backend, db_session, fake_redis):
+    import asyncio
+    from app.state import MemoryState, RedisState, SQLState
+    from tests.conftest import test_engine
+    
+    if backend == "memory":
+        state = MemoryState()
+    elif backend == "sql":
+        state = SQLState(test_engine)
+    else:
+        state = RedisState(fake_redis.url, prefix="test:")
+    
+    try:
+        assert await state.get("missing") is None
+        await state.set("entry", b"value")
+        await state.set("short", b"value", ttl=0.05)
+        assert await state.get("entry") == b"value"
+        assert await state.get("short") == b"value"
+        
+        # Counters keep the expiry of their first increment
+        assert await state.incr("hits", ttl=0.2) == 1
+        assert await state.incr("hits", 2, ttl=0.2) == 3
+        assert await state.get("hits") == b"3"
+        await asyncio.sleep(0.25)
+        assert await state.get("short") is None
+        assert await state.incr("hits", ttl=0.2) == 1
+        await state.delete("entry")
+        assert await state.get("entry") is None
+    finally:
+        await state.close()
+    
+    if backend == "redis":
+        assert {"INCRBY", "PEXPIRE"} <= set(fake_redis.commands)
+
+
+@pytest.mark.asyncio
+async def test_memory_state_bounds_bytes():
+    from app.state import MemoryState
+    
+    state = MemoryState(max_bytes=10)
+    await state.set("a", b"12345")
+    await state.set("b", b"12345")
+    await state.incr("hits")
+    await state.get("a")
+    # Over 10 bytes: the least recently used value goes
+    await state.set("c", b"123")
+    assert await state.get("b") is None
+    assert await state.get("a") == b"12345"
+    assert await state.get("hits") == b"1"
+    await state.set("a", b"1")
+    await state.set("d", b"123456")
+    assert await state.get("c") == b"123"
+
+
+@pytest.mark.asyncio
+async def test_cli_bulk_ocr_resumes_from_manifest(fake_llm, sample_image, tmp_path):
+    import io
+    from app.cli import MANIFEST_NAME, run_ocr
+    
+    (tmp_path / "series" / "vol1").mkdir(parents=True)
+    (tmp_path / "series" / "vol1" / "cover.png").write_bytes(sample_image)
+    (tmp_path / "series" / "notes.png").write_bytes(sample_image)
+    (tmp_path / "series" / "notes.jpg").write_bytes(b"not an image")
+    (tmp_path / "series" / "readme.txt").write_text("skipped")
+    root = tmp_path / "series"
+    
+    stats = await run_ocr(root, log=io.StringIO())
+    assert stats["files"] == 3 and stats["written"] == 3 and stats["pages"] == 3
+    # Unreadable images still go to the model as they are
+    assert stats["failed"] == 0
+    assert (root / "vol1" / "cover.md").read_text() == "# OCR\n\n$x^2$"
+    # notes.png and notes.jpg would both be notes.md
+    assert (root / "notes.png.md").exists() and (root / "notes.jpg.md").exists()
+    
+    calls = len(fake_llm.calls)
+    stats = await run_ocr(root, log=io.StringIO())
+    assert stats["skipped"] == 3 and stats["pages"] == 0
+    assert len(fake_llm.calls) == calls
+    
+    # Changed content is OCR'd again; the manifest keeps one record per event
+    (root / "notes.png").write_bytes(sample_image + b"\0")
+    stats = await run_ocr(root, log=io.StringIO())
+    assert stats["written"] == 1 and stats["skipped"] == 2
+    assert (root / MANIFEST_NAME).read_text().count('"done": true') == 4
@@ -17,6 +17,7 @@ export interface OCRResult {
   markdown?: string
   error?: string
   tokens_remaining: number
+  document_id?: string
 }
 
 export interface Product {